@@ -1,49 +1,76 @@
-from utility import determine_media_type
-from artist_matching.converters import (
-    transcribe_audio,
-    transcribe_image,
-    describe_audio,
-    describe_image,
-    get_generic_description,
-    generate_tags,
+from artist_matching.converters import transcribe_audio, transcribe_image, analyze
+from artist_matching.qdrant_handler import (
+    EMBEDDING_DIM,
+    add_to_vectorstore,
+    engine_collection,
+    ensure_collection,
+    search_vectorstore,
+    search_vectorstore_batch,
 )
-from artist_matching.qdrant_handler import add_to_vectorstore, search_vectorstore
-from flask import Flask, request, jsonify, send_file
+from artist_matching.local_index import get_local_index
+from artist_matching.stage_cache import get_stage_cache
+from artist_matching.embeddings import embedding_cache_stats
+from artist_matching.tag_centroids import refresh_tag_centroids
+from artist_matching.dedup import closest_match, dedup_fields, duplicate_query, near_duplicate_query
+from artist_matching.dedup import perceptual_hash as compute_perceptual_hash
+from artist_matching.neighbours import RETURN_TYPES, NeighbourStore
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_pymongo import PyMongo
 from flask_bcrypt import Bcrypt
 from config import Config
-from kindo_api import KindoAPI
+from clients import get_http_session, init_clients, registry
 from firebase_handler import FirebaseHandler
-from werkzeug.utils import secure_filename
+from media_io import InMemoryRequest, read_upload
+from job_queue import JobQueue, QueueFullError
+from bootstrap import Bootstrap
+from progress import ProgressTracker, TooManyTasksError
+from pipeline import StageGraph
+from metrics import current_trace, metrics, server_timing, timed
+from resilience import outbound_stats
 import os
+import json
+import contextvars
 import time
+import datetime
 import re
 import sys
-import threading
 import uuid
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 if os.getenv("SHOW_LOGS") == "True":
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 app = Flask(__name__)
+# Uploads stay in memory and are streamed to Firebase and the model APIs from there
+app.request_class = InMemoryRequest
 
-app.config["UPLOAD_FOLDER"] = "./tmp"
+app.config["MAX_CONTENT_LENGTH"] = Config.MAX_UPLOAD_BYTES
 app.config["MONGO_URI"] = Config.MONGO_URI
 
-# Ensure the upload folder exists
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-
-firebase_cred_path = "artist-recommendation-key.json"
-firebase_bucket_name = "artist-recommendation.firebasestorage.app"
-
 # Initialize KindoAPI
 mongo = PyMongo(app)
 bcrypt = Bcrypt(app)
 
-# Initialize KindoAPI with the API key from the config file
-kindo_api = KindoAPI(api_key=Config.KINDO_API_KEY)
-firebase_handler = FirebaseHandler(firebase_cred_path, firebase_bucket_name)
+# Initialize the pooled outbound clients once per worker
+init_clients()
+firebase_handler = FirebaseHandler(Config.FIREBASE_CRED_PATH, Config.FIREBASE_BUCKET_NAME)
+# Runs the independent stages of the /upload and /save pipelines side by side
+stage_executor = ThreadPoolExecutor(max_workers=Config.PIPELINE_WORKERS)
+
+
+def upload_media(media):
+    return firebase_handler.upload_bytes(
+        media.blob_name, media.data, media.content_type, chunk_size=Config.FIREBASE_CHUNK_SIZE
+    )
+
+
+def fetch_media(url):
+    with timed("firebase.download") as span:
+        response = get_http_session().get(url)
+        response.raise_for_status()
+        span.bytes_received = len(response.content)
+    return response.content
 
 
 # Signup API
@@ -75,34 +102,264 @@ def login():
     return jsonify(success=False, message="Invalid credentials"), 401
 
 
+@app.before_request
+def start_trace():
+    g.trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.trace_start = time.perf_counter()
+    g.trace_token = current_trace.set([])
+
+
+def route_name(endpoint):
+    # Requests matching no route (404s, scanners) share one label instead of one per path
+    return endpoint or "unmatched"
+
+
+@app.after_request
+def finish_trace(response):
+    trace = current_trace.get()
+    elapsed = time.perf_counter() - g.trace_start
+    metrics.observe(f"request.{route_name(request.endpoint)}", elapsed, error=response.status_code >= 500)
+    current_trace.reset(g.trace_token)
+
+    if Config.SERVER_TIMING:
+        response.headers["X-Request-ID"] = g.trace_id
+        response.headers["Server-Timing"] = server_timing(trace + [("total", elapsed)])
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """
+    Stage timings, errors and bytes transferred, plus cache and connection pool counters, in the Prometheus text format.
+    """
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def render_metrics():
+    client_stats = {
+        f"{client}_{key}": value
+        for client, stats in registry.stats().items()
+        for key, value in stats.items()
+    }
+    endpoint_stats = {
+        f"{endpoint}_{key}": value
+        for endpoint, stats in outbound_stats().items()
+        for key, value in stats.items()
+    }
+    return (
+        metrics.render()
+        + metrics.render_gauges("stage_cache", get_stage_cache().stats(), "Stage cache counters.")
+        + metrics.render_gauges("embedding_cache", embedding_cache_stats(), "Embedding cache counters.")
+        + metrics.render_gauges("clients", client_stats, "Pooled client and connection counters.")
+        + metrics.render_gauges("outbound", endpoint_stats, "Retry, circuit breaker and hedging counters of outbound calls.")
+    )
+
+
+def ensure_indexes():
+    mongo.db.media.create_index("url")
+    mongo.db.users.create_index("username")
+    # Looked up by /save and its job to find duplicates
+    mongo.db.media.create_index("content_hash")
+    mongo.db.media.create_index("phash_bands")
+    mongo.db.neighbours.create_index("point_id", unique=True)
+    mongo.db.neighbours.create_index("url")
+    mongo.db.queries.create_index("created_at", expireAfterSeconds=Config.QUERY_TOKEN_TTL)
+
+
+def check_local_index():
+    index = get_local_index(engine_collection(os.getenv("QDRANT_INDEX_NAME")), EMBEDDING_DIM)
+    if not index.ready.is_set():
+        raise RuntimeError("Local vector index not loaded yet")
+
+
+# Schema setup, done once per worker here rather than on every write
+bootstrap = Bootstrap()
+bootstrap.register("qdrant", lambda: ensure_collection(engine_collection(os.getenv("QDRANT_INDEX_NAME"))))
+bootstrap.register("mongo", ensure_indexes)
+if Config.VECTOR_BACKEND == "local":
+    bootstrap.register("local_index", check_local_index, once=False)
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness of the worker: 200 once every bootstrap check passed, 503 otherwise.
+    Failed checks are retried on every call.
+
+    Response:
+    - ready (bool): Whether the worker can serve requests.
+    - checks (object): Per check, "ok", its duration in "seconds" and the "error" if it failed.
+    """
+    status = bootstrap.run()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+def hydrate_results(points):
+    """
+    Builds the artist details of search results, in the order of the results.
+
+    Points ingested with the artist in their payload need no lookup; the others are
+    resolved with a single MongoDB query. Results without a stored artist keep null details.
+    """
+    missing = missing_artists(points)
+    artists = {}
+    if missing:
+        with timed("mongo.hydrate"):
+            for media in mongo.db.media.find({"url": {"$in": missing}}):
+                artists[media["url"]] = media
+    return format_results(points, artists)
+
+
+def missing_artists(points):
+    return [point.payload["url"] for point in points if "artist" not in point.payload]
+
+
+def format_results(points, artists):
+    response_data = []
+    for point in points:
+        url = point.payload["url"]
+        artist = point.payload.get("artist") or artists.get(url, {})
+        result = {
+            "url": url,
+            "artist_name": artist.get('name'),
+            "artist_email": artist.get('email'),
+            "artist_portfolio_url": artist.get('portfolio_url'),
+            "title": artist.get('title'),
+            "score": point.score,
+        }
+        # Set when the hits were re-ranked by tags
+        if point.order_value is not None:
+            result["rank_score"] = point.order_value
+        response_data.append(result)
+    return response_data
+
+
+# Pooled client counters, to confirm connections are being reused
+@app.route("/stats/clients", methods=["GET"])
+def client_stats():
+    return jsonify(registry.stats()), 200
+
+
+# Hit ratio and size of the description/tag stage cache
+@app.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    return jsonify(get_cache_stats()), 200
+
+
+def get_cache_stats():
+    stats = get_stage_cache().stats()
+    stats["embeddings"] = embedding_cache_stats()
+    return stats
+
+
 # Background task to process slides and save to MongoDB
 def process_save_file(
-    local_file_path, filename, media_type, artist_name, email, portfolio_url, title
+    input_media_url, content_hash, media_type, artist_name, email, portfolio_url, title, perceptual_hash=None
 ):
-    # Upload the image to Firebase
-    input_media_url = firebase_handler.upload_to_firebase(filename, local_file_path)
-
-    metadata = {
-        "url": input_media_url,
+    artist = {
         "name": artist_name,
         "email": email,
         "portfolio_url": portfolio_url,
         "title": title,
     }
 
-    mongo.db.media.insert_one(metadata)
+    def save_artist():
+        # Upsert so that a retried job does not store the artist twice
+        with timed("mongo.save"):
+            mongo.db.media.update_one(
+                {"url": input_media_url},
+                {"$set": {"url": input_media_url, **artist}},
+                upsert=True,
+            )
+
+    def find_near_duplicate(phash):
+        if phash is None:
+            return None
+        with timed("mongo.dedup"):
+            candidates = mongo.db.media.find({**near_duplicate_query(media_type, phash), "url": {"$ne": input_media_url}})
+            match = closest_match(candidates, phash)
+        if match is None:
+            return None
+        # Possibly another artist's similar work, so it is reported rather than skipped
+        logging.info(f"{input_media_url} is a near duplicate of {match['url']}")
+        return match["url"]
+
+    def mark_saved(saved, stored, phash, near_duplicate_of):
+        # /save treats media carrying these fields as already saved, so they are only
+        # written once the point is stored; a failed job leaves the media ingestible again
+        fields = dedup_fields(media_type, content_hash, phash)
+        if near_duplicate_of is not None:
+            fields["near_duplicate_of"] = near_duplicate_of
+        with timed("mongo.save"):
+            mongo.db.media.update_one({"url": input_media_url}, {"$set": fields})
+
+    def store(analysis):
+        add_to_vectorstore(
+            text=analysis["generic_description"],
+            tags=analysis["tags"],
+            type=media_type,
+            url=input_media_url,
+            artist=artist,
+            content_hash=content_hash,
+        )
+
+    # Jobs queued before the hash moved out of /save carry it in their payload
+    hash_media = Config.DEDUP_ENABLED and perceptual_hash is None
+
+    # The MongoDB write and the fingerprint do not depend on the analysis, so they run alongside it
+    graph = StageGraph(stage_executor)
+    graph.add("mongo", save_artist)
+    if media_type == "audio" or hash_media:
+        graph.add("data", lambda: fetch_media(input_media_url))
     if media_type == "audio":
-        transcription = transcribe_audio(local_file_path)
-        description = describe_audio(transcription)
+        graph.add("transcription", lambda data: transcribe_audio(data, content_hash=content_hash), after=["data"])
     else:
-        transcription = transcribe_image(input_media_url)
-        description = describe_image(transcription)
+        # With PREPROCESS_MEDIA the image is downloaded back only on a cache miss
+        graph.add("transcription", lambda: transcribe_image(input_media_url, content_hash=content_hash))
+    graph.add("analysis", lambda transcription: analyze(transcription, media_type), after=["transcription"])
+    graph.add("vectorstore", store, after=["analysis"])
+    if hash_media:
+        # Runs ffmpeg on audio, so it is done here rather than in the /save request
+        graph.add("phash", lambda data: compute_perceptual_hash(media_type, data), after=["data"])
+    else:
+        graph.add("phash", lambda: perceptual_hash)
+    graph.add("near_duplicate", find_near_duplicate, after=["phash"])
+    graph.add("dedup", mark_saved, after=["mongo", "vectorstore", "phash", "near_duplicate"])
+    results = graph.run()
 
-    generic_description = get_generic_description(description)
-    tags = generate_tags(generic_description)
-    add_to_vectorstore(
-        text=generic_description, tags=tags, type=media_type, url=input_media_url
-    )
+    if Config.NEIGHBOURS_ENABLED and media_type in RETURN_TYPES:
+        try:
+            job_queue.submit(
+                "update_neighbours",
+                {"url": input_media_url, "content_hash": content_hash},
+                delay=Config.NEIGHBOURS_UPDATE_DELAY,
+            )
+        except QueueFullError:
+            # The nightly refresh catches up
+            logging.warning(f"Job queue full, recommendations of {input_media_url} not updated")
+    return {"near_duplicate_of": results["near_duplicate"]}
+
+
+neighbour_store = NeighbourStore(mongo.db, hydrate_results)
+
+
+job_queue = JobQueue(
+    collection=mongo.db.jobs,
+    workers=Config.JOB_WORKERS,
+    max_pending=Config.JOB_QUEUE_MAX_PENDING,
+    max_attempts=Config.JOB_MAX_ATTEMPTS,
+    backoff_base=Config.JOB_BACKOFF_BASE,
+    backoff_max=Config.JOB_BACKOFF_MAX,
+    lease_seconds=Config.JOB_LEASE_SECONDS,
+    retention=Config.JOB_RETENTION,
+)
+bootstrap.register("jobs", job_queue.ensure_indexes)
+logging.info(f"Bootstrap: {bootstrap.run()}")
+job_queue.register("save_media", process_save_file)
+job_queue.register("refresh_tag_centroids", refresh_tag_centroids)
+job_queue.register("update_neighbours", neighbour_store.add)
+job_queue.register("refresh_neighbours", neighbour_store.refresh)
+job_queue.start()
 
 
 # Async endpoint, that initiates the processing and storing of image in the background
@@ -118,46 +375,360 @@ def save_file():
     - user_id (string): The user ID. (Required)
 
     Response:
-    - input_media_url (string): URL generated for the input media.
+    - job_id (string): ID of the background job, to be polled on /jobs/<job_id>.
+
+    When the same file was already saved, returns 200 with:
+    - duplicate (bool): true.
+    - input_media_url (string): URL of the media saved before.
+
+    Returns 429 with a Retry-After header when too many uploads are already pending.
     """
-    if "file" not in request.files:
-        return jsonify({"error": "No file part"}), 400
+    media, error = parse_save_form(request.files, request.form)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    if Config.DEDUP_ENABLED:
+        with timed("mongo.dedup"):
+            duplicate = mongo.db.media.find_one(duplicate_query(media.content_hash))
+        if duplicate is not None:
+            # Already stored, analyzed and indexed; skip all of it
+            return jsonify(duplicate_response(duplicate)), 200
+
+    # Queue background processing of the file
+    try:
+        # Checked before the upload so that a rejected request does not pay for a blob; a
+        # request losing the race to a full queue leaves its blob under the content-addressed
+        # name, which its retry overwrites
+        job_queue.check_capacity()
+        # Store the file before queueing, so the job only carries its URL
+        input_media_url = upload_media(media)
+        job_id = job_queue.submit("save_media", save_job_payload(media, input_media_url, request.form))
+    except QueueFullError:
+        response = jsonify({"error": "Too many pending uploads, try again later"})
+        response.headers["Retry-After"] = str(Config.JOB_RETRY_AFTER)
+        return response, 429
 
-    file = request.files["file"]
+    return jsonify({"job_id": job_id}), 202
+
+
+def parse_save_form(files, form):
+    """
+    Validates a /save request and reads its file.
+
+    Returns:
+        tuple: The media, or None and the (message, status code) of the error.
+    """
+    if "file" not in files:
+        return None, ("No file part", 400)
+
+    file = files["file"]
     if file.filename == "":
-        return jsonify({"error": "No selected file"}), 400
+        return None, ("No selected file", 400)
 
-    user_id = request.form.get("user_id")
-    if not user_id:
-        return jsonify({"error": "User ID is required"}), 400
-
-    artist_name = request.form.get("artist_name")
-    email = request.form.get("email")
-    portfolio_url = request.form.get("portfolio_url")
-    title = request.form.get("title")
-
-    filename = secure_filename(file.filename)
-    local_file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    file.save(local_file_path)
-
-    media_type = determine_media_type(local_file_path)
-    if not media_type:
-        return jsonify({"error": "Unsupported media type"}), 400
-
-    # Start background processing of slides
-    threading.Thread(
-        target=process_save_file,
-        args=(
-            local_file_path,
-            filename,
-            media_type,
-            artist_name,
-            email,
-            portfolio_url,
-            title,
+    if not form.get("user_id"):
+        return None, ("User ID is required", 400)
+
+    media = read_upload(file)
+    if media.media_type not in ["audio", "image"]:
+        return None, ("Unsupported media type", 400)
+    return media, None
+
+
+def duplicate_response(duplicate):
+    logging.info(f"Skipping duplicate of {duplicate['url']}")
+    return {"duplicate": True, "input_media_url": duplicate["url"]}
+
+
+def save_job_payload(media, input_media_url, form):
+    return {
+        "input_media_url": input_media_url,
+        "content_hash": media.content_hash,
+        "media_type": media.media_type,
+        "artist_name": form.get("artist_name"),
+        "email": form.get("email"),
+        "portfolio_url": form.get("portfolio_url"),
+        "title": form.get("title"),
+    }
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Returns the status of a job queued by /save.
+
+    Response:
+    - id (string): The job ID.
+    - status (string): One of 'queued', 'running', 'done', 'failed'.
+    - attempts (int): Number of attempts made so far.
+    - error (string): Error of the last failed attempt, if any.
+    - result (object): Once done, what the job returned. For /save, "near_duplicate_of" is the
+      URL of a saved media that looks or sounds the same (e.g. re-encoded), or null.
+
+    Finished jobs are kept JOB_RETENTION seconds.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+
+# Nightly App Engine cron, see cron.yaml
+@app.route("/tasks/refresh_tag_centroids", methods=["GET"])
+def refresh_tag_centroids_task():
+    """
+    Queues the recomputation of the tag centroids used by TAGGING_ENGINE=centroid.
+
+    Only accepted from App Engine cron, which sets the X-Appengine-Cron header
+    (App Engine strips it from outside requests).
+
+    Response:
+    - job_id (string): ID of the background job, to be polled on /jobs/<job_id>.
+    """
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        job_id = job_queue.submit("refresh_tag_centroids", {})
+    except QueueFullError:
+        return jsonify({"error": "Job queue is full"}), 503
+    return jsonify({"job_id": job_id}), 202
+
+
+# Nightly App Engine cron, see cron.yaml
+@app.route("/tasks/refresh_neighbours", methods=["GET"])
+def refresh_neighbours_task():
+    """
+    Queues the recomputation of the recommendations of the whole catalogue served by /recommendations.
+    Only accepted from App Engine cron, like /tasks/refresh_tag_centroids.
+
+    Response:
+    - job_id (string): ID of the background job, to be polled on /jobs/<job_id>.
+    """
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        job_id = job_queue.submit("refresh_neighbours", {})
+    except QueueFullError:
+        return jsonify({"error": "Job queue is full"}), 503
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route("/recommendations", methods=["GET"])
+def recommendations():
+    """
+    Returns the precomputed recommendations of a saved media: audio for an image, images
+    for an audio. Served from the stored results, without running the /upload pipeline.
+
+    Request Parameters:
+    - url (string): URL of the saved media, as returned by /save. (url or id)
+    - id (string): ID of its Qdrant point, a UUID. (url or id)
+    - k (int): Number of recommendations to return, at most NEIGHBOURS_K. Defaults to NEIGHBOURS_K.
+
+    Response:
+    - input_media_url (string): URL of the saved media.
+    - return_type (string): Type of the recommendations, 'audio' or 'image'.
+    - urls (array): The recommendations, as in the /upload response.
+
+    Returns 400 for an id that is not a UUID, 404 for a media that is not in the catalogue.
+    """
+    document, error = find_recommendations(request.args, neighbour_store.get)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    return jsonify(document), 200
+
+
+def find_recommendations(args, get):
+    """
+    Validates a /recommendations request and builds its response with `get(url, point_id)`.
+
+    Returns:
+        tuple: The response, or None and the (message, status code) of the error.
+    """
+    url = args.get("url")
+    point_id = args.get("id")
+    if not url and not point_id:
+        return None, ("No url or id provided", 400)
+    if point_id:
+        # Qdrant rejects ids that are not UUIDs (or integers, which this app does not use)
+        try:
+            point_id = str(uuid.UUID(point_id))
+        except ValueError:
+            return None, ("Invalid id", 400)
+    try:
+        k = int(args.get("k", Config.NEIGHBOURS_K))
+    except ValueError:
+        return None, ("Invalid k", 400)
+    if not 1 <= k <= Config.NEIGHBOURS_K:
+        return None, (f"k must be between 1 and {Config.NEIGHBOURS_K}", 400)
+
+    with timed("neighbours.lookup"):
+        document = get(url, point_id)
+    if document is None:
+        return None, ("Media not found", 404)
+    return {
+        "input_media_url": document["url"],
+        "return_type": document["return_type"],
+        "urls": document["urls"][:k],
+    }, None
+
+
+def save_query(query):
+    """
+    Stores the outcome of the LLM stages of a request under a new "query_token".
+
+    Queries are kept in MongoDB, so any instance can serve the next pages, until the
+    TTL index drops them QUERY_TOKEN_TTL seconds later.
+    """
+    query["query_token"] = uuid.uuid4().hex
+    with timed("mongo.queries"):
+        mongo.db.queries.insert_one(query_document(query))
+    return query
+
+
+def load_query(token):
+    with timed("mongo.queries"):
+        return mongo.db.queries.find_one({"_id": token}, QUERY_PROJECTION)
+
+
+def query_document(query):
+    # created_at is read by the TTL index, which needs a date
+    return {**query, "_id": query["query_token"], "created_at": datetime.datetime.now(datetime.timezone.utc)}
+
+
+QUERY_PROJECTION = {"_id": 0, "created_at": 0}
+
+
+def add_analysis_stages(graph, report, media, text):
+    """
+    Adds the stages turning the input into its description and tags: "input_media_url",
+    "source" (the transcription or text) and "analysis".
+    """
+    if media is None:
+        media_type = "text"
+        graph.add("input_media_url", lambda: None)
+        graph.add("source", lambda: text)
+    else:
+        media_type = media.media_type
+
+        def upload():
+            # Upload the media to Firebase
+            input_media_url = upload_media(media)
+            report("upload", {"input_media_url": input_media_url})
+            return input_media_url
+
+        graph.add("input_media_url", upload)
+
+        if media_type == "audio":
+            # Transcription needs only the bytes, so it overlaps with the upload
+            def transcribe():
+                source = transcribe_audio(media.data, content_hash=media.content_hash)
+                report("transcription", {"transcription": source})
+                return source
+
+            graph.add("source", transcribe)
+        elif media_type == "image" and Config.PREPROCESS_MEDIA:
+            # The downscaled image is sent inline, so this too overlaps with the upload
+            def transcribe():
+                source = transcribe_image(media.data, content_hash=media.content_hash)
+                report("transcription", {"transcription": source})
+                return source
+
+            graph.add("source", transcribe)
+        elif media_type == "image":
+            # The vision model reads the image from its URL
+            def transcribe(input_media_url):
+                source = transcribe_image(input_media_url, content_hash=media.content_hash)
+                report("transcription", {"transcription": source})
+                return source
+
+            graph.add("source", transcribe, after=["input_media_url"])
+        else:
+            graph.add("source", lambda: media.data.decode("utf-8", errors="replace"))
+
+    def describe(source):
+        analysis = analyze(source, media_type)
+        logging.info(f"Description: {analysis['description']}")
+        report("description", {"description": analysis["description"]})
+        report(
+            "tags",
+            {"generic_description": analysis["generic_description"], "tags": analysis["tags"]},
+        )
+        return analysis
+
+    graph.add("analysis", describe, after=["source"])
+
+
+def run_upload(
+    report,
+    return_type,
+    media=None,
+    text=None,
+    query=None,
+    k=5,
+    offset=0,
+    min_score=None,
+):
+    """
+    Runs the recommendation pipeline of /upload and returns the response body.
+
+    `report(stage, data)` is called as each stage finishes, so that clients of the
+    async mode can follow the progress. When `query` holds the stored outcome of a
+    previous request, the LLM stages are skipped and only the search runs.
+
+    The stages run as a graph: the search starts as soon as the analysis is done,
+    while the input media may still be uploading.
+    """
+    graph = StageGraph(stage_executor)
+    inputs = {}
+    if query is None:
+        add_analysis_stages(graph, report, media, text)
+        graph.add(
+            "query",
+            lambda analysis, input_media_url: save_query(
+                {
+                    "generic_description": analysis["generic_description"],
+                    "tags": analysis["tags"],
+                    "input_media_url": input_media_url,
+                }
+            ),
+            after=["analysis", "input_media_url"],
+        )
+    else:
+        inputs = {"analysis": query, "query": query}
+
+    graph.add(
+        "points",
+        lambda analysis: search_vectorstore(
+            text=analysis["generic_description"],
+            type=return_type,
+            tags=analysis["tags"],
+            collection_name=os.getenv("QDRANT_INDEX_NAME"),
+            limit=k,
+            offset=offset,
+            score_threshold=min_score,
         ),
-    ).start()
-    return jsonify({}), 200
+        after=["analysis"],
+    )
+    graph.add("urls", hydrate_results, after=["points"])
+    results = graph.run(**inputs)
+
+    query = results["query"]
+    response = {
+        "return_type": return_type,
+        "urls": results["urls"],
+        "query_token": query["query_token"],
+    }
+    if query.get("input_media_url") is not None:
+        response["input_media_url"] = query["input_media_url"]
+
+    report("results", response)
+    return response
+
+
+upload_tracker = ProgressTracker(
+    workers=Config.UPLOAD_ASYNC_WORKERS,
+    max_pending=Config.UPLOAD_ASYNC_MAX_PENDING,
+    ttl=Config.UPLOAD_ASYNC_TTL,
+)
 
 
 @app.route("/upload", methods=["POST"])
@@ -175,6 +746,13 @@ def upload_file():
     - return_type (string): The desired return type. (Required)
       Allowed values: 'audio', 'image'
     - user_id (string): The user ID. (Required)
+    - query_token (string): Token returned by a previous request. Reuses its description and
+      tags, so only the vector search runs. (Instead of file or text)
+    - k (int): Number of recommendations to return. Defaults to 5.
+    - offset (int): Number of recommendations to skip, for pagination. Defaults to 0.
+    - min_score (float): Minimum similarity score of the returned recommendations.
+    - async (string): 'true' to return a request_id at once and run the pipeline in the
+      background. Progress is available on /upload/<request_id> and /upload/<request_id>/events.
 
     Response:
     - input_media_url (string): URL generated for the input media.
@@ -184,80 +762,274 @@ def upload_file():
       - artist_name (string): The name of the artist.
       - artist_email (string): The email of the artist.
       - artist_portfolio_url (string): The portfolio URL of the artist.
+      - score (float): Cosine similarity of the recommendation to the input.
+      - rank_score (float): With TAG_FILTER_MODE "should", the score the recommendations are
+        ordered by: the similarity plus a bonus for the query tags they carry.
+    - query_token (string): Token to request more pages of the same query.
+
+    Async Response (202):
+    - request_id (string): ID to poll or follow the request with.
+    """
+    pipeline_args, error = parse_upload_form(request.files, request.form)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    if request.form.get("async") == "true":
+        try:
+            request_id = upload_tracker.start(run_upload, **pipeline_args)
+        except TooManyTasksError:
+            response = jsonify({"error": "Too many pending requests, try again later"})
+            response.headers["Retry-After"] = str(Config.JOB_RETRY_AFTER)
+            return response, 429
+        return jsonify({"request_id": request_id}), 202
+
+    return jsonify(run_upload(lambda stage, data: None, **pipeline_args))
+
+
+def parse_upload_form(files, form, load=load_query):
+    """
+    Validates an /upload request and builds the arguments of run_upload.
+
+    Parameters:
+        load (callable): Returns the query stored under a token, or None.
+
+    Returns:
+        tuple: The arguments, or None and the (message, status code) of the error.
     """
-    file = request.files["file"]
-    text = request.form.get("text")
-    input_media_url = None
+    file = files.get("file")
+    text = form.get("text")
+    query_token = form.get("query_token")
 
-    if not file and not text:
-        return jsonify({"error": "No file or text provided"}), 400
+    if not file and not text and not query_token:
+        return None, ("No file or text provided", 400)
 
-    return_type = request.form.get("return_type")
+    return_type = form.get("return_type")
     if return_type not in ["audio", "image"]:
-        return jsonify({"error": "Invalid return type"}), 400
+        return None, ("Invalid return type", 400)
 
-    user_id = request.form.get("user_id")
+    user_id = form.get("user_id")
     if not user_id:
-        return jsonify({"error": "User ID is required"}), 400
+        return None, ("User ID is required", 400)
 
-    if file:
-        filename = secure_filename(file.filename)
-        local_file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(local_file_path)
+    search_args, error = parse_search_args(form)
+    if error:
+        return None, error
 
-        media_type = determine_media_type(local_file_path)
-        if not media_type:
-            return jsonify({"error": "Unsupported media type"}), 400
+    pipeline_args = {"return_type": return_type, "text": text, **search_args}
+    if query_token:
+        query = load(query_token)
+        if query is None:
+            return None, ("Unknown or expired query token", 404)
+        pipeline_args["query"] = query
+    elif file:
+        media = read_upload(file)
+        if not media.media_type:
+            return None, ("Unsupported media type", 400)
+        pipeline_args["media"] = media
+    return pipeline_args, None
 
-        # Upload the image to Firebase
-        input_media_url = firebase_handler.upload_to_firebase(filename, local_file_path)
 
-        if media_type == "audio":
-            transcription = transcribe_audio(local_file_path)
-            description = describe_audio(transcription)
-        elif media_type == "image":
-            transcription = transcribe_image(input_media_url)
-            description = describe_image(transcription)
-        else:
-            with open(local_file_path, "r") as file:
-                description = file.read()
-        # Clean up local file
-        firebase_handler.delete_local_file(local_file_path)
-    else:
-        description = text
+def parse_search_args(form):
+    """
+    Validates the k, offset and min_score parameters of a search.
+
+    Returns:
+        tuple: The arguments, or None and the (message, status code) of the error.
+    """
+    try:
+        k = int(form.get("k", 5))
+        offset = int(form.get("offset", 0))
+        min_score = form.get("min_score")
+        min_score = float(min_score) if min_score else None
+    except ValueError:
+        return None, ("Invalid k, offset or min_score", 400)
+    if not 1 <= k <= Config.MAX_RESULTS or offset < 0:
+        return None, (f"k must be between 1 and {Config.MAX_RESULTS}, offset must be positive", 400)
+    return {"k": k, "offset": offset, "min_score": min_score}, None
+
 
-    print(f"Description: {description}")
-    generic_description = get_generic_description(description)
-    tags = generate_tags(generic_description)
+batch_executor = ThreadPoolExecutor(max_workers=Config.BATCH_WORKERS)
 
-    result = search_vectorstore(
-        text=generic_description,
-        type=return_type,
-        tags=tags,
-        collection_name=os.getenv("QDRANT_INDEX_NAME"),
+
+def analyze_input(media=None, text=None):
+    """
+    Runs the analysis stages of /upload on one input and stores the outcome as a query.
+    """
+    graph = StageGraph(stage_executor)
+    add_analysis_stages(graph, lambda stage, data: None, media, text)
+    results = graph.run()
+    return save_query(
+        {
+            "generic_description": results["analysis"]["generic_description"],
+            "tags": results["analysis"]["tags"],
+            "input_media_url": results["input_media_url"],
+        }
     )
 
-    response_data = []
-    for i, _ in enumerate(result):
-        user = mongo.db.media.find_one({"url": result[i].payload["url"]})
-        response_data.append(
-            {
-                "url": result[i].payload["url"],
-                "artist_name": user.get('name'),
-                "artist_email": user.get('email'),
-                "artist_portfolio_url": user.get('portfolio_url'),
-                "title": user.get('title'),
-            }
-        )
 
-    response = {
-        "return_type": return_type,
-        "urls": response_data,
-    }
-    if input_media_url is not None:
-        response["input_media_url"] = input_media_url
+def run_upload_batch(items, return_types, k=5, offset=0, min_score=None):
+    """
+    Runs the /upload pipeline on several inputs and returns the response of /upload/batch.
+
+    The inputs are analyzed side by side, then every (input, return type) search runs in
+    one embedding batch and one Qdrant round-trip, and the artists of all results are
+    looked up in one MongoDB query. An input that fails is reported in its item.
+    """
+    futures = [
+        batch_executor.submit(contextvars.copy_context().run, analyze_input, item.get("media"), item.get("text"))
+        for item in items
+        if "error" not in item
+    ]
+    outcomes = []
+    for item in items:
+        if "error" in item:
+            outcomes.append(item["error"])
+            continue
+        try:
+            outcomes.append(futures.pop(0).result())
+        except Exception as e:
+            logging.error(f"Batch input failed: {e}")
+            outcomes.append(str(e))
+
+    queries = batch_queries(outcomes, return_types, k, offset, min_score)
+    points = search_vectorstore_batch(queries, os.getenv("QDRANT_INDEX_NAME")) if queries else []
+    urls = hydrate_results([point for hits in points for point in hits])
+    return batch_response(outcomes, return_types, points, urls)
+
+
+def batch_queries(outcomes, return_types, k, offset, min_score):
+    """
+    The searches of a batch: one per analyzed input and return type.
+    """
+    return [
+        (query["generic_description"], return_type, query["tags"], k, offset, min_score)
+        for query in outcomes
+        if isinstance(query, dict)
+        for return_type in return_types
+    ]
+
+
+def batch_response(outcomes, return_types, points, urls):
+    """
+    Splits the hydrated results of a batch back into its items; an outcome that is not a query is the error of its input.
+    """
+    hits = iter(points)
+    entries = iter(urls)
+    items = []
+    for index, query in enumerate(outcomes):
+        if not isinstance(query, dict):
+            items.append({"index": index, "error": query})
+            continue
+        item = {"index": index, "results": {}, "query_token": query["query_token"]}
+        if query.get("input_media_url") is not None:
+            item["input_media_url"] = query["input_media_url"]
+        for return_type in return_types:
+            item["results"][return_type] = [next(entries) for _ in next(hits)]
+        items.append(item)
+    failed = sum("error" in item for item in items)
+    return {"items": items, "succeeded": len(items) - failed, "failed": failed}
+
 
-    return jsonify(response)
+@app.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """
+    Recommendations for several inputs in one request, e.g. every item of a gallery.
+
+    Request Parameters:
+    - file (file): A media file; repeat the field for several files.
+    - text (string): An input string; repeat the field for several texts.
+      The items of the response are the files in order, then the texts. At most BATCH_MAX_ITEMS.
+    - return_type (string): 'audio' or 'image'; repeat the field to get both. (Required)
+    - user_id (string): The user ID. (Required)
+    - k, offset, min_score: As in /upload, for every search.
+
+    Response:
+    - items (array): One object per input, with its "index" and either
+      - results (object): The recommendations of each return type, as the "urls" of /upload.
+      - query_token (string): Token to request more pages of this input on /upload.
+      - input_media_url (string): URL generated for an input media.
+      or
+      - error (string): Why this input failed; the other inputs are not affected.
+    - succeeded (int): Number of inputs with results.
+    - failed (int): Number of inputs that failed.
+    """
+    batch_args, error = parse_batch_form(request.files, request.form)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    return jsonify(run_upload_batch(**batch_args))
+
+
+def parse_batch_form(files, form):
+    """
+    Validates an /upload/batch request and builds the arguments of run_upload_batch.
+    Inputs of an unsupported media type become failed items rather than failing the request.
+
+    Returns:
+        tuple: The arguments, or None and the (message, status code) of the error.
+    """
+    items = []
+    for file in files.getlist("file"):
+        media = read_upload(file)
+        items.append({"media": media} if media.media_type else {"error": "Unsupported media type"})
+    items += [{"text": text} for text in form.getlist("text") if text]
+
+    if not items:
+        return None, ("No file or text provided", 400)
+    if len(items) > Config.BATCH_MAX_ITEMS:
+        return None, (f"At most {Config.BATCH_MAX_ITEMS} files and texts per batch", 400)
+
+    return_types = list(dict.fromkeys(form.getlist("return_type")))
+    if not return_types or any(return_type not in ["audio", "image"] for return_type in return_types):
+        return None, ("Invalid return type", 400)
+
+    if not form.get("user_id"):
+        return None, ("User ID is required", 400)
+
+    search_args, error = parse_search_args(form)
+    if error:
+        return None, error
+    return {"items": items, "return_types": return_types, **search_args}, None
+
+
+@app.route("/upload/<request_id>", methods=["GET"])
+def upload_status(request_id):
+    """
+    Returns the progress of an async /upload request.
+
+    Response:
+    - id (string): The request ID.
+    - status (string): One of 'queued', 'running', 'done', 'failed'.
+    - stages (object): Output of every finished stage, keyed by stage name.
+    - result (object): The /upload response, once the request is done.
+    - error (string): The error, if the request failed.
+    """
+    task = upload_tracker.get(request_id)
+    if task is None:
+        return jsonify({"error": "Request not found"}), 404
+    return jsonify(task), 200
+
+
+@app.route("/upload/<request_id>/events", methods=["GET"])
+def upload_events(request_id):
+    """
+    Server-Sent Events stream of an async /upload request. Every finished stage
+    (upload, transcription, description, tags, results) is sent as an event named after the stage.
+    """
+    if upload_tracker.get(request_id) is None:
+        return jsonify({"error": "Request not found"}), 404
+
+    def stream():
+        for event in upload_tracker.follow(request_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event['stage']}\ndata: {json.dumps(event['data'])}\n\n"
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
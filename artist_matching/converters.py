@@ -1,49 +1,112 @@
-import requests
+import asyncio
 import json
-import time
 from pathlib import Path
 import os
-from huggingface_hub import InferenceClient
 import logging
 
-from kindo_api import KindoAPI
-
-def transcribe_audio(audio_path):
-    logging.info(f"Transcribing audio file: {audio_path}")
+from config import Config
+from clients import (
+    get_async_http_client,
+    get_async_inference_client,
+    get_async_kindo_api,
+    get_http_session,
+    get_inference_client,
+    get_kindo_api,
+)
+from artist_matching.stage_cache import cached, cached_stage, cached_stage_async, hash_bytes, hash_text
+from metrics import timed, timed_stage
+from resilience import RetryableError, get_endpoint
+from artist_matching.local_engine import get_local_engine
+from artist_matching.tag_centroids import centroid_tags
+from artist_matching.preprocessing import audio_excerpt, audio_variant, image_data_url, image_variant
+
+TEXT_MODEL = "azure/gpt-4o"
+VISION_MODEL = "meta-llama/Llama-3.2-11B-Vision-Instruct"
+
+# Bump the version of a stage whenever its prompt changes, so stale cache entries are not served
+PROMPT_VERSIONS = {
+    "transcribe_audio": 1,
+    "transcribe_image": 1,
+    "describe_audio": 1,
+    "describe_image": 1,
+    "get_generic_description": 1,
+    "generate_tags": 1,
+    "analyze": 1,
+}
+
+TAGS = ["Joy", "Sorrow", "Love", "Fear", "Hope", "Anger", "Longing", "Freedom", "Conflict", "Gratitude"]
+
+@timed_stage("transcribe_audio")
+def transcribe_audio(audio, content_hash=None):
+    """
+    Transcribes an audio file, given either its path or its content.
 
+    Uploads already held in memory are passed as bytes, with the hash computed
+    while they were read, so the audio is neither written to disk nor hashed twice.
+    Whisper is sent the excerpt made by preprocessing.audio_excerpt.
+    """
     api_url = os.getenv("WHISPER_API_ENDPOINT")
     headers = {"Authorization": f"Bearer {os.getenv('HUGGINGFACE_API_KEY')}"}
-    # Check if file exists
-    audio_file = Path(audio_path)
-    if not audio_file.exists():
-        raise FileNotFoundError(f"Audio file not found: {audio_path}")
 
-    # Read the audio file in binary mode
-    with open(audio_path, "rb") as file:
-        data = file.read()
-
-    # Make API request
-    response = requests.post(
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        logging.info(f"Transcribing {len(audio)} bytes of audio")
+        data = audio
+    else:
+        logging.info(f"Transcribing audio file: {audio}")
+        # Check if file exists
+        audio_file = Path(audio)
+        if not audio_file.exists():
+            raise FileNotFoundError(f"Audio file not found: {audio}")
+
+        # Read the audio file in binary mode
+        with open(audio, "rb") as file:
+            data = file.read()
+
+    return cached_stage(
+        "transcribe_audio",
         api_url,
-        headers=headers,
-        data=data
+        PROMPT_VERSIONS["transcribe_audio"],
+        _variant_key(content_hash or hash_bytes(data), audio_variant()),
+        lambda: _request_transcription(api_url, headers, audio_excerpt(data)),
     )
 
-    # Check if model is still loading
-    if response.status_code == 503:
-        estimated_time = json.loads(response.text).get("estimated_time", 20)
-        logging.info(f"Model is loading. Waiting for {estimated_time} seconds...")
-        time.sleep(estimated_time)
-        # Retry the request
-        response = requests.post(
+def _variant_key(content_hash, variant):
+    # Results of the originals keep their key from before preprocessing existed
+    return content_hash if variant == "original" else f"{content_hash}:{variant}"
+
+def _request_transcription(api_url, headers, data):
+    return get_endpoint("whisper").call(
+        lambda timeout: _post_transcription(api_url, headers, data, timeout)
+    )
+
+def _post_transcription(api_url, headers, data, timeout):
+    with timed("whisper", bytes_sent=len(data)) as span:
+        # Make API request
+        response = get_http_session().post(
             api_url,
             headers=headers,
-            data=data
+            data=data,
+            timeout=timeout,
         )
+        span.bytes_received = len(response.content)
+
+        _raise_if_loading(response)
+        # Handle other potential errors
+        response.raise_for_status()
 
-    # Handle other potential errors
-    response.raise_for_status()
+    return _read_transcription(response)
 
+def _raise_if_loading(response):
+    # A cold model answers 503 with the time it needs to load; the retry waits for it within the deadline
+    if response.status_code == 503:
+        try:
+            estimated_time = json.loads(response.text).get("estimated_time", 20)
+        except ValueError:
+            return
+        logging.info(f"Model is loading, ready in about {estimated_time} seconds")
+        raise RetryableError("Whisper model is loading", retry_after=estimated_time)
+
+def _read_transcription(response):
     response = response.json()
 
 
@@ -53,6 +116,8 @@ def transcribe_audio(audio_path):
     else:
         raise Exception("Transcription failed. No text found in response.")
 
+@timed_stage("describe_audio")
+@cached("describe_audio", TEXT_MODEL, PROMPT_VERSIONS["describe_audio"])
 def describe_audio(transcription):
     logging.info(f"Generating audio description for transcription: {transcription}")
 
@@ -62,10 +127,10 @@ def describe_audio(transcription):
     """
 
 
-    kindo = KindoAPI(os.getenv("KINDO_API_KEY"))
+    kindo = get_kindo_api()
 
     response = kindo.call_kindo_api(
-        model="azure/gpt-4o",
+        model=TEXT_MODEL,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=200,
     )
@@ -78,16 +143,68 @@ def describe_audio(transcription):
     except Exception as e:
         raise Exception(f"Failed to generate audio description: {e}")
     
-def transcribe_image(image_url):
-    logging.info(f"Generating image description for image: {image_url}")
+@timed_stage("transcribe_image")
+def transcribe_image(image, content_hash=None):
+    """
+    Describes an image, given either its URL or its content.
+
+    With PREPROCESS_MEDIA the vision model is sent a downscaled copy inline, and an image
+    given by URL is downloaded for it; otherwise the model reads the image from its URL.
+
+    `content_hash` is the hash of the image bytes when the caller has them. Without it
+    the cache is keyed on the URL, which is only safe for URLs that never change content.
+    """
+    if content_hash is None:
+        content_hash = hash_text(image) if isinstance(image, str) else hash_bytes(image)
+    return cached_stage(
+        "transcribe_image",
+        VISION_MODEL,
+        PROMPT_VERSIONS["transcribe_image"],
+        _variant_key(content_hash, image_variant()),
+        lambda: _transcribe_image(_vision_image_url(image)),
+    )
+
+def _vision_image_url(image):
+    if isinstance(image, str):
+        if not Config.PREPROCESS_MEDIA:
+            return image
+        image = _download_image(image)
+    return image_data_url(image)
+
+def _download_image(url):
+    with timed("firebase.download") as span:
+        response = get_http_session().get(url, timeout=Config.OUTBOUND_TIMEOUTS["vision"][0])
+        response.raise_for_status()
+        span.bytes_received = len(response.content)
+    return response.content
+
+def _transcribe_image(image_url):
+    logging.info(f"Generating image description for image: {image_url[:100]}")
+
+    client = get_inference_client()
 
-    client = InferenceClient(api_key=os.getenv("HUGGINGFACE_API_KEY"))
+    def request(timeout):
+        # The client enforces its own timeout, set to the one of the "vision" endpoint
+        with timed("vision"):
+            return client.chat.completions.create(
+                model=VISION_MODEL,
+                messages=_vision_messages(image_url),
+                max_tokens=500,
+            )
 
+    response = get_endpoint("vision").call(request)
+
+    description = response.choices[0].message.content
+
+    logging.info(f"Image Description generated: {description}")
+    return description
+
+def _vision_messages(image_url):
     prompt = """
     Describe this image with as much details as possible. Mention the objects, people, animals, and any other relevant information in the image. The description should be detailed and informative.
     """ 
 
-    messages = [
+    return [
         {
             "role": "user",
             "content": [
@@ -105,17 +222,8 @@ def transcribe_image(image_url):
         }
     ]
 
-    response = client.chat.completions.create(
-        model="meta-llama/Llama-3.2-11B-Vision-Instruct", 
-        messages=messages, 
-        max_tokens=500,
-    )
-
-    description = response.choices[0].message.content
-
-    logging.info(f"Image Description generated: {description}")
-    return description
-
+@timed_stage("describe_image")
+@cached("describe_image", TEXT_MODEL, PROMPT_VERSIONS["describe_image"])
 def describe_image(description):
     logging.info(f"Generating detailed description for image: {description}")
 
@@ -124,10 +232,10 @@ def describe_image(description):
     Description: {description}
     """
 
-    kindo = KindoAPI(os.getenv("KINDO_API_KEY"))
+    kindo = get_kindo_api()
 
     response = kindo.call_kindo_api(
-        model="azure/gpt-4o",
+        model=TEXT_MODEL,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=200,
     )
@@ -140,6 +248,8 @@ def describe_image(description):
     except Exception as e:
         raise Exception(f"Failed to generate detailed description: {e}")
     
+@timed_stage("get_generic_description")
+@cached("get_generic_description", TEXT_MODEL, PROMPT_VERSIONS["get_generic_description"])
 def get_generic_description(description):
     logging.info(f"Generating generic description for text: {description}")
 
@@ -148,10 +258,10 @@ def get_generic_description(description):
     Description: {description}
     """
 
-    kindo = KindoAPI(os.getenv("KINDO_API_KEY"))
+    kindo = get_kindo_api()
 
     response = kindo.call_kindo_api(
-        model="azure/gpt-4o",
+        model=TEXT_MODEL,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=200,
     )
@@ -164,16 +274,46 @@ def get_generic_description(description):
     except Exception as e:
         raise Exception(f"Failed to generate generic description: {e}")
     
+@timed_stage("generate_tags")
 def generate_tags(generic_description):
+    tags = engine_tags(generic_description)
+    if tags is not None:
+        return tags
+    return _generate_tags_llm(generic_description)
+
+def engine_tags(generic_description):
+    """
+    Picks the tags of a description with the TAGGING_ENGINE, or returns None when the LLM should pick them.
+    """
+    if Config.TAGGING_ENGINE == "local":
+        return local_tags(generic_description)
+    if Config.TAGGING_ENGINE == "centroid":
+        with timed("tagging.centroid"):
+            tags = centroid_tags([generic_description], TAGS)
+        # Until the first refresh there are no centroids; keep the LLM tags meanwhile
+        return tags[0] if tags is not None else None
+    return None
+
+def local_tags(generic_description):
+    """
+    Picks the tags of a description with the CPU classifier of the local engine, without any network call.
+    """
+    with timed("tagging.local"):
+        return get_local_engine().classify(
+            [generic_description], TAGS, Config.LOCAL_TAG_THRESHOLD, Config.LOCAL_TAG_TOP_K
+        )[0]
+
+@cached("generate_tags", TEXT_MODEL, PROMPT_VERSIONS["generate_tags"])
+def _generate_tags_llm(generic_description):
     prompt = f"""
     You are given a description. Your task is to pick the relevant tags based on the description. The tags should be concise and descriptive, capturing the key elements of the description. These tags will help in  categorizing and organizing the content for future reference. The possible tags are Joy, Sorrow, Love, Fear, Hope, Anger, Longing, Freedom, Conflict and Gratitude. The tags must be from this list only. Provide a comma separated list of tags that you think fit with the description. The output should contain nothing but the comma separated tags.
     Description: {generic_description}
     """
 
-    kindo = KindoAPI(os.getenv("KINDO_API_KEY"))
+    kindo = get_kindo_api()
 
     response = kindo.call_kindo_api(
-        model="azure/gpt-4o",
+        model=TEXT_MODEL,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=200,
     )
@@ -185,3 +325,222 @@ def generate_tags(generic_description):
         return [x.strip() for x in tags.split(",")]
     except Exception as e:
         raise Exception(f"Failed to generate tags: {e}")
+
+ANALYSIS_INPUTS = {
+    "audio": ("a transcription of a song clip", "Try to understand what the song is about, what emotions it conveys, and what message it is trying to communicate."),
+    "image": ("a description of an image", "Capture the possible emotions, themes and story behind the image."),
+    "text": ("a text description. It could be about a music sample, an image or a movie plot", "Keep the meaning of the original text."),
+}
+
+@timed_stage("analyze")
+def analyze(source, media_type):
+    """
+    Generates the detailed description, generic description and tags of a media in a single call.
+
+    `source` is the transcription of an audio clip, the transcription of an image, or the
+    input text. When the model output does not match the expected schema, this falls back
+    to describe_*, get_generic_description and generate_tags. With the local or centroid
+    tagging engine, the tags come from engine_tags rather than from the model.
+
+    Returns:
+        dict: "description", "generic_description" and "tags" of the media.
+    """
+    if not Config.FUSED_ANALYSIS:
+        return _analyze_separately(source, media_type)
+
+    analysis = cached_stage(
+        f"analyze_{media_type}",
+        TEXT_MODEL,
+        PROMPT_VERSIONS["analyze"],
+        hash_text(source),
+        lambda: _analyze(source, media_type),
+    )
+    tags = engine_tags(analysis["generic_description"])
+    if tags is not None:
+        analysis["tags"] = tags
+    return analysis
+
+def _analyze(source, media_type):
+    logging.info(f"Generating analysis for {media_type}: {source}")
+
+    kindo = get_kindo_api()
+
+    response = kindo.call_kindo_api(
+        model=TEXT_MODEL,
+        messages=[{"role": "user", "content": _analysis_prompt(source, media_type)}],
+        max_tokens=600,
+        response_format={"type": "json_object"},
+    )
+
+    try:
+        analysis = _read_analysis(response, source, media_type)
+    except Exception as e:
+        logging.warning(f"Malformed analysis, falling back to separate calls: {e}")
+        return _analyze_separately(source, media_type)
+    return analysis
+
+def _analysis_prompt(source, media_type):
+    kind, guidance = ANALYSIS_INPUTS[media_type]
+    return f"""
+    You are given {kind}. Respond with a JSON object with exactly these keys:
+    - "description": a brief description based on the given input, not more than 100 words. {guidance}
+    - "generic_description": a concise and informative description that captures the essence of "description". It should not contain any reference to what type of media the original description was about.
+    - "tags": a list of the tags that fit "generic_description". The possible tags are {", ".join(TAGS)}. The tags must be from this list only.
+    Input: {source}
+    """
+
+def _read_analysis(response, source, media_type):
+    analysis = _parse_analysis(response.json()['choices'][0]['message']['content'])
+    if media_type == "text":
+        analysis["description"] = source
+
+    logging.info(f"Analysis generated: {analysis}")
+    return analysis
+
+def _analyze_separately(source, media_type):
+    if media_type == "audio":
+        description = describe_audio(source)
+    elif media_type == "image":
+        description = describe_image(source)
+    else:
+        description = source
+    generic_description = get_generic_description(description)
+    return {
+        "description": description,
+        "generic_description": generic_description,
+        "tags": generate_tags(generic_description),
+    }
+
+def _parse_analysis(content):
+    analysis = json.loads(content)
+    if not isinstance(analysis, dict):
+        raise ValueError("Analysis is not a JSON object")
+
+    for key in ["description", "generic_description"]:
+        if not isinstance(analysis.get(key), str) or not analysis[key].strip():
+            raise ValueError(f"Missing or empty '{key}'")
+
+    tags = analysis.get("tags")
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise ValueError("'tags' is not a list of strings")
+
+    allowed = {tag.lower(): tag for tag in TAGS}
+    unknown = [tag for tag in tags if tag.strip().lower() not in allowed]
+    if unknown or not tags:
+        raise ValueError(f"Tags outside of the allowed list: {unknown}")
+
+    return {
+        "description": analysis["description"].strip(),
+        "generic_description": analysis["generic_description"].strip(),
+        "tags": [allowed[tag.strip().lower()] for tag in tags],
+    }
+
+# Async variants used by the async serving mode (asgi.py). They share the prompts,
+# caches and parsing of the functions above, and only differ in how they wait.
+
+@timed_stage("transcribe_audio")
+async def transcribe_audio_async(data, content_hash=None):
+    api_url = os.getenv("WHISPER_API_ENDPOINT")
+    headers = {"Authorization": f"Bearer {os.getenv('HUGGINGFACE_API_KEY')}"}
+    logging.info(f"Transcribing {len(data)} bytes of audio")
+
+    return await cached_stage_async(
+        "transcribe_audio",
+        api_url,
+        PROMPT_VERSIONS["transcribe_audio"],
+        _variant_key(content_hash or hash_bytes(data), audio_variant()),
+        lambda: _request_transcription_async(api_url, headers, data),
+    )
+
+async def _request_transcription_async(api_url, headers, data):
+    # ffmpeg or NumPy work; keep it off the event loop
+    data = await asyncio.to_thread(audio_excerpt, data)
+    return await get_endpoint("whisper").call_async(
+        lambda timeout: _post_transcription_async(api_url, headers, data, timeout)
+    )
+
+async def _post_transcription_async(api_url, headers, data, timeout):
+    with timed("whisper", bytes_sent=len(data)) as span:
+        response = await get_async_http_client().post(api_url, headers=headers, content=data, timeout=timeout)
+        span.bytes_received = len(response.content)
+
+        _raise_if_loading(response)
+        response.raise_for_status()
+
+    return _read_transcription(response)
+
+@timed_stage("transcribe_image")
+async def transcribe_image_async(image, content_hash=None):
+    if content_hash is None:
+        content_hash = hash_text(image) if isinstance(image, str) else hash_bytes(image)
+    return await cached_stage_async(
+        "transcribe_image",
+        VISION_MODEL,
+        PROMPT_VERSIONS["transcribe_image"],
+        _variant_key(content_hash, image_variant()),
+        lambda: _transcribe_image_async(image),
+    )
+
+async def _vision_image_url_async(image):
+    if isinstance(image, str):
+        if not Config.PREPROCESS_MEDIA:
+            return image
+        with timed("firebase.download") as span:
+            response = await get_async_http_client().get(image, timeout=Config.OUTBOUND_TIMEOUTS["vision"][0])
+            response.raise_for_status()
+            span.bytes_received = len(response.content)
+        image = response.content
+    return await asyncio.to_thread(image_data_url, image)
+
+async def _transcribe_image_async(image):
+    image_url = await _vision_image_url_async(image)
+    logging.info(f"Generating image description for image: {image_url[:100]}")
+
+    async def request(timeout):
+        with timed("vision"):
+            return await get_async_inference_client().chat.completions.create(
+                model=VISION_MODEL,
+                messages=_vision_messages(image_url),
+                max_tokens=500,
+            )
+
+    response = await get_endpoint("vision").call_async(request)
+
+    description = response.choices[0].message.content
+
+    logging.info(f"Image Description generated: {description}")
+    return description
+
+@timed_stage("analyze")
+async def analyze_async(source, media_type):
+    if not Config.FUSED_ANALYSIS:
+        return await asyncio.to_thread(_analyze_separately, source, media_type)
+
+    analysis = await cached_stage_async(
+        f"analyze_{media_type}",
+        TEXT_MODEL,
+        PROMPT_VERSIONS["analyze"],
+        hash_text(source),
+        lambda: _analyze_async(source, media_type),
+    )
+    tags = await asyncio.to_thread(engine_tags, analysis["generic_description"])
+    if tags is not None:
+        analysis["tags"] = tags
+    return analysis
+
+async def _analyze_async(source, media_type):
+    logging.info(f"Generating analysis for {media_type}: {source}")
+
+    response = await get_async_kindo_api().call_kindo_api(
+        model=TEXT_MODEL,
+        messages=[{"role": "user", "content": _analysis_prompt(source, media_type)}],
+        max_tokens=600,
+        response_format={"type": "json_object"},
+    )
+
+    try:
+        return _read_analysis(response, source, media_type)
+    except Exception as e:
+        # The fallback is rare; it keeps its blocking calls off the event loop
+        logging.warning(f"Malformed analysis, falling back to separate calls: {e}")
+        return await asyncio.to_thread(_analyze_separately, source, media_type)
@@ -0,0 +1,151 @@
+"""
+Duplicate detection for saved media.
+
+Every saved media is indexed in MongoDB by the SHA-256 of its content, which catches
+byte-identical files, and by a 64-bit perceptual hash, which also finds re-encoded,
+resized or re-compressed copies:
+- images: a difference hash (dHash) of the 9x8 grayscale thumbnail.
+- audio: the signs of the changes over time of the energy differences between
+  neighbouring frequency bands, over the first FINGERPRINT_SECONDS.
+
+Only byte-identical files are skipped by /save. A perceptual match may be another
+artist's similar work, so it is only reported, as the near duplicate of the saved media.
+
+Two perceptual hashes match when they differ by at most DEDUP_MAX_DISTANCE bits. The
+hash is split into HASH_BANDS bands: hashes fewer than HASH_BANDS bits apart share at
+least one band, so candidates are found by an exact lookup on the bands.
+"""
+import io
+import logging
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from config import Config
+from metrics import timed
+from artist_matching.preprocessing import decode_audio
+
+HASH_BITS = 64
+# The fingerprint format is fixed rather than read from the tuning knobs of preprocessing:
+# stored hashes are only comparable with hashes computed the same way. Bump
+# FINGERPRINT_VERSION when changing any of these; lookups ignore hashes of other versions.
+FINGERPRINT_VERSION = 1
+FINGERPRINT_SAMPLE_RATE = 16000
+FINGERPRINT_SECONDS = 30
+# 4 bands of 16 bits, so DEDUP_MAX_DISTANCE can be at most 3
+HASH_BANDS = 4
+
+# Band edges of the audio fingerprint in Hz, log-spaced over the range where most of
+# the melody and voice energy is
+AUDIO_BAND_EDGES = np.geomspace(300, 3000, 10)
+
+
+def perceptual_hash(media_type, data):
+    """
+    Returns the perceptual hash of a media as 16 hex digits, or None when it cannot be computed.
+    """
+    try:
+        with timed(f"dedup.hash_{media_type}"):
+            if media_type == "image":
+                bits = _image_bits(data)
+            elif media_type == "audio":
+                bits = _audio_bits(data)
+            else:
+                return None
+    except Exception as e:
+        logging.warning(f"No perceptual hash for this {media_type}: {e}")
+        return None
+    if bits is None:
+        return None
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}"
+
+
+def _image_bits(data):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+
+def _audio_bits(data):
+    samples = decode_audio(data, FINGERPRINT_SAMPLE_RATE, FINGERPRINT_SECONDS)
+    rate = FINGERPRINT_SAMPLE_RATE
+    frame = 2048
+    if len(samples) < 9 * frame or not np.any(samples):
+        # Too short or silent to say anything about the content
+        return None
+
+    frames = samples[: len(samples) // frame * frame].reshape(-1, frame)
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame), axis=1)) ** 2
+    frequencies = np.fft.rfftfreq(frame, 1 / rate)
+    bands = np.stack(
+        [
+            spectrum[:, (frequencies >= low) & (frequencies < high)].sum(axis=1)
+            for low, high in zip(AUDIO_BAND_EDGES[:-1], AUDIO_BAND_EDGES[1:])
+        ],
+        axis=1,
+    )
+
+    # 9 segments of 9 bands; the logarithm makes the hash insensitive to the volume
+    segments = np.stack([segment.mean(axis=0) for segment in np.array_split(bands, 9)])
+    energy = np.log(segments + 1e-9)
+    band_differences = energy[:, 1:] - energy[:, :-1]
+    return (band_differences[1:] > band_differences[:-1]).flatten()
+
+
+def hamming(first, second):
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+
+def max_distance():
+    # Farther hashes may share no band, so they could not be found
+    return min(Config.DEDUP_MAX_DISTANCE, HASH_BANDS - 1)
+
+
+def hash_bands(phash):
+    """
+    Splits a perceptual hash into HASH_BANDS bands, prefixed by their position.
+    """
+    bits = f"{int(phash, 16):0{HASH_BITS}b}"
+    width = HASH_BITS // HASH_BANDS
+    return [f"{i}:{bits[i * width : (i + 1) * width]}" for i in range(HASH_BANDS)]
+
+
+def dedup_fields(media_type, content_hash, phash):
+    """
+    Fields indexed on the MongoDB document of a saved media.
+    """
+    fields = {"type": media_type, "content_hash": content_hash}
+    if phash is not None:
+        fields["perceptual_hash"] = phash
+        fields["phash_version"] = FINGERPRINT_VERSION
+        fields["phash_bands"] = hash_bands(phash)
+    return fields
+
+
+def duplicate_query(content_hash):
+    """
+    MongoDB filter matching the saved media with the same content.
+    """
+    return {"content_hash": content_hash}
+
+
+def near_duplicate_query(media_type, phash):
+    """
+    MongoDB filter matching the candidate near duplicates of a media.
+    """
+    return {"type": media_type, "phash_version": FINGERPRINT_VERSION, "phash_bands": {"$in": hash_bands(phash)}}
+
+
+def closest_match(candidates, phash):
+    """
+    Returns the candidate whose perceptual hash is closest to `phash`, within max_distance(), or None.
+    """
+    closest = None
+    for candidate in candidates:
+        other = candidate.get("perceptual_hash")
+        if other is None:
+            continue
+        distance = hamming(phash, other)
+        if distance <= max_distance() and (closest is None or distance < closest[0]):
+            closest = (distance, candidate)
+    return closest[1] if closest else None
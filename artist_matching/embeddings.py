@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import queue
+import threading
+import time
+import unicodedata
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from clients import get_embed_model
+from config import Config
+from metrics import timed, timed_stage
+from artist_matching.local_engine import get_local_engine
+
+# The local engine's vectors are smaller, and stored in a collection of their own
+EMBEDDING_DIM = Config.LOCAL_EMBEDDING_DIM if Config.EMBEDDING_ENGINE == "local" else 1536
+
+
+def normalize_text(text):
+    # Whitespace and unicode form do not change the meaning of a query, so they should not miss the cache
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+
+class VectorCache:
+    """
+    LRU of embeddings kept as rows of a single float32 matrix.
+
+    A Python list of 1536 floats costs ~50KB; a float32 row costs 6KB. The
+    matrix grows by doubling until it reaches `capacity` rows, after which the
+    least recently used row is overwritten.
+    """
+
+    def __init__(self, capacity, dim=EMBEDDING_DIM):
+        self.capacity = capacity
+        self.dim = dim
+        self._matrix = np.empty((min(capacity, 256), dim), dtype=np.float32)
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._rows.move_to_end(key)
+            return self._matrix[row].copy()
+
+    def set(self, key, vector):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            if key in self._rows:
+                row = self._rows[key]
+                self._rows.move_to_end(key)
+            elif len(self._rows) < self.capacity:
+                row = len(self._rows)
+                if row >= len(self._matrix):
+                    self._grow()
+                self._rows[key] = row
+            else:
+                _, row = self._rows.popitem(last=False)
+                self._rows[key] = row
+            self._matrix[row] = vector
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._rows),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes": self._matrix.nbytes,
+            }
+
+    def _grow(self):
+        size = min(len(self._matrix) * 2, self.capacity)
+        matrix = np.empty((size, self.dim), dtype=np.float32)
+        matrix[: len(self._matrix)] = self._matrix
+        self._matrix = matrix
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding requests from concurrent request threads and sends them
+    as one `get_text_embedding_batch` call.
+
+    A batch is flushed when it reaches `max_batch` texts or when the oldest
+    request has waited `max_wait` seconds, whichever comes first.
+    """
+
+    def __init__(self, max_batch, max_wait):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        # Threads racing on the same popular query share one slot in the batch
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = _request_embeddings(texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        logging.info(f"Embedded batch of {len(texts)} texts")
+        rows = {text: vector for text, vector in zip(texts, vectors)}
+        for text, future in batch:
+            future.set_result(rows[text])
+
+
+def _request_embeddings(texts):
+    if Config.EMBEDDING_ENGINE == "local":
+        with timed("embedding.local"):
+            vectors = get_local_engine().embed(texts)
+    else:
+        with timed("embedding"):
+            vectors = np.asarray(get_embed_model().get_text_embedding_batch(texts), dtype=np.float32)
+    if vectors.shape != (len(texts), EMBEDDING_DIM):
+        raise ValueError(f"Unexpected embedding shape: {vectors.shape}")
+    return vectors
+
+
+_cache = VectorCache(Config.EMBEDDING_CACHE_SIZE)
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def _get_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = EmbeddingBatcher(
+                max_batch=Config.EMBEDDING_BATCH_SIZE,
+                max_wait=Config.EMBEDDING_BATCH_WAIT_MS / 1000,
+            )
+        return _batcher
+
+
+def _lookup(texts):
+    """
+    Serves the cached rows of `texts`; returns the array of vectors and the missing
+    texts, as a dict from cache key to the rows it fills.
+    """
+    keys = [text_key(text) for text in texts]
+    vectors = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+
+    # Only one request per distinct missing text, even if it repeats within the list
+    missing = {}
+    for i, key in enumerate(keys):
+        vector = _cache.get(key)
+        if vector is None:
+            missing.setdefault(key, []).append(i)
+        else:
+            vectors[i] = vector
+    return vectors, missing
+
+
+def _fill(vectors, missing, fetched):
+    for (key, rows), vector in zip(missing.items(), fetched):
+        _cache.set(key, vector)
+        vectors[rows] = vector
+    return vectors
+
+
+@timed_stage("embed_texts")
+def embed_texts(texts):
+    """
+    Embeds a list of texts, serving repeated texts from the vector cache.
+
+    Returns:
+        np.ndarray: float32 array of shape (len(texts), EMBEDDING_DIM).
+    """
+    vectors, missing = _lookup(texts)
+    if not missing:
+        return vectors
+
+    miss_texts = [normalize_text(texts[rows[0]]) for rows in missing.values()]
+    if Config.EMBEDDING_BATCH_WAIT_MS > 0:
+        batcher = _get_batcher()
+        futures = [batcher.submit(text) for text in miss_texts]
+        fetched = [future.result() for future in futures]
+    else:
+        fetched = _request_embeddings(miss_texts)
+    return _fill(vectors, missing, fetched)
+
+
+@timed_stage("embed_texts")
+async def embed_texts_async(texts):
+    """
+    Same as embed_texts, awaiting the batcher instead of blocking the event loop.
+    """
+    vectors, missing = _lookup(texts)
+    if not missing:
+        return vectors
+
+    miss_texts = [normalize_text(texts[rows[0]]) for rows in missing.values()]
+    if Config.EMBEDDING_BATCH_WAIT_MS > 0:
+        batcher = _get_batcher()
+        fetched = await asyncio.gather(*(asyncio.wrap_future(batcher.submit(text)) for text in miss_texts))
+    else:
+        fetched = await asyncio.to_thread(_request_embeddings, miss_texts)
+    return _fill(vectors, missing, fetched)
+
+
+def embed_text(text):
+    return embed_texts([text])[0]
+
+
+async def embed_text_async(text):
+    return (await embed_texts_async([text]))[0]
+
+
+def embedding_cache_stats():
+    return _cache.stats()
@@ -0,0 +1,176 @@
+"""
+CPU-only embedding and tagging, used instead of the OpenAI embeddings and the
+generate_tags LLM call when EMBEDDING_ENGINE / TAGGING_ENGINE are set to "local".
+
+The engine runs a small sentence-embedding model exported to ONNX, e.g.
+sentence-transformers/all-MiniLM-L6-v2, from LOCAL_MODEL_DIR:
+    model.onnx       the transformer, taking input_ids and attention_mask
+    tokenizer.json   its Hugging Face tokenizer
+    tag_head.npz     optional linear tag classifier: "weights" (dim, len(TAGS)) and "bias"
+
+Without tag_head.npz, tags are picked zero-shot by cosine similarity to an
+embedded description of each tag.
+
+Local vectors have another dimension than the OpenAI ones, so they live in their
+own collection, QDRANT_INDEX_NAME + "_local". Fill it from the main collection with:
+    python -m artist_matching.local_engine --backfill
+"""
+import argparse
+import logging
+import os
+import threading
+
+import numpy as np
+from qdrant_client.http import models
+
+from clients import get_qdrant_client, registry
+from config import Config
+
+TAG_PROMPT = "A piece of art that expresses {tag}."
+LOCAL_COLLECTION_SUFFIX = "_local"
+
+
+class LocalEngine:
+    def __init__(self, model_dir, threads, max_length=256):
+        """
+        Parameters:
+            model_dir (str): Directory holding model.onnx, tokenizer.json and optionally tag_head.npz.
+            threads (int): CPU threads used by ONNX Runtime for one batch.
+            max_length (int): Tokens kept per text.
+        """
+        # Optional dependencies, only needed when the local engine is selected
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("The local engine needs onnxruntime and tokenizers: pip install onnxruntime tokenizers") from e
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        head_path = os.path.join(model_dir, "tag_head.npz")
+        self.tag_head = dict(np.load(head_path)) if os.path.exists(head_path) else None
+        self._tag_vectors = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts):
+        """
+        Embeds a batch of texts.
+
+        Returns:
+            np.ndarray: float32 array of shape (len(texts), dim), rows of unit length.
+        """
+        encodings = self.tokenizer.encode_batch(list(texts))
+        feed = {
+            "input_ids": np.asarray([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.asarray([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.asarray([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        output = self.session.run(None, {name: value for name, value in feed.items() if name in self.input_names})[0]
+
+        if output.ndim == 3:
+            # Mean of the token vectors, ignoring padding
+            mask = feed["attention_mask"][:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+        vectors = output.astype(np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def tag_scores(self, texts, tags):
+        """
+        Scores every tag for every text: sigmoid probabilities of the linear head when there
+        is one, cosine similarities to the tag descriptions otherwise.
+
+        Returns:
+            np.ndarray: float32 array of shape (len(texts), len(tags)).
+        """
+        vectors = self.embed(texts)
+        if self.tag_head is not None:
+            logits = vectors @ self.tag_head["weights"] + self.tag_head["bias"]
+            return 1 / (1 + np.exp(-logits))
+        return vectors @ self._tag_matrix(tags).T
+
+    def classify(self, texts, tags, threshold, top_k):
+        """
+        Picks the tags of each text: the tags scoring at least `threshold`, at most `top_k`
+        of them, and at least the best one.
+        """
+        scores = self.tag_scores(texts, tags)
+        picked = []
+        for row in scores:
+            order = np.argsort(-row)[:top_k]
+            chosen = [tags[i] for i in order if row[i] >= threshold]
+            picked.append(chosen or [tags[order[0]]])
+        return picked
+
+    def _tag_matrix(self, tags):
+        with self._lock:
+            if self._tag_vectors is None:
+                self._tag_vectors = self.embed([TAG_PROMPT.format(tag=tag.lower()) for tag in tags])
+            return self._tag_vectors
+
+
+def get_local_engine():
+    return registry.get(
+        "local_engine",
+        lambda: LocalEngine(Config.LOCAL_MODEL_DIR, threads=Config.LOCAL_ENGINE_THREADS),
+    )
+
+
+def backfill(source_collection, batch_size=256):
+    """
+    Copies every point of `source_collection` into its local-engine collection, re-embedding
+    the stored texts with the local model. Points keep their id and payload.
+    """
+    # qdrant_handler imports this module through embeddings
+    from artist_matching.qdrant_handler import create_collection_if_not_exists
+
+    qdrant_client = get_qdrant_client()
+    target_collection = source_collection + LOCAL_COLLECTION_SUFFIX
+    create_collection_if_not_exists(qdrant_client, target_collection, size=Config.LOCAL_EMBEDDING_DIM)
+
+    engine = get_local_engine()
+    copied = 0
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=source_collection, limit=batch_size, offset=offset, with_payload=True
+        )
+        if points:
+            vectors = engine.embed([point.payload["text"] for point in points])
+            qdrant_client.upsert(
+                collection_name=target_collection,
+                points=[
+                    models.PointStruct(id=point.id, vector=vector.tolist(), payload=point.payload)
+                    for point, vector in zip(points, vectors)
+                ],
+            )
+            copied += len(points)
+            logging.info(f"Backfilled {copied} points into {target_collection}")
+        if offset is None:
+            return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local embedding engine utilities")
+    parser.add_argument("--backfill", action="store_true", help="Re-embed the main collection into the local one")
+    parser.add_argument("--collection", default=os.getenv("QDRANT_INDEX_NAME"))
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.backfill:
+        print(f"Backfilled {backfill(args.collection, args.batch_size)} points")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+In-process copy of a Qdrant collection, searched without a network round-trip when
+VECTOR_BACKEND is "local".
+
+Qdrant stays the store of record: writes go to Qdrant, and each worker keeps its own
+index, synced from the collection every LOCAL_INDEX_SYNC_INTERVAL seconds. Points are
+pulled incrementally through their "ingested_at" payload field; points stored before
+that field existed are only pulled by a full sync (a new index, or --rebuild).
+
+The vectors of each media type form one float32 matrix, so a search is a single
+matrix-vector product over the partition of the requested type, with the tags filtered
+through one boolean column per tag. Partitions of at least LOCAL_INDEX_HNSW_MIN_POINTS
+points are searched through an HNSW graph instead, when hnswlib is installed.
+
+The index is snapshotted to LOCAL_INDEX_DIR after every sync that changed it, and a
+restarted worker memory-maps the snapshot instead of pulling the collection again.
+Build or refresh a snapshot ahead of a deploy with:
+    python -m artist_matching.local_index --sync
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from qdrant_client.http import models
+
+from clients import get_qdrant_client, registry
+from config import Config
+from metrics import timed
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Seconds subtracted from the sync cursor, for points written while the previous sync ran
+SYNC_MARGIN = 60
+
+
+class Partition:
+    """
+    The points of one media type. Rows are appended into buffers with spare capacity,
+    so a search reading the first `size` rows never sees a half-written point.
+    """
+
+    def __init__(self, vectors, ids, payloads, tag_names):
+        self.vectors = vectors
+        self.size = len(ids)
+        self.ids = list(ids)
+        self.payloads = list(payloads)
+        self.rows = {point_id: row for row, point_id in enumerate(self.ids)}
+        self.tag_names = list(tag_names)
+        self.tag_columns = {tag: column for column, tag in enumerate(self.tag_names)}
+        self.tag_bits = np.zeros((len(self.ids), len(self.tag_names)), dtype=bool)
+        for row, payload in enumerate(self.payloads):
+            self._set_tags(row, payload)
+        self.hnsw = None
+
+    def upsert(self, ids, vectors, payloads):
+        """
+        Adds or replaces points. Must be called under the index lock.
+        """
+        new = [i for i, point_id in enumerate(ids) if point_id not in self.rows]
+        self._reserve(self.size + len(new))
+        if not self.vectors.flags.writeable:
+            # Still the memory-mapped snapshot; copy it before the first write
+            self.vectors = np.array(self.vectors)
+
+        for i, point_id in enumerate(ids):
+            row = self.rows.get(point_id)
+            if row is None:
+                row = len(self.ids)
+                self.ids.append(point_id)
+                self.payloads.append(payloads[i])
+                self.rows[point_id] = row
+            else:
+                self.payloads[row] = payloads[i]
+                self.tag_bits[row] = False
+            self.vectors[row] = vectors[i]
+            self._set_tags(row, payloads[i])
+
+        if self.hnsw is not None:
+            if self.hnsw.get_max_elements() < len(self.ids):
+                self.hnsw.resize_index(self.vectors.shape[0])
+            self.hnsw.add_items(vectors, [self.rows[point_id] for point_id in ids])
+        # Published last: searches only read rows below size
+        self.size = len(self.ids)
+
+    def _reserve(self, size):
+        capacity = self.vectors.shape[0]
+        if size > capacity:
+            capacity = max(size, 2 * capacity, 1024)
+            vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors[: self.size] = self.vectors[: self.size]
+            self.vectors = vectors
+        if size > self.tag_bits.shape[0]:
+            tag_bits = np.zeros((self.vectors.shape[0], self.tag_bits.shape[1]), dtype=bool)
+            tag_bits[: self.size] = self.tag_bits[: self.size]
+            self.tag_bits = tag_bits
+
+    def _set_tags(self, row, payload):
+        for tag in payload.get("tags") or []:
+            if tag not in self.tag_columns:
+                self.tag_columns[tag] = len(self.tag_names)
+                self.tag_names.append(tag)
+                self.tag_bits = np.hstack([self.tag_bits, np.zeros((self.tag_bits.shape[0], 1), dtype=bool)])
+            self.tag_bits[row, self.tag_columns[tag]] = True
+
+    def build_hnsw(self):
+        hnsw = hnswlib.Index(space="ip", dim=self.vectors.shape[1])
+        hnsw.init_index(
+            max_elements=self.vectors.shape[0],
+            M=Config.LOCAL_INDEX_HNSW_M,
+            ef_construction=Config.LOCAL_INDEX_HNSW_EF_CONSTRUCTION,
+        )
+        hnsw.add_items(self.vectors[: self.size], np.arange(self.size))
+        hnsw.set_ef(Config.LOCAL_INDEX_HNSW_EF)
+        self.hnsw = hnsw
+
+
+class LocalIndex:
+    def __init__(self, collection_name, dim, directory):
+        """
+        Parameters:
+            collection_name (str): Qdrant collection mirrored by the index.
+            dim (int): Dimension of the vectors.
+            directory (str): Directory of the snapshot of this collection.
+        """
+        self.collection_name = collection_name
+        self.dim = dim
+        self.directory = directory
+        self.partitions = {}
+        self.synced_at = None
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0
+
+    # Search
+
+    def search(self, query_vector, type, tags, limit, offset=0, score_threshold=None):
+        """
+        Same arguments and results as a search of the Qdrant collection with the filters and
+        re-ranking of TAG_FILTER_MODE (see qdrant_handler.search_vectorstore).
+        """
+        if not self.ready.wait(Config.LOCAL_INDEX_READY_TIMEOUT):
+            raise TimeoutError(f"The local index of {self.collection_name} is not loaded yet")
+        partition = self.partitions.get(type)
+        if partition is None or partition.size == 0:
+            return []
+
+        size = partition.size
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+
+        mode = Config.TAG_FILTER_MODE if tags else "none"
+        columns = [partition.tag_columns.get(tag) for tag in tags]
+        keep = None
+        matched = None
+        if mode != "none":
+            known = [column for column in columns if column is not None]
+            matched = partition.tag_bits[:size, known].sum(axis=1) if known else np.zeros(size, dtype=np.int64)
+            required = len(tags) if mode == "must" else min(Config.TAG_MIN_MATCH, len(tags))
+            keep = matched >= required
+
+        rerank = mode == "should" and Config.TAG_WEIGHT > 0
+        k = offset + limit
+        # Candidates re-ranked by tags: the same pool of closest points for every page
+        candidates = Config.TAG_RERANK_POOL if rerank else k
+        if partition.hnsw is not None:
+            rows, scores = self._hnsw_candidates(partition, query, keep, candidates)
+        else:
+            scores = partition.vectors[:size] @ query
+            rows = np.flatnonzero(keep) if keep is not None else np.arange(size)
+            scores = scores[rows]
+            if rerank and len(rows) > candidates:
+                closest = np.argpartition(-scores, candidates - 1)[:candidates]
+                rows, scores = rows[closest], scores[closest]
+
+        if score_threshold is not None:
+            above = scores >= score_threshold
+            rows, scores = rows[above], scores[above]
+
+        ranking = scores
+        if rerank:
+            ranking = scores + Config.TAG_WEIGHT * matched[rows] / len(tags)
+
+        if len(rows) > k:
+            top = np.argpartition(-ranking, k - 1)[:k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-ranking[top], kind="stable")][offset:]
+
+        return [
+            models.ScoredPoint(
+                id=partition.ids[rows[i]],
+                version=0,
+                score=float(scores[i]),
+                payload=partition.payloads[rows[i]],
+                order_value=float(ranking[i]) if rerank else None,
+            )
+            for i in top
+        ]
+
+    def _hnsw_candidates(self, partition, query, keep, k):
+        # hnswlib is not safe to query while points are added
+        with self._lock:
+            count = min(k, partition.size if keep is None else int(keep.sum()))
+            if count == 0:
+                return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+            labels, distances = partition.hnsw.knn_query(
+                # Points added since the search started are past the end of keep
+                query, k=count, filter=None if keep is None else lambda label: label < len(keep) and bool(keep[label])
+            )
+        # Inner product space: distance is 1 - dot product
+        return labels[0].astype(np.int64), 1 - distances[0]
+
+    # Writes and sync
+
+    def upsert(self, points):
+        """
+        Adds or replaces points given as Qdrant PointStruct or Record objects with a vector.
+        """
+        by_type = {}
+        for point in points:
+            by_type.setdefault(point.payload.get("type"), []).append(point)
+
+        with self._lock:
+            for type, typed_points in by_type.items():
+                vectors = np.asarray([point.vector for point in typed_points], dtype=np.float32)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                partition = self.partitions.get(type)
+                if partition is None:
+                    partition = Partition(np.zeros((0, self.dim), dtype=np.float32), [], [], [])
+                partition.upsert([str(point.id) for point in typed_points], vectors, [point.payload for point in typed_points])
+                if partition.hnsw is None and _wants_hnsw(partition):
+                    self._build_hnsw(type, partition)
+                self.partitions = {**self.partitions, type: partition}
+            self._dirty = True
+
+    def sync(self, qdrant_client, full=False, batch_size=1024):
+        """
+        Pulls the points ingested since the last sync (every point when `full`), then snapshots the index.
+
+        Returns:
+            int: Number of points pulled.
+        """
+        started = time.time()
+        query_filter = None
+        if self.synced_at is not None and not full:
+            query_filter = models.Filter(
+                must=[models.FieldCondition(key="ingested_at", range=models.Range(gte=self.synced_at - SYNC_MARGIN))]
+            )
+
+        pulled = 0
+        offset = None
+        with timed("local_index.sync"):
+            while True:
+                points, offset = qdrant_client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=query_filter,
+                    limit=batch_size,
+                    offset=offset,
+                    with_payload=True,
+                    with_vectors=True,
+                )
+                if points:
+                    self.upsert(points)
+                    pulled += len(points)
+                if offset is None:
+                    break
+
+        self.synced_at = started
+        self.ready.set()
+        if self._dirty and time.monotonic() - self._saved_at >= Config.LOCAL_INDEX_SNAPSHOT_INTERVAL:
+            self.save()
+        logging.info(f"Synced {pulled} points into the local index of {self.collection_name}")
+        return pulled
+
+    def _build_hnsw(self, type, partition):
+        with timed("local_index.hnsw_build"):
+            partition.build_hnsw()
+        logging.info(f"Built the HNSW index of {partition.size} {type} points")
+
+    # Snapshots
+
+    def save(self):
+        """
+        Writes the index to its directory. Each file is replaced atomically; a snapshot
+        whose files do not agree is ignored on load.
+        """
+        with self._lock:
+            partitions = {type: partition for type, partition in self.partitions.items()}
+            sizes = {type: partition.size for type, partition in partitions.items()}
+            metadata = {
+                "collection_name": self.collection_name,
+                "dim": self.dim,
+                "synced_at": self.synced_at,
+                "partitions": {
+                    str(type): {
+                        "ids": partition.ids[: sizes[type]],
+                        "payloads": partition.payloads[: sizes[type]],
+                        "tags": partition.tag_names,
+                    }
+                    for type, partition in partitions.items()
+                },
+            }
+            self._dirty = False
+            self._saved_at = time.monotonic()
+
+        # Workers of one instance share the directory; keep their temporary files apart
+        suffix = f".tmp{os.getpid()}"
+        os.makedirs(self.directory, exist_ok=True)
+        with timed("local_index.save"):
+            for type, partition in partitions.items():
+                path = os.path.join(self.directory, f"{type}.npy")
+                with open(path + suffix, "wb") as file:
+                    np.save(file, partition.vectors[: sizes[type]])
+                os.replace(path + suffix, path)
+
+            path = os.path.join(self.directory, "index.json")
+            with open(path + suffix, "w") as file:
+                json.dump(metadata, file)
+            os.replace(path + suffix, path)
+
+    def load(self):
+        """
+        Memory-maps the snapshot of the index, if there is a usable one.
+
+        Returns:
+            bool: Whether a snapshot was loaded.
+        """
+        path = os.path.join(self.directory, "index.json")
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as file:
+                metadata = json.load(file)
+            if metadata["dim"] != self.dim:
+                logging.warning(f"Ignoring the local index snapshot in {self.directory}: dimension {metadata['dim']}")
+                return False
+
+            partitions = {}
+            for type, stored in metadata["partitions"].items():
+                vectors = np.load(os.path.join(self.directory, f"{type}.npy"), mmap_mode="r")
+                if len(vectors) != len(stored["ids"]):
+                    raise ValueError(f"{type}.npy has {len(vectors)} rows for {len(stored['ids'])} points")
+                partitions[type] = Partition(vectors, stored["ids"], stored["payloads"], stored["tags"])
+        except Exception as e:
+            logging.warning(f"Ignoring the local index snapshot in {self.directory}: {e}")
+            return False
+
+        for type, partition in partitions.items():
+            if _wants_hnsw(partition):
+                self._build_hnsw(type, partition)
+        self.partitions = partitions
+        self.synced_at = metadata["synced_at"]
+        self.ready.set()
+        logging.info(
+            f"Loaded the local index of {self.collection_name}: "
+            + ", ".join(f"{partition.size} {type}" for type, partition in partitions.items())
+        )
+        return True
+
+    def stats(self):
+        return {
+            "synced_at": self.synced_at,
+            "points": {str(type): partition.size for type, partition in self.partitions.items()},
+            "hnsw": [str(type) for type, partition in self.partitions.items() if partition.hnsw is not None],
+        }
+
+
+def _wants_hnsw(partition):
+    return (
+        hnswlib is not None
+        and Config.LOCAL_INDEX_HNSW_MIN_POINTS > 0
+        and partition.size >= Config.LOCAL_INDEX_HNSW_MIN_POINTS
+    )
+
+
+def _sync_forever(index):
+    while True:
+        try:
+            index.sync(get_qdrant_client())
+        except Exception as e:
+            logging.error(f"Local index sync of {index.collection_name} failed: {e}")
+        time.sleep(Config.LOCAL_INDEX_SYNC_INTERVAL)
+
+
+def _build_local_index(collection_name, dim):
+    index = LocalIndex(collection_name, dim, os.path.join(Config.LOCAL_INDEX_DIR, collection_name))
+    index.load()
+    if Config.LOCAL_INDEX_HNSW_MIN_POINTS > 0 and hnswlib is None:
+        logging.warning("LOCAL_INDEX_HNSW_MIN_POINTS is set but hnswlib is not installed; searching exhaustively")
+    # The first sync pulls everything when there was no snapshot; searches wait for it
+    threading.Thread(target=_sync_forever, args=(index,), daemon=True, name=f"local-index-{collection_name}").start()
+    return index
+
+
+def get_local_index(collection_name, dim):
+    return registry.get(f"local_index:{collection_name}", lambda: _build_local_index(collection_name, dim))
+
+
+def main():
+    # Imported here: qdrant_handler imports this module
+    from artist_matching.qdrant_handler import EMBEDDING_DIM, engine_collection
+
+    parser = argparse.ArgumentParser(description="In-process vector index utilities")
+    parser.add_argument("--sync", action="store_true", help="Pull new points from Qdrant and snapshot the index")
+    parser.add_argument("--rebuild", action="store_true", help="Pull every point, not only the new ones")
+    parser.add_argument("--collection", default=os.getenv("QDRANT_INDEX_NAME"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.sync or args.rebuild:
+        collection_name = engine_collection(args.collection)
+        index = LocalIndex(collection_name, EMBEDDING_DIM, os.path.join(Config.LOCAL_INDEX_DIR, collection_name))
+        if not args.rebuild:
+            index.load()
+        pulled = index.sync(get_qdrant_client(), full=args.rebuild)
+        index.save()
+        print(f"Pulled {pulled} points; {index.stats()['points']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Rebuilds a collection into the layout currently set in Config (quantization, on-disk
+storage, HNSW parameters) while it keeps serving:
+    python -m artist_matching.migrate_collection [--collection NAME] [--drop-source]
+
+The application only knows the collection by name (QDRANT_INDEX_NAME). The migration
+copies the points into a new collection "<name>_<timestamp>", copies again whatever
+was written meanwhile (through the "ingested_at" field), then points the alias <name>
+at the new collection. Searches and writes move over in one atomic alias update.
+
+Collections created by the application are already behind an alias of their name.
+A collection created before that, which is not an alias yet, has to be deleted to free
+its name for the alias: writes made after the last catch-up copy are lost, and requests
+fail until the alias exists. Stop the writers (/save jobs, bulk_ingest.py) during that
+first migration. Later migrations only swap the alias and need no freeze.
+"""
+import argparse
+import logging
+import os
+import time
+
+from qdrant_client.http import models
+
+from clients import get_qdrant_client
+from artist_matching.qdrant_handler import (
+    EMBEDDING_DIM,
+    collection_config,
+    create_payload_indexes,
+    engine_collection,
+    resolve_alias,
+)
+
+# Seconds subtracted from the start of a copy when catching up, for clock skew between writers
+CATCH_UP_MARGIN = 60
+
+
+def copy_points(qdrant_client, source, target, since=None, batch_size=512):
+    """
+    Copies the points of `source` into `target`, keeping their ids, vectors and payloads.
+    With `since`, only the points ingested from that time on.
+
+    Returns:
+        int: Number of points copied.
+    """
+    scroll_filter = None
+    if since is not None:
+        scroll_filter = models.Filter(
+            must=[models.FieldCondition(key="ingested_at", range=models.Range(gte=since - CATCH_UP_MARGIN))]
+        )
+
+    copied = 0
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=source,
+            scroll_filter=scroll_filter,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if points:
+            qdrant_client.upsert(
+                collection_name=target,
+                points=[models.PointStruct(id=point.id, vector=point.vector, payload=point.payload) for point in points],
+            )
+            copied += len(points)
+            logging.info(f"Copied {copied} points from {source} to {target}")
+        if offset is None:
+            return copied
+
+
+def migrate(name, drop_source=False, batch_size=512):
+    """
+    Rebuilds the collection or alias `name` into a new collection and points the alias `name` at it.
+
+    Returns:
+        str: Name of the new collection.
+    """
+    qdrant_client = get_qdrant_client()
+    source = resolve_alias(qdrant_client, name)
+    is_alias = source is not None
+    if not is_alias:
+        if not qdrant_client.collection_exists(name):
+            raise ValueError(f"No collection or alias named {name}")
+        source = name
+
+    target = f"{name}_{int(time.time())}"
+    size = qdrant_client.get_collection(source).config.params.vectors.size
+    if size != EMBEDDING_DIM:
+        logging.warning(f"{source} holds {size}-dim vectors; the configured engine uses {EMBEDDING_DIM}")
+    qdrant_client.create_collection(collection_name=target, **collection_config(size))
+    create_payload_indexes(qdrant_client, target, {})
+    logging.info(f"Created {target} from {source}")
+
+    started = time.time()
+    copy_points(qdrant_client, source, target, batch_size=batch_size)
+    # Writes made while the bulk copy ran
+    caught_up = time.time()
+    copy_points(qdrant_client, source, target, since=started, batch_size=batch_size)
+
+    if is_alias:
+        qdrant_client.update_collection_aliases(
+            change_aliases_operations=[
+                models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=name)),
+                models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=name)),
+            ]
+        )
+        # Writes that still reached the old collection before the swap
+        copy_points(qdrant_client, source, target, since=caught_up, batch_size=batch_size)
+        if drop_source:
+            qdrant_client.delete_collection(source)
+    else:
+        copy_points(qdrant_client, source, target, since=caught_up, batch_size=batch_size)
+        # Writes from here to the alias creation are lost, hence the write freeze (see above)
+        logging.warning(f"Replacing the collection {name} with an alias; writes must be stopped")
+        qdrant_client.delete_collection(name)
+        qdrant_client.update_collection_aliases(
+            change_aliases_operations=[
+                models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=name)),
+            ]
+        )
+
+    logging.info(f"{name} now points at {target}")
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild a Qdrant collection into the configured layout")
+    parser.add_argument("--collection", default=os.getenv("QDRANT_INDEX_NAME"))
+    parser.add_argument("--drop-source", action="store_true", help="Delete the previous collection after the swap")
+    parser.add_argument("--batch-size", type=int, default=512)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(migrate(engine_collection(args.collection), args.drop_source, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Precomputed cross-modal recommendations of the catalogue: the NEIGHBOURS_K closest audio
+of every saved image and the closest images of every saved audio, as /upload would
+return them for that media. /recommendations serves them with a single MongoDB lookup
+instead of running the whole pipeline again.
+
+They are stored in the MongoDB collection "neighbours", one document per Qdrant point.
+Saving a media computes its recommendations and recomputes those of the NEIGHBOURS_FANOUT
+closest items of the other type, the ones it is likely to enter. A nightly refresh
+(cron.yaml) recomputes everything, which also picks up bulk ingests and deletions.
+"""
+import logging
+import os
+import time
+
+from pymongo import UpdateOne
+
+from clients import get_qdrant_client
+from config import Config
+from metrics import timed
+from artist_matching.qdrant_handler import VECTOR_BACKENDS, engine_collection, point_id
+
+# Type of the recommendations of each media type
+RETURN_TYPES = {"image": "audio", "audio": "image"}
+
+
+def lookup_query(url=None, point_id=None):
+    """
+    MongoDB filter of the stored recommendations of a media, by URL or by Qdrant point id.
+    """
+    return {"point_id": point_id} if point_id is not None else {"url": url}
+
+
+class NeighbourStore:
+    def __init__(self, db, hydrate):
+        """
+        Parameters:
+            db: MongoDB database holding the "media" and "neighbours" collections.
+            hydrate (callable): Turns search results into the response entries of /upload,
+                with their artist details.
+        """
+        self.db = db
+        self.hydrate = hydrate
+
+    def get(self, url=None, point_id=None):
+        """
+        Returns the stored recommendations of a media, computing them on a miss.
+        None if the media is not in the catalogue.
+        """
+        document = self.db.neighbours.find_one(lookup_query(url, point_id))
+        if document is not None:
+            return document
+        return self.fill(url, point_id)
+
+    def fill(self, url=None, point_id=None):
+        """
+        Computes and stores the recommendations of a single media, or returns None if it is not in the catalogue.
+        """
+        if point_id is None:
+            media = self.db.media.find_one({"url": url})
+            if media is None:
+                return None
+            point_id = _point_id(url, media.get("content_hash"))
+        self.refresh_points([point_id])
+        return self.db.neighbours.find_one(lookup_query(point_id=point_id))
+
+    def add(self, url, content_hash=None):
+        """
+        Updates the recommendations after the media at `url` was saved: its own, and those
+        of the closest NEIGHBOURS_FANOUT items of the other type.
+
+        Returns:
+            int: Number of documents written.
+        """
+        collection_name = _collection_name()
+        points = get_qdrant_client().retrieve(
+            collection_name=collection_name,
+            ids=[_point_id(url, content_hash)],
+            with_payload=True,
+            with_vectors=True,
+        )
+        if not points or points[0].payload.get("type") not in RETURN_TYPES:
+            return 0
+
+        point = points[0]
+        # Search scores are symmetric without tags, so these are the items ranking the new media highest
+        affected = VECTOR_BACKENDS["qdrant"].search(
+            collection_name,
+            point.vector,
+            RETURN_TYPES[point.payload["type"]],
+            [],
+            Config.NEIGHBOURS_FANOUT,
+            0,
+            None,
+        )
+        if affected:
+            points += get_qdrant_client().retrieve(
+                collection_name=collection_name,
+                ids=[hit.id for hit in affected],
+                with_payload=True,
+                with_vectors=True,
+            )
+        return self.store(collection_name, points)
+
+    def refresh_points(self, ids):
+        collection_name = _collection_name()
+        points = get_qdrant_client().retrieve(
+            collection_name=collection_name, ids=ids, with_payload=True, with_vectors=True
+        )
+        return self.store(collection_name, points)
+
+    def refresh(self, batch_size=256):
+        """
+        Recomputes the recommendations of the whole catalogue and drops those of deleted items.
+
+        Returns:
+            int: Number of documents written.
+        """
+        collection_name = _collection_name()
+        started = time.time()
+        written = 0
+        offset = None
+        while True:
+            points, offset = get_qdrant_client().scroll(
+                collection_name=collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            written += self.store(collection_name, points)
+            logging.info(f"Computed the recommendations of {written} items")
+            if offset is None:
+                break
+
+        # Documents written since the start, by this refresh or by saves, are current
+        with timed("mongo.neighbours"):
+            removed = self.db.neighbours.delete_many({"computed_at": {"$lt": started}}).deleted_count
+        logging.info(f"Refreshed {written} recommendations, removed {removed}")
+        return written
+
+    def store(self, collection_name, points):
+        """
+        Computes and stores the recommendations of `points` (retrieved with their vectors).
+        """
+        points = [point for point in points if point.payload.get("type") in RETURN_TYPES]
+        if not points:
+            return 0
+
+        results = VECTOR_BACKENDS["qdrant"].search_batch(
+            collection_name,
+            [
+                (
+                    point.vector,
+                    RETURN_TYPES[point.payload["type"]],
+                    point.payload.get("tags") or [],
+                    Config.NEIGHBOURS_K,
+                    0,
+                    None,
+                )
+                for point in points
+            ],
+        )
+
+        # The artists of the whole batch are looked up at once
+        entries = self.hydrate([hit for hits in results for hit in hits])
+        computed_at = time.time()
+        operations = []
+        start = 0
+        for point, hits in zip(points, results):
+            operations.append(
+                UpdateOne(
+                    {"point_id": str(point.id)},
+                    {
+                        "$set": {
+                            "point_id": str(point.id),
+                            "url": point.payload["url"],
+                            "type": point.payload["type"],
+                            "return_type": RETURN_TYPES[point.payload["type"]],
+                            "urls": entries[start : start + len(hits)],
+                            "computed_at": computed_at,
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+            start += len(hits)
+
+        with timed("mongo.neighbours"):
+            self.db.neighbours.bulk_write(operations, ordered=False)
+        return len(operations)
+
+
+def _collection_name():
+    return engine_collection(os.getenv("QDRANT_INDEX_NAME"))
+
+
+def _point_id(url, content_hash):
+    return point_id({"url": url, "content_hash": content_hash})
@@ -0,0 +1,188 @@
+"""
+Smaller derivatives of the uploaded media, sent to the models instead of the originals.
+
+Images are downscaled to IMAGE_MAX_SIDE and re-encoded as IMAGE_FORMAT, then sent to the
+vision model inline as a data URL. Audio is cut to its first AUDIO_EXCERPT_SECONDS, mixed
+down to mono and resampled to AUDIO_SAMPLE_RATE (Whisper works at 16 kHz anyway). The
+originals are still what gets stored in Firebase.
+
+Any audio format is handled when ffmpeg is on the PATH; without it only WAV is, and other
+formats are sent as they are.
+"""
+import base64
+import io
+import logging
+import shutil
+import subprocess
+import wave
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from config import Config
+from metrics import timed
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def image_variant():
+    """
+    Identifies the derivative settings, so cached transcriptions of other settings are not reused.
+    """
+    if not Config.PREPROCESS_MEDIA:
+        return "original"
+    return f"{Config.IMAGE_MAX_SIDE}px-{Config.IMAGE_FORMAT}-q{Config.IMAGE_QUALITY}"
+
+
+def audio_variant():
+    if not Config.PREPROCESS_MEDIA:
+        return "original"
+    return f"{Config.AUDIO_EXCERPT_SECONDS}s-{Config.AUDIO_SAMPLE_RATE}hz-mono"
+
+
+def downscale_image(data):
+    """
+    Returns the image bounded to IMAGE_MAX_SIDE pixels and re-encoded, with its MIME type.
+    """
+    with timed("preprocess.image", bytes_sent=len(data)) as span:
+        image = Image.open(io.BytesIO(data))
+        # Phones store the rotation in EXIF; apply it, since re-encoding drops the tag
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((Config.IMAGE_MAX_SIDE, Config.IMAGE_MAX_SIDE), Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        image.save(output, format=Config.IMAGE_FORMAT, quality=Config.IMAGE_QUALITY)
+        span.bytes_received = output.tell()
+    return output.getvalue(), IMAGE_MIME_TYPES[Config.IMAGE_FORMAT]
+
+
+def image_data_url(data):
+    """
+    Returns a data URL of the image derivative, to be sent to the vision model instead of a link.
+    """
+    if not Config.PREPROCESS_MEDIA:
+        return f"data:{_sniff_image_type(data)};base64,{base64.b64encode(data).decode('ascii')}"
+    try:
+        data, mime_type = downscale_image(data)
+    except Exception as e:
+        logging.warning(f"Image preprocessing failed, sending the original: {e}")
+        mime_type = _sniff_image_type(data)
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def _sniff_image_type(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+def audio_excerpt(data):
+    """
+    Returns the trimmed, mono, downsampled excerpt of an audio file, or the file itself when
+    preprocessing is off, fails, or would not make it smaller.
+    """
+    if not Config.PREPROCESS_MEDIA:
+        return data
+
+    try:
+        with timed("preprocess.audio", bytes_sent=len(data)) as span:
+            if shutil.which("ffmpeg"):
+                excerpt = _ffmpeg(data, "flac")
+            elif _is_wav(data):
+                excerpt = _encode_wav(_decode_wav(data))
+            else:
+                excerpt = data
+            span.bytes_received = len(excerpt)
+    except Exception as e:
+        logging.warning(f"Audio preprocessing failed, sending the original: {e}")
+        return data
+    return excerpt if len(excerpt) < len(data) else data
+
+
+def decode_audio(data, sample_rate=None, seconds=None):
+    """
+    Decodes the first `seconds` of an audio file to mono samples at `sample_rate`,
+    by default AUDIO_EXCERPT_SECONDS at AUDIO_SAMPLE_RATE.
+
+    Returns:
+        np.ndarray: float32 samples in the int16 range.
+
+    Raises:
+        ValueError: The format cannot be decoded here (not WAV, and no ffmpeg).
+    """
+    sample_rate = sample_rate or Config.AUDIO_SAMPLE_RATE
+    seconds = seconds or Config.AUDIO_EXCERPT_SECONDS
+    if shutil.which("ffmpeg"):
+        return np.frombuffer(_ffmpeg(data, "s16le", sample_rate, seconds), dtype=np.int16).astype(np.float32)
+    if _is_wav(data):
+        return _decode_wav(data, sample_rate, seconds)
+    raise ValueError("Only WAV audio can be decoded without ffmpeg")
+
+
+def _is_wav(data):
+    return data[:4] == b"RIFF" and data[8:12] == b"WAVE"
+
+
+def _ffmpeg(data, format, sample_rate=None, seconds=None):
+    result = subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-t", str(seconds or Config.AUDIO_EXCERPT_SECONDS),
+            "-ac", "1",
+            "-ar", str(sample_rate or Config.AUDIO_SAMPLE_RATE),
+            "-f", format, "pipe:1",
+        ],
+        input=data,
+        capture_output=True,
+        check=True,
+        timeout=60,
+    )
+    return result.stdout
+
+
+def _decode_wav(data, sample_rate=None, seconds=None):
+    sample_rate = sample_rate or Config.AUDIO_SAMPLE_RATE
+    seconds = seconds or Config.AUDIO_EXCERPT_SECONDS
+    with wave.open(io.BytesIO(data)) as source:
+        channels = source.getnchannels()
+        width = source.getsampwidth()
+        rate = source.getframerate()
+        frames = source.readframes(int(seconds * rate))
+
+    if width == 1:
+        # 8-bit WAV is unsigned
+        samples = np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128
+        samples *= 256
+    elif width in (2, 4):
+        samples = np.frombuffer(frames, dtype=np.int16 if width == 2 else np.int32).astype(np.float32)
+        if width == 4:
+            samples /= 1 << 16
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width} bytes")
+
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != sample_rate:
+        # Linear interpolation is enough for speech recognition, which tolerates some aliasing
+        duration = len(samples) / rate
+        positions = np.arange(int(duration * sample_rate)) * (rate / sample_rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+    return samples
+
+
+def _encode_wav(samples):
+    output = io.BytesIO()
+    with wave.open(output, "wb") as target:
+        target.setnchannels(1)
+        target.setsampwidth(2)
+        target.setframerate(Config.AUDIO_SAMPLE_RATE)
+        target.writeframes(np.clip(samples, -32768, 32767).astype(np.int16).tobytes())
+    return output.getvalue()
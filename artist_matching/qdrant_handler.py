@@ -1,79 +1,450 @@
+import asyncio
+import threading
+import time
 import uuid
-from qdrant_client import QdrantClient
 from qdrant_client.http import models
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core.node_parser import SimpleNodeParser
-from llama_index.embeddings.openai import OpenAIEmbedding
 import os
 import logging
 
+from config import Config
+from clients import get_async_qdrant_client, get_qdrant_client
+from metrics import timed
+from artist_matching.embeddings import EMBEDDING_DIM, embed_text, embed_text_async, embed_texts, embed_texts_async
+from artist_matching.local_engine import LOCAL_COLLECTION_SUFFIX
+from artist_matching.local_index import get_local_index
 
-def create_collection_if_not_exists(qdrant_client, collection_name):
-    collections = qdrant_client.get_collections().collections
-    if not any(collection.name == collection_name for collection in collections):
-        qdrant_client.create_collection(
-            collection_name=collection_name,
-            vectors_config=models.VectorParams(size=1536, distance=models.Distance.COSINE),
+
+# Payload fields used in search filters; without an index Qdrant scans every point to filter them
+KEYWORD_INDEXES = ["type", "tags"]
+# Range-filtered by the incremental sync of the local index
+FLOAT_INDEXES = ["ingested_at"]
+
+# Namespace of the point ids, derived from the content hash of the media (or its URL without one)
+POINT_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "artist-recommendation/points")
+
+def engine_collection(collection_name):
+    """
+    Name of the collection holding the vectors of the configured embedding engine.
+    """
+    if Config.EMBEDDING_ENGINE == "local":
+        return collection_name + LOCAL_COLLECTION_SUFFIX
+    return collection_name
+
+def collection_config(size=EMBEDDING_DIM):
+    """
+    Arguments of create_collection for the layout set in Config: quantization, on-disk
+    vectors and payload, and HNSW parameters.
+    """
+    quantization_config = None
+    if Config.QDRANT_QUANTIZATION == "scalar":
+        quantization_config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                # Clip the outliers so the int8 range covers the bulk of the values
+                quantile=Config.QDRANT_QUANTIZATION_QUANTILE,
+                always_ram=Config.QDRANT_QUANTIZATION_ALWAYS_RAM,
+            )
         )
-        logging.info(f"Created new collection: {collection_name}")
-    else:
-        logging.info(f"Collection {collection_name} already exists")
+    elif Config.QDRANT_QUANTIZATION == "binary":
+        quantization_config = models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=Config.QDRANT_QUANTIZATION_ALWAYS_RAM)
+        )
+
+    return {
+        "vectors_config": models.VectorParams(
+            size=size, distance=models.Distance.COSINE, on_disk=Config.QDRANT_ON_DISK_VECTORS
+        ),
+        "on_disk_payload": Config.QDRANT_ON_DISK_PAYLOAD,
+        "hnsw_config": models.HnswConfigDiff(m=Config.QDRANT_HNSW_M, ef_construct=Config.QDRANT_HNSW_EF_CONSTRUCT),
+        "quantization_config": quantization_config,
+    }
+
+def collection_names(qdrant_client):
+    """
+    Names of the collections and of the aliases pointing at them; an alias is used like a collection.
+    """
+    names = {collection.name for collection in qdrant_client.get_collections().collections}
+    names.update(alias.alias_name for alias in qdrant_client.get_aliases().aliases)
+    return names
+
+def resolve_alias(qdrant_client, name):
+    """
+    Returns the collection the alias `name` points at, or None if `name` is not an alias.
+    """
+    for alias in qdrant_client.get_aliases().aliases:
+        if alias.alias_name == name:
+            return alias.collection_name
+    return None
+
+def create_collection_if_not_exists(qdrant_client, collection_name, size=EMBEDDING_DIM):
+    if collection_name not in collection_names(qdrant_client):
+        # Created behind an alias of the name, so that migrate_collection only has to swap the alias.
+        # The suffix keeps workers bootstrapping at the same second from picking the same name.
+        target = f"{collection_name}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        created = False
+        try:
+            qdrant_client.create_collection(collection_name=target, **collection_config(size))
+            created = True
+            qdrant_client.update_collection_aliases(
+                change_aliases_operations=[
+                    models.CreateAliasOperation(
+                        create_alias=models.CreateAlias(collection_name=target, alias_name=collection_name)
+                    ),
+                ]
+            )
+        except Exception as e:
+            # Another worker created the alias first ("already exists"); anything else is a real failure
+            if resolve_alias(qdrant_client, collection_name) is None:
+                raise
+            logging.info(f"Collection {collection_name} was created by another worker: {e}")
+
+        if resolve_alias(qdrant_client, collection_name) == target:
+            logging.info(f"Created new collection {target} as {collection_name}")
+            create_payload_indexes(qdrant_client, target, {})
+            return
+        if created:
+            # Lost the race; the alias points at the other worker's collection
+            qdrant_client.delete_collection(target)
+
+    logging.info(f"Collection {collection_name} already exists")
+    indexed = qdrant_client.get_collection(collection_name).payload_schema
+    create_payload_indexes(qdrant_client, collection_name, indexed)
+
+_ready_collections = set()
+_ready_lock = threading.Lock()
+
+def ensure_collection(collection_name, size=EMBEDDING_DIM):
+    """
+    Creates the collection and its payload indexes if needed, once per process; later calls
+    return without any round-trip. The bootstrap of app.py runs it when a worker starts.
+    """
+    if collection_name in _ready_collections:
+        return
+    with _ready_lock:
+        if collection_name not in _ready_collections:
+            create_collection_if_not_exists(get_qdrant_client(), collection_name, size)
+            _ready_collections.add(collection_name)
+
+def create_payload_indexes(qdrant_client, collection_name, indexed):
+    schemas = [(field, models.PayloadSchemaType.KEYWORD) for field in KEYWORD_INDEXES]
+    schemas += [(field, models.PayloadSchemaType.FLOAT) for field in FLOAT_INDEXES]
+    for field, schema in schemas:
+        if field not in indexed:
+            qdrant_client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field,
+                field_schema=schema,
+            )
+            logging.info(f"Created {schema.value} index on {field} in {collection_name}")
 
-def add_to_vectorstore(text, tags, type, url):
-    qdrant_client = QdrantClient(
-        url=os.getenv("QDRANT_URL"),
-        api_key=os.getenv("QDRANT_KEY"),
+def add_to_vectorstore(text, tags, type, url, artist=None, content_hash=None):
+    add_many_to_vectorstore(
+        [{"text": text, "tags": tags, "type": type, "url": url, "artist": artist, "content_hash": content_hash}]
     )
-    embed_model = OpenAIEmbedding(api_key=os.getenv("OPENAI_API_KEY"))
+
+def add_many_to_vectorstore(items):
+    """
+    Embeds and upserts several items in one batch.
+
+    Parameters:
+        items (list): Dicts with the "text", "tags", "type" and "url" of each item, and optionally
+            the "artist" metadata (name, email, portfolio_url, title) to denormalize into the payload
+            and the "content_hash" of the media.
+
+    Point ids are derived from the content hash, so storing the same media again overwrites
+    its point instead of adding a duplicate.
+    """
     # Connect to hacksc vectorstore
-    collection_name = os.getenv("QDRANT_INDEX_NAME")
-    create_collection_if_not_exists(qdrant_client, collection_name)
+    collection_name = engine_collection(os.getenv("QDRANT_INDEX_NAME"))
+    ensure_collection(collection_name)
+
+    vectors = embed_texts([item["text"] for item in items])
 
     # Add the text and tags (as metadata) to the vectorstore
-    qdrant_client.upsert(
-        collection_name=collection_name,
-        points=[
+    ingested_at = time.time()
+    get_vector_backend().upsert(
+        collection_name,
+        [
             models.PointStruct(
-                id=str(uuid.uuid4()),
-                vector=embed_model.get_text_embedding(text),
-                payload={"text": text, "tags": tags, "type": type, "url": url}
+                id=point_id(item),
+                vector=vector.tolist(),
+                payload=_payload(item, ingested_at),
             )
-        ]
+            for item, vector in zip(items, vectors)
+        ],
+    )
+
+    logging.info(f"Added {len(items)} texts to vectorstore successfully")
+
+def point_id(item):
+    return str(uuid.uuid5(POINT_NAMESPACE, item.get("content_hash") or item["url"]))
+
+def _payload(item, ingested_at):
+    payload = {
+        "text": item["text"],
+        "tags": item["tags"],
+        "type": item["type"],
+        "url": item["url"],
+        "ingested_at": ingested_at,
+    }
+    if item.get("content_hash"):
+        payload["content_hash"] = item["content_hash"]
+    # Keeping the artist next to the vector lets search results skip the MongoDB lookup
+    if item.get("artist"):
+        payload["artist"] = item["artist"]
+    return payload
+
+def search_vectorstore(text, type, tags, collection_name, limit=5, offset=0, score_threshold=None):
+    """
+    Searches the points of the given type closest to `text`.
+
+    How the query tags are used depends on TAG_FILTER_MODE:
+    - "must": only points carrying every query tag are returned.
+    - "should": points must carry at least TAG_MIN_MATCH of the query tags, and the
+      TAG_RERANK_POOL closest ones are re-ranked by cosine score plus TAG_WEIGHT times
+      the fraction of query tags they carry. The hits keep their cosine score; the
+      re-ranking score is their `order_value`.
+    - "none": tags are ignored.
+
+    `limit` and `offset` page through the hits by decreasing rank; hits whose cosine
+    similarity is below `score_threshold` are dropped. With the local embedding engine,
+    the local counterpart of `collection_name` is searched.
+    """
+
+    collection_name = engine_collection(collection_name)
+    query_vector = embed_text(text).tolist()
+
+    search_result = get_vector_backend().search(
+        collection_name, query_vector, type, tags, limit, offset, score_threshold
     )
 
+    logging.info(f"Retrieval results: {search_result}")
+
+    # Return the search result
+    return search_result
+
+async def search_vectorstore_async(text, type, tags, collection_name, limit=5, offset=0, score_threshold=None):
+    """
+    Same as search_vectorstore, on the async Qdrant client of the async serving mode.
+    """
+    collection_name = engine_collection(collection_name)
+    query_vector = (await embed_text_async(text)).tolist()
 
-    logging.info("Text added to vectorstore successfully")
+    search_result = await get_vector_backend().search_async(
+        collection_name, query_vector, type, tags, limit, offset, score_threshold
+    )
+
+    logging.info(f"Retrieval results: {search_result}")
+    return search_result
 
-def search_vectorstore(text, type, tags, collection_name):
+def search_vectorstore_batch(queries, collection_name):
     """
-    Right now, the query tags are filtered to be a subset of the tags in the vectorstore.
+    Runs several searches in one round-trip, embedding their texts in a single batch.
+
+    Parameters:
+        queries (list): Tuples (text, type, tags, limit, offset, score_threshold), with the
+            meaning of the arguments of search_vectorstore.
+
+    Returns:
+        list: The results of each query, in order.
     """
+    collection_name = engine_collection(collection_name)
+    vectors = embed_texts([query[0] for query in queries])
+    return get_vector_backend().search_batch(
+        collection_name, [(vector.tolist(), *query[1:]) for vector, query in zip(vectors, queries)]
+    )
 
-    qdrant_client = QdrantClient(
-        url=os.getenv("QDRANT_URL"),
-        api_key=os.getenv("QDRANT_KEY"),
+async def search_vectorstore_batch_async(queries, collection_name):
+    """
+    Same as search_vectorstore_batch, on the async Qdrant client of the async serving mode.
+    """
+    collection_name = engine_collection(collection_name)
+    vectors = await embed_texts_async([query[0] for query in queries])
+    return await get_vector_backend().search_batch_async(
+        collection_name, [(vector.tolist(), *query[1:]) for vector, query in zip(vectors, queries)]
     )
-    embed_model = OpenAIEmbedding(api_key=os.getenv("OPENAI_API_KEY"))
 
+class QdrantBackend:
+    """
+    Vector backend storing and searching the points in the Qdrant collection.
+
+    A backend implements upsert(collection_name, points) and search / search_async
+    (collection_name, query_vector, type, tags, limit, offset, score_threshold),
+    returning ScoredPoints by decreasing score. search_batch / search_batch_async
+    (collection_name, queries) run several searches, each given as the tuple of the
+    arguments after collection_name.
+    """
+
+    def upsert(self, collection_name, points):
+        with timed("qdrant.upsert"):
+            get_qdrant_client().upsert(collection_name=collection_name, points=points)
+
+    def search(self, collection_name, query_vector, type, tags, limit, offset, score_threshold):
+        search_params, rerank = _search_params(type, tags, limit, offset, score_threshold)
+
+        with timed("qdrant.search"):
+            search_result = get_qdrant_client().search(
+                collection_name=collection_name,
+                query_vector=query_vector,
+                **search_params,
+            )
+
+        if rerank:
+            search_result = rerank_by_tags(search_result, tags)[offset : offset + limit]
+        return search_result
+
+    def search_batch(self, collection_name, queries):
+        prepared, requests = _search_requests(queries)
+
+        # One round-trip for the whole batch
+        with timed("qdrant.search_batch"):
+            results = get_qdrant_client().search_batch(collection_name=collection_name, requests=requests)
+
+        return _rerank_batch(prepared, results)
+
+    async def search_batch_async(self, collection_name, queries):
+        prepared, requests = _search_requests(queries)
+
+        with timed("qdrant.search_batch"):
+            results = await get_async_qdrant_client().search_batch(collection_name=collection_name, requests=requests)
+
+        return _rerank_batch(prepared, results)
+
+    async def search_async(self, collection_name, query_vector, type, tags, limit, offset, score_threshold):
+        search_params, rerank = _search_params(type, tags, limit, offset, score_threshold)
+
+        with timed("qdrant.search"):
+            search_result = await get_async_qdrant_client().search(
+                collection_name=collection_name,
+                query_vector=query_vector,
+                **search_params,
+            )
+
+        if rerank:
+            search_result = rerank_by_tags(search_result, tags)[offset : offset + limit]
+        return search_result
+
+class LocalIndexBackend(QdrantBackend):
+    """
+    Vector backend searching the in-process copy of the collection (see local_index.py).
+    Writes still go to Qdrant, and to the copy of this worker so that they show up at once.
+    """
+
+    def upsert(self, collection_name, points):
+        super().upsert(collection_name, points)
+        get_local_index(collection_name, EMBEDDING_DIM).upsert(points)
+
+    def search(self, collection_name, query_vector, type, tags, limit, offset, score_threshold):
+        index = get_local_index(collection_name, EMBEDDING_DIM)
+        with timed("local_index.search"):
+            return index.search(query_vector, type, tags, limit, offset, score_threshold)
+
+    def search_batch(self, collection_name, queries):
+        return [self.search(collection_name, *query) for query in queries]
+
+    async def search_batch_async(self, collection_name, queries):
+        return await asyncio.to_thread(self.search_batch, collection_name, queries)
+
+    async def search_async(self, collection_name, query_vector, type, tags, limit, offset, score_threshold):
+        # A few milliseconds of NumPy, but enough to keep off the event loop
+        return await asyncio.to_thread(
+            self.search, collection_name, query_vector, type, tags, limit, offset, score_threshold
+        )
+
+VECTOR_BACKENDS = {"qdrant": QdrantBackend(), "local": LocalIndexBackend()}
+
+def get_vector_backend():
+    return VECTOR_BACKENDS[Config.VECTOR_BACKEND]
+
+def _search_params(type, tags, limit, offset, score_threshold):
+    """
+    Builds the filter and paging arguments of a search; also returns whether the hits must be re-ranked by tags.
+    """
+    mode = Config.TAG_FILTER_MODE if tags else "none"
+
+    type_condition = models.FieldCondition(key="type", match=models.MatchValue(value=type))
     tag_filter_conditions = [
         models.FieldCondition(key="tags", match=models.MatchValue(value=tag))
         for tag in tags
     ]
+    if mode == "must":
+        query_filter = models.Filter(must=[*tag_filter_conditions, type_condition])
+    elif mode == "should":
+        query_filter = models.Filter(
+            must=[type_condition],
+            min_should=models.MinShould(
+                conditions=tag_filter_conditions,
+                min_count=min(Config.TAG_MIN_MATCH, len(tags)),
+            ),
+        )
+    else:
+        query_filter = models.Filter(must=[type_condition])
 
-    # Search the vectorstore
-    search_result = qdrant_client.search(
-        collection_name=collection_name,
-        query_vector=embed_model.get_text_embedding(text),
-        limit=5,
-        query_filter= models.Filter(
-            must=[
-                *tag_filter_conditions,
-                models.FieldCondition(key="type", match=models.MatchValue(value=type)),
-            ],
-        ),
-    )
+    rerank = mode == "should" and Config.TAG_WEIGHT > 0
 
-    logging.info(f"Retrieval results: {search_result}")
+    search_params = {
+        # The pool does not depend on the page, so every page slices the same ranking
+        "limit": Config.TAG_RERANK_POOL if rerank else limit,
+        "offset": 0 if rerank else offset,
+        "score_threshold": score_threshold,
+        "query_filter": query_filter,
+        "search_params": _qdrant_search_params(),
+    }
+    return search_params, rerank
 
-    # Return the search result
-    return search_result
+def _search_requests(queries):
+    """
+    Builds the SearchRequests of a batch; also returns each query with its parameters and re-ranking flag.
+    """
+    prepared = [(query, *_search_params(*query[1:])) for query in queries]
+    requests = [
+        models.SearchRequest(
+            vector=query[0],
+            filter=search_params["query_filter"],
+            params=search_params["search_params"],
+            limit=search_params["limit"],
+            offset=search_params["offset"],
+            score_threshold=search_params["score_threshold"],
+            with_payload=True,
+        )
+        for query, search_params, _ in prepared
+    ]
+    return prepared, requests
+
+def _rerank_batch(prepared, results):
+    batch_results = []
+    for (query, _, rerank), search_result in zip(prepared, results):
+        _, _, tags, limit, offset, _ = query
+        if rerank:
+            search_result = rerank_by_tags(search_result, tags)[offset : offset + limit]
+        batch_results.append(search_result)
+    return batch_results
+
+def _qdrant_search_params():
+    quantization = None
+    if Config.QDRANT_QUANTIZATION != "none":
+        # Candidates are picked on the quantized vectors, then rescored on the original ones
+        quantization = models.QuantizationSearchParams(
+            rescore=Config.QDRANT_RESCORE,
+            oversampling=Config.QDRANT_OVERSAMPLING,
+        )
+    if quantization is None and Config.QDRANT_HNSW_EF is None:
+        return None
+    return models.SearchParams(hnsw_ef=Config.QDRANT_HNSW_EF, quantization=quantization)
+
+def rerank_by_tags(points, tags):
+    """
+    Orders points by cosine score plus TAG_WEIGHT times the fraction of `tags` they carry.
+    That sum is set as their `order_value`; `score` stays the cosine similarity.
+    """
+    query_tags = set(tags)
+    rescored = [
+        point.model_copy(
+            update={
+                "order_value": point.score
+                + Config.TAG_WEIGHT * len(query_tags.intersection(point.payload.get("tags") or [])) / len(query_tags)
+            }
+        )
+        for point in points
+    ]
+    return sorted(rescored, key=lambda point: point.order_value, reverse=True)
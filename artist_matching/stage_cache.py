@@ -0,0 +1,363 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from config import Config
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_text(text):
+    return hash_bytes(text.encode("utf-8"))
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(stage, model, prompt_version, content_hash):
+    """
+    Builds the cache key of a pipeline stage.
+
+    Parameters:
+        stage (str): Name of the stage, e.g. "describe_audio".
+        model (str): Model the stage calls.
+        prompt_version (int): Bumped whenever the stage prompt changes.
+        content_hash (str): Content hash of the stage input.
+    """
+    return f"{stage}:{model}:v{prompt_version}:{content_hash}"
+
+
+class MemoryTier:
+    """
+    In-process LRU bounded by the total size of the stored values.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes_used = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (expires_at or time.time() + self.ttl, value)
+            self.bytes_used += len(value)
+            while self.bytes_used > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        _, value = self._entries.pop(key)
+        self.bytes_used -= len(value)
+
+
+class SQLiteTier:
+    """
+    Persistent tier stored in a local SQLite file, so results survive worker restarts.
+    """
+
+    # Seconds between two updates of the access time of a row
+    ACCESS_RESOLUTION = 60
+
+    def __init__(self, path, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        # Readers are not blocked by the writes of other workers sharing the file
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stage_cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS stage_cache_accessed ON stage_cache (accessed_at)"
+        )
+        self._conn.commit()
+
+    @property
+    def bytes_used(self):
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM stage_cache").fetchone()
+        return row[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at, accessed_at FROM stage_cache WHERE key = ?", (key,)
+            ).fetchone()
+            # Expired rows are left to the eviction of the next set
+            if row is None or row[1] < now:
+                return None, None
+            value, expires_at, accessed_at = row
+            # Hits are served from memory afterwards, so the LRU order only needs to be coarse;
+            # skipping the write keeps reads from queueing on the write lock
+            if now - accessed_at > self.ACCESS_RESOLUTION:
+                self._conn.execute(
+                    "UPDATE stage_cache SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+                self._conn.commit()
+        return bytes(value), expires_at
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stage_cache VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now + self.ttl, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM stage_cache WHERE expires_at < ?", (now,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM stage_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Drop least recently used rows until we are back under the budget
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM stage_cache ORDER BY accessed_at"
+        ):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.executemany("DELETE FROM stage_cache WHERE key = ?", stale)
+
+
+class StageCache:
+    """
+    Two-tier cache for the results of the description/tag pipeline stages.
+
+    Lookups go to the in-process LRU first and fall back to the SQLite file;
+    disk hits are promoted into memory. Values must be JSON serializable.
+    """
+
+    def __init__(self, path, memory_bytes, disk_bytes, ttl):
+        self.memory = MemoryTier(memory_bytes, ttl)
+        self.disk = SQLiteTier(path, disk_bytes, ttl)
+        self._lock = threading.Lock()
+        self._counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def get(self, key):
+        value = self.get_memory(key)
+        if value is not None:
+            return value
+        return self.get_disk(key)
+
+    def get_memory(self, key):
+        """
+        Looks the key up in memory only. Returns None on a miss, which get_disk then counts.
+        """
+        value = self.memory.get(key)
+        if value is None:
+            return None
+        self._count("memory_hits")
+        return json.loads(value)
+
+    def get_disk(self, key):
+        value, expires_at = self.disk.get(key)
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("disk_hits")
+        self.memory.set(key, value, expires_at)
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.disk.set(key, self.set_memory(key, value))
+
+    def set_memory(self, key, value):
+        """
+        Stores the value in memory only; returns its encoding, for `disk.set`.
+        """
+        encoded = json.dumps(value).encode("utf-8")
+        self.memory.set(key, encoded)
+        return encoded
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = sum(counts.values())
+        hits = counts["memory_hits"] + counts["disk_hits"]
+        return {
+            **counts,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "memory_bytes": self.memory.bytes_used,
+            "disk_bytes": self.disk.bytes_used,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_stage_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = StageCache(
+                path=Config.STAGE_CACHE_PATH,
+                memory_bytes=Config.STAGE_CACHE_MEMORY_BYTES,
+                disk_bytes=Config.STAGE_CACHE_DISK_BYTES,
+                ttl=Config.STAGE_CACHE_TTL,
+            )
+        return _cache
+
+
+def _lookup(key):
+    # The cache is best-effort: a failing lookup runs the stage instead of failing the request
+    try:
+        return get_stage_cache().get(key)
+    except Exception as e:
+        logging.warning(f"Stage cache lookup failed: {e}")
+        return None
+
+
+def _store(key, value):
+    # Losing an entry only costs a recomputation, while the paid result is already in hand
+    try:
+        get_stage_cache().set(key, value)
+    except Exception as e:
+        logging.warning(f"Stage cache write failed: {e}")
+
+
+async def _lookup_async(key):
+    # Only the in-memory LRU is read on the event loop: SQLite may wait on its lock for seconds
+    try:
+        cache = _cache or await asyncio.to_thread(get_stage_cache)
+        value = cache.get_memory(key)
+        if value is None:
+            value = await asyncio.to_thread(cache.get_disk, key)
+        return value
+    except Exception as e:
+        logging.warning(f"Stage cache lookup failed: {e}")
+        return None
+
+
+async def _store_async(key, value):
+    try:
+        cache = _cache or await asyncio.to_thread(get_stage_cache)
+        encoded = cache.set_memory(key, value)
+        await asyncio.to_thread(cache.disk.set, key, encoded)
+    except Exception as e:
+        logging.warning(f"Stage cache write failed: {e}")
+
+
+def cached_stage(stage, model, prompt_version, content_hash, compute):
+    """
+    Returns the cached result of a stage, or runs `compute` and caches what it returns.
+
+    Parameters:
+        stage (str): Name of the stage.
+        model (str): Model the stage calls.
+        prompt_version (int): Version of the stage prompt.
+        content_hash (str): Content hash of the stage input.
+        compute (callable): Zero-argument callable producing the stage result.
+    """
+    if not Config.STAGE_CACHE_ENABLED:
+        return compute()
+
+    key = make_key(stage, model, prompt_version, content_hash)
+    value = _lookup(key)
+    if value is not None:
+        logging.info(f"Stage cache hit: {stage}")
+        return value
+
+    value = compute()
+    _store(key, value)
+    return value
+
+
+async def cached_stage_async(stage, model, prompt_version, content_hash, compute):
+    """
+    Same as cached_stage, for an async `compute` returning an awaitable. The SQLite tier
+    is read and written in a thread.
+    """
+    if not Config.STAGE_CACHE_ENABLED:
+        return await compute()
+
+    key = make_key(stage, model, prompt_version, content_hash)
+    value = await _lookup_async(key)
+    if value is not None:
+        logging.info(f"Stage cache hit: {stage}")
+        return value
+
+    value = await compute()
+    await _store_async(key, value)
+    return value
+
+
+def cached(stage, model, prompt_version, key=hash_text):
+    """
+    Decorator caching a stage on the content hash of its first argument.
+
+    Parameters:
+        stage (str): Name of the stage.
+        model (str): Model the stage calls.
+        prompt_version (int): Version of the stage prompt.
+        key (callable): Maps the first argument to its content hash.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(value, *args, **kwargs):
+            return cached_stage(
+                stage,
+                model,
+                prompt_version,
+                key(value),
+                lambda: func(value, *args, **kwargs),
+            )
+
+        return wrapper
+
+    return decorator
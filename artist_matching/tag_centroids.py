@@ -0,0 +1,259 @@
+"""
+Tagging by nearest tag centroid, used instead of the generate_tags LLM call when
+TAGGING_ENGINE is "centroid".
+
+The centroid of a tag is the mean embedding of the ingested points carrying it.
+A text gets the tags whose centroid is closer to its embedding than the tag's
+threshold, calibrated on the same points to maximize F1. Since the text is
+embedded for the search anyway, tagging is a (1, dim) x (dim, tags) product.
+
+Centroids are stored in Qdrant, in the collection <collection>_tag_centroids, so
+every worker loads the same ones. Refresh them nightly (cron.yaml) or with:
+    python -m artist_matching.tag_centroids --refresh
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from qdrant_client.http import models
+
+from clients import get_qdrant_client
+from config import Config
+from artist_matching.embeddings import EMBEDDING_DIM, embed_texts
+from artist_matching.qdrant_handler import engine_collection
+
+CENTROIDS_SUFFIX = "_tag_centroids"
+
+
+class CentroidTagger:
+    def __init__(self, tags, centroids, thresholds):
+        """
+        Parameters:
+            tags (list): Names of the tags, in the order of the rows below.
+            centroids (np.ndarray): float32 array of shape (len(tags), dim), rows of unit length.
+            thresholds (np.ndarray): Minimum cosine similarity of each tag; inf for tags never assigned.
+        """
+        self.tags = list(tags)
+        self.centroids = centroids
+        self.thresholds = thresholds
+
+    def assign(self, vectors, top_k):
+        """
+        Tags each row of `vectors`: the tags above their threshold, at most `top_k` of them,
+        and at least the closest assignable one.
+        """
+        vectors = np.atleast_2d(vectors)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        scores = vectors @ self.centroids.T
+        # Rank by margin over the threshold, so tags with a strict threshold need a closer match
+        margins = scores - self.thresholds
+        order = np.argsort(-margins, axis=1)[:, :top_k]
+
+        assignable = np.isfinite(self.thresholds)
+        picked = []
+        for row_margins, row_order in zip(margins, order):
+            chosen = [self.tags[i] for i in row_order if row_margins[i] >= 0]
+            if not chosen and assignable.any():
+                chosen = [self.tags[row_order[0]]]
+            picked.append(chosen)
+        return picked
+
+
+def calibrate_threshold(scores, labels):
+    """
+    Returns the score threshold maximizing the F1 of `scores >= threshold` against `labels`.
+    """
+    order = np.argsort(-scores)
+    sorted_scores = scores[order]
+    true_positives = np.cumsum(labels[order])
+    predicted = np.arange(1, len(scores) + 1)
+    precision = true_positives / predicted
+    recall = true_positives / max(labels.sum(), 1)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+    return float(sorted_scores[int(np.argmax(f1))])
+
+
+def _scroll(qdrant_client, collection_name, batch_size):
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["tags"],
+            with_vectors=True,
+        )
+        if points:
+            vectors = np.asarray([point.vector for point in points], dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            yield vectors, [point.payload.get("tags") or [] for point in points]
+        if offset is None:
+            return
+
+
+def _labels(point_tags, tags):
+    index = {tag: i for i, tag in enumerate(tags)}
+    labels = np.zeros((len(point_tags), len(tags)), dtype=bool)
+    for row, names in enumerate(point_tags):
+        for name in names:
+            if name in index:
+                labels[row, index[name]] = True
+    return labels
+
+
+def compute_centroids(qdrant_client, collection_name, tags, min_samples, batch_size=512):
+    """
+    Computes the centroid and calibrated threshold of every tag from the points of a collection.
+
+    Two passes over the collection keep memory bounded: one sums the vectors of each tag,
+    the next scores every point against the centroids.
+
+    Returns:
+        tuple: centroids (len(tags), dim), thresholds (len(tags),) and point counts (len(tags),).
+    """
+    sums = np.zeros((len(tags), EMBEDDING_DIM), dtype=np.float64)
+    counts = np.zeros(len(tags), dtype=np.int64)
+    for vectors, point_tags in _scroll(qdrant_client, collection_name, batch_size):
+        labels = _labels(point_tags, tags)
+        sums += labels.T.astype(np.float64) @ vectors
+        counts += labels.sum(axis=0)
+
+    centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    scores = []
+    labels = []
+    for vectors, point_tags in _scroll(qdrant_client, collection_name, batch_size):
+        scores.append(vectors @ centroids.T)
+        labels.append(_labels(point_tags, tags))
+
+    thresholds = np.full(len(tags), np.inf, dtype=np.float32)
+    if scores:
+        scores = np.concatenate(scores)
+        labels = np.concatenate(labels)
+        for i in range(len(tags)):
+            # Too few examples give a centroid and threshold that are mostly noise
+            if counts[i] >= min_samples:
+                thresholds[i] = calibrate_threshold(scores[:, i], labels[:, i])
+    return centroids, thresholds, counts
+
+
+def save_centroids(qdrant_client, collection_name, tags, centroids, thresholds, counts):
+    target = collection_name + CENTROIDS_SUFFIX
+    if not qdrant_client.collection_exists(target):
+        qdrant_client.create_collection(
+            collection_name=target,
+            vectors_config=models.VectorParams(size=centroids.shape[1], distance=models.Distance.COSINE),
+        )
+    computed_at = time.time()
+    qdrant_client.upsert(
+        collection_name=target,
+        points=[
+            models.PointStruct(
+                id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"tag:{tag}")),
+                vector=centroid.tolist(),
+                payload={
+                    "tag": tag,
+                    # JSON has no infinity; a missing threshold marks a tag that is never assigned
+                    "threshold": float(threshold) if np.isfinite(threshold) else None,
+                    "count": int(count),
+                    "computed_at": computed_at,
+                },
+            )
+            for tag, centroid, threshold, count in zip(tags, centroids, thresholds, counts)
+        ],
+    )
+
+
+def load_centroids(qdrant_client, collection_name, tags):
+    """
+    Returns the stored CentroidTagger of a collection, or None if the centroids were never computed.
+    """
+    target = collection_name + CENTROIDS_SUFFIX
+    if not qdrant_client.collection_exists(target):
+        return None
+
+    points, _ = qdrant_client.scroll(collection_name=target, limit=len(tags) * 2, with_vectors=True)
+    stored = {point.payload["tag"]: point for point in points}
+    if not stored:
+        return None
+
+    centroids = np.zeros((len(tags), EMBEDDING_DIM), dtype=np.float32)
+    thresholds = np.full(len(tags), np.inf, dtype=np.float32)
+    for i, tag in enumerate(tags):
+        point = stored.get(tag)
+        if point is not None and point.payload.get("threshold") is not None:
+            centroids[i] = point.vector
+            thresholds[i] = point.payload["threshold"]
+    return CentroidTagger(tags, centroids, thresholds)
+
+
+def refresh_tag_centroids(collection_name=None):
+    """
+    Recomputes and stores the centroids of a collection; run nightly by the job queue.
+    """
+    # Imported here: converters imports this module
+    from artist_matching.converters import TAGS
+
+    collection_name = engine_collection(collection_name or os.getenv("QDRANT_INDEX_NAME"))
+    qdrant_client = get_qdrant_client()
+    centroids, thresholds, counts = compute_centroids(
+        qdrant_client, collection_name, TAGS, Config.TAG_CENTROIDS_MIN_SAMPLES
+    )
+    save_centroids(qdrant_client, collection_name, TAGS, centroids, thresholds, counts)
+    logging.info(
+        f"Refreshed tag centroids of {collection_name}: "
+        + ", ".join(f"{tag}={count}" for tag, count in zip(TAGS, counts))
+    )
+    _loaded.clear()
+    return {tag: int(count) for tag, count in zip(TAGS, counts)}
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def get_centroid_tagger(collection_name, tags):
+    """
+    Returns the CentroidTagger of a collection, reloaded from Qdrant every TAG_CENTROIDS_RELOAD seconds.
+    """
+    with _loaded_lock:
+        loaded_at, tagger = _loaded.get(collection_name, (0, None))
+        if time.monotonic() - loaded_at > Config.TAG_CENTROIDS_RELOAD:
+            try:
+                tagger = load_centroids(get_qdrant_client(), collection_name, tags)
+            except Exception as e:
+                logging.error(f"Failed to load the tag centroids of {collection_name}: {e}")
+            _loaded[collection_name] = (time.monotonic(), tagger)
+        return tagger
+
+
+def centroid_tags(texts, tags, collection_name=None):
+    """
+    Tags each text by its nearest centroids. Returns None when no centroids are stored yet.
+    """
+    collection_name = engine_collection(collection_name or os.getenv("QDRANT_INDEX_NAME"))
+    tagger = get_centroid_tagger(collection_name, tags)
+    if tagger is None:
+        return None
+    # The same text is embedded for the search, so this is usually a cache hit
+    return tagger.assign(embed_texts(texts), Config.TAG_CENTROIDS_TOP_K)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tag centroid utilities")
+    parser.add_argument("--refresh", action="store_true", help="Recompute and store the tag centroids")
+    parser.add_argument("--collection", default=os.getenv("QDRANT_INDEX_NAME"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.refresh:
+        print(refresh_tag_centroids(args.collection))
+
+
+if __name__ == "__main__":
+    main()
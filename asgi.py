@@ -0,0 +1,432 @@
+"""
+Async serving mode.
+
+Serves the same routes and responses as app.py on an ASGI server:
+    hypercorn asgi:app --workers 2 --bind 0.0.0.0:$PORT
+
+The recommendation path awaits httpx (Kindo, Whisper), AsyncInferenceClient,
+AsyncQdrantClient and Motor instead of blocking a worker thread, so one worker
+keeps hundreds of /upload requests in flight. Firebase Storage has no async
+client and runs in a thread; /save jobs still run on the job queue of app.py.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, Response, g, jsonify, request
+
+import app as wsgi
+from artist_matching.converters import analyze_async, transcribe_audio_async, transcribe_image_async
+from artist_matching.dedup import duplicate_query
+from artist_matching.neighbours import lookup_query
+from artist_matching.qdrant_handler import search_vectorstore_async, search_vectorstore_batch_async
+from clients import registry
+from config import Config
+from job_queue import QueueFullError
+from metrics import current_trace, metrics, server_timing, timed
+from progress import TooManyTasksError
+
+app = Quart(__name__)
+app.config["MAX_CONTENT_LENGTH"] = Config.MAX_UPLOAD_BYTES
+
+mongo_db = AsyncIOMotorClient(Config.MONGO_URI).get_default_database()
+
+
+def too_many(message):
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = str(Config.JOB_RETRY_AFTER)
+    return response, 429
+
+
+# Signup API
+@app.route("/api/signup", methods=["POST"])
+async def signup():
+    data = await request.get_json()
+    if await mongo_db.users.find_one({"username": data["username"]}):
+        return jsonify(success=False, message="User already exists"), 400
+
+    # bcrypt is deliberately slow; keep it off the event loop
+    hashed_password = (await asyncio.to_thread(wsgi.bcrypt.generate_password_hash, data["password"])).decode("utf-8")
+    user_data = {
+        "username": data["username"],
+        "name": data["name"],
+        "password": hashed_password,
+    }
+    await mongo_db.users.insert_one(user_data)
+    return jsonify(success=True, message="Signup successful"), 201
+
+
+# Login API
+@app.route("/api/login", methods=["POST"])
+async def login():
+    data = await request.get_json()
+    user = await mongo_db.users.find_one({"username": data["username"]})
+
+    if user and await asyncio.to_thread(wsgi.bcrypt.check_password_hash, user["password"], data["password"]):
+        return jsonify(success=True, message="Login successful"), 200
+
+    return jsonify(success=False, message="Invalid credentials"), 401
+
+
+@app.before_request
+async def start_trace():
+    g.trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.trace_start = time.perf_counter()
+    g.trace_token = current_trace.set([])
+
+
+@app.after_request
+async def finish_trace(response):
+    trace = current_trace.get()
+    elapsed = time.perf_counter() - g.trace_start
+    metrics.observe(f"request.{wsgi.route_name(request.endpoint)}", elapsed, error=response.status_code >= 500)
+    current_trace.reset(g.trace_token)
+
+    if Config.SERVER_TIMING:
+        response.headers["X-Request-ID"] = g.trace_id
+        response.headers["Server-Timing"] = server_timing(trace + [("total", elapsed)])
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    return Response(wsgi.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/healthz", methods=["GET"])
+async def healthz():
+    status = await asyncio.to_thread(wsgi.bootstrap.run)
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@app.route("/stats/clients", methods=["GET"])
+async def client_stats():
+    return jsonify(registry.stats()), 200
+
+
+@app.route("/stats/cache", methods=["GET"])
+async def cache_stats():
+    return jsonify(wsgi.get_cache_stats()), 200
+
+
+async def hydrate_results(points):
+    """
+    Same as app.hydrate_results, on Motor.
+    """
+    missing = wsgi.missing_artists(points)
+    artists = {}
+    if missing:
+        with timed("mongo.hydrate"):
+            async for media in mongo_db.media.find({"url": {"$in": missing}}):
+                artists[media["url"]] = media
+    return wsgi.format_results(points, artists)
+
+
+@app.route("/save", methods=["POST"])
+async def save_file():
+    """
+    Same as app.save_file: stores the file and queues its processing on the job queue.
+    """
+    # Reading and hashing the whole payload would block the event loop
+    media, error = await asyncio.to_thread(wsgi.parse_save_form, await request.files, await request.form)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    if Config.DEDUP_ENABLED:
+        with timed("mongo.dedup"):
+            duplicate = await mongo_db.media.find_one(duplicate_query(media.content_hash))
+        if duplicate is not None:
+            return jsonify(wsgi.duplicate_response(duplicate)), 200
+
+    try:
+        # Same order as app.save_file: no blob for a rejected request
+        await asyncio.to_thread(wsgi.job_queue.check_capacity)
+        input_media_url = await asyncio.to_thread(wsgi.upload_media, media)
+        job_id = await asyncio.to_thread(
+            wsgi.job_queue.submit,
+            "save_media",
+            wsgi.save_job_payload(media, input_media_url, await request.form),
+        )
+    except QueueFullError:
+        return too_many("Too many pending uploads, try again later")
+
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def job_status(job_id):
+    job = await asyncio.to_thread(wsgi.job_queue.get, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+
+@app.route("/tasks/refresh_tag_centroids", methods=["GET"])
+async def refresh_tag_centroids_task():
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        job_id = await asyncio.to_thread(wsgi.job_queue.submit, "refresh_tag_centroids", {})
+    except QueueFullError:
+        return jsonify({"error": "Job queue is full"}), 503
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route("/tasks/refresh_neighbours", methods=["GET"])
+async def refresh_neighbours_task():
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        job_id = await asyncio.to_thread(wsgi.job_queue.submit, "refresh_neighbours", {})
+    except QueueFullError:
+        return jsonify({"error": "Job queue is full"}), 503
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route("/recommendations", methods=["GET"])
+async def recommendations():
+    url = request.args.get("url")
+    point_id = request.args.get("id")
+    document = None
+    if url or point_id:
+        document = await mongo_db.neighbours.find_one(lookup_query(url, point_id))
+    if document is None:
+        # Not computed yet (or an invalid request, reported below): computed on the blocking store
+        body, error = await asyncio.to_thread(wsgi.find_recommendations, request.args, wsgi.neighbour_store.get)
+    else:
+        body, error = wsgi.find_recommendations(request.args, lambda url, point_id: document)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    return jsonify(body), 200
+
+
+async def transcribe(report, media, upload):
+    if media.media_type == "audio":
+        # Transcription needs only the bytes, so it overlaps with the upload
+        source = await transcribe_audio_async(media.data, content_hash=media.content_hash)
+    elif media.media_type == "image" and Config.PREPROCESS_MEDIA:
+        # The downscaled image is sent inline, so this too overlaps with the upload
+        source = await transcribe_image_async(media.data, content_hash=media.content_hash)
+    elif media.media_type == "image":
+        # The vision model reads the image from its URL
+        source = await transcribe_image_async(await upload, content_hash=media.content_hash)
+    else:
+        return media.data.decode("utf-8", errors="replace")
+    report("transcription", {"transcription": source})
+    return source
+
+
+async def save_query(query):
+    """
+    Same as app.save_query, on Motor.
+    """
+    query["query_token"] = uuid.uuid4().hex
+    with timed("mongo.queries"):
+        await mongo_db.queries.insert_one(wsgi.query_document(query))
+    return query
+
+
+async def load_query(token):
+    with timed("mongo.queries"):
+        return await mongo_db.queries.find_one({"_id": token}, wsgi.QUERY_PROJECTION)
+
+
+async def settle(*tasks):
+    """
+    Cancels the given tasks (None is skipped) and waits for them, so that a failed stage
+    leaves none running or with an exception nobody retrieved.
+    """
+    tasks = [task for task in tasks if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def upload_input(report, media):
+    input_media_url = await asyncio.to_thread(wsgi.upload_media, media)
+    report("upload", {"input_media_url": input_media_url})
+    return input_media_url
+
+
+async def run_upload(
+    report,
+    return_type,
+    media=None,
+    text=None,
+    query=None,
+    k=5,
+    offset=0,
+    min_score=None,
+):
+    """
+    Same as app.run_upload, with the stages awaited instead of run on threads.
+    """
+    upload = None
+    search = None
+    try:
+        if query is None:
+            if media is not None:
+                media_type = media.media_type
+                upload = asyncio.ensure_future(upload_input(report, media))
+                source = await transcribe(report, media, upload)
+            else:
+                media_type = "text"
+                source = text
+
+            analysis = await analyze_async(source, media_type)
+            report("description", {"description": analysis["description"]})
+            report(
+                "tags",
+                {"generic_description": analysis["generic_description"], "tags": analysis["tags"]},
+            )
+        else:
+            analysis = query
+
+        # The search starts while the input media may still be uploading
+        search = asyncio.ensure_future(
+            search_vectorstore_async(
+                text=analysis["generic_description"],
+                type=return_type,
+                tags=analysis["tags"],
+                collection_name=os.getenv("QDRANT_INDEX_NAME"),
+                limit=k,
+                offset=offset,
+                score_threshold=min_score,
+            )
+        )
+        if query is None:
+            input_media_url = await upload if upload is not None else None
+            query = await save_query(
+                {
+                    "generic_description": analysis["generic_description"],
+                    "tags": analysis["tags"],
+                    "input_media_url": input_media_url,
+                }
+            )
+        urls = await hydrate_results(await search)
+    finally:
+        await settle(upload, search)
+
+    response = {
+        "return_type": return_type,
+        "urls": urls,
+        "query_token": query["query_token"],
+    }
+    if query.get("input_media_url") is not None:
+        response["input_media_url"] = query["input_media_url"]
+
+    report("results", response)
+    return response
+
+
+@app.route("/upload", methods=["POST"])
+async def upload_file():
+    """
+    Same parameters and responses as app.upload_file.
+    """
+    form = await request.form
+    query_token = form.get("query_token")
+    query = await load_query(query_token) if query_token else None
+    pipeline_args, error = await asyncio.to_thread(
+        wsgi.parse_upload_form, await request.files, form, lambda token: query
+    )
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    if form.get("async") == "true":
+        try:
+            request_id = wsgi.upload_tracker.start_async(run_upload, **pipeline_args)
+        except TooManyTasksError:
+            return too_many("Too many pending requests, try again later")
+        return jsonify({"request_id": request_id}), 202
+
+    return jsonify(await run_upload(lambda stage, data: None, **pipeline_args))
+
+
+async def analyze_input(media=None, text=None):
+    """
+    Same as app.analyze_input, with the stages awaited.
+    """
+    report = lambda stage, data: None
+    upload = None
+    if media is not None:
+        upload = asyncio.ensure_future(upload_input(report, media))
+        try:
+            source = await transcribe(report, media, upload)
+            analysis = await analyze_async(source, media.media_type)
+            input_media_url = await upload
+        finally:
+            await settle(upload)
+    else:
+        analysis = await analyze_async(text, "text")
+        input_media_url = None
+    return await save_query(
+        {
+            "generic_description": analysis["generic_description"],
+            "tags": analysis["tags"],
+            "input_media_url": input_media_url,
+        }
+    )
+
+
+async def analyze_batch_item(item):
+    if "error" in item:
+        return item["error"]
+    try:
+        return await analyze_input(item.get("media"), item.get("text"))
+    except Exception as e:
+        logging.error(f"Batch input failed: {e}")
+        return str(e)
+
+
+@app.route("/upload/batch", methods=["POST"])
+async def upload_batch():
+    """
+    Same parameters and responses as app.upload_batch.
+    """
+    batch_args, error = await asyncio.to_thread(wsgi.parse_batch_form, await request.files, await request.form)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    return_types = batch_args["return_types"]
+    outcomes = await asyncio.gather(*(analyze_batch_item(item) for item in batch_args["items"]))
+    queries = wsgi.batch_queries(
+        outcomes, return_types, batch_args["k"], batch_args["offset"], batch_args["min_score"]
+    )
+    points = await search_vectorstore_batch_async(queries, os.getenv("QDRANT_INDEX_NAME")) if queries else []
+    urls = await hydrate_results([point for hits in points for point in hits])
+    return jsonify(wsgi.batch_response(outcomes, return_types, points, urls))
+
+
+@app.route("/upload/<request_id>", methods=["GET"])
+async def upload_status(request_id):
+    task = wsgi.upload_tracker.get(request_id)
+    if task is None:
+        return jsonify({"error": "Request not found"}), 404
+    return jsonify(task), 200
+
+
+@app.route("/upload/<request_id>/events", methods=["GET"])
+async def upload_events(request_id):
+    if wsgi.upload_tracker.get(request_id) is None:
+        return jsonify({"error": "Request not found"}), 404
+
+    async def stream():
+        async for event in wsgi.upload_tracker.follow_async(request_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event['stage']}\ndata: {json.dumps(event['data'])}\n\n"
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Quart otherwise cuts streamed responses after RESPONSE_TIMEOUT
+    response.timeout = None
+    return response
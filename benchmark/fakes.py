@@ -0,0 +1,292 @@
+"""
+In-process stand-ins for the external services used by the app.
+
+Every fake sleeps for a configurable latency, fails at a configurable rate and
+records how long each call took, so the benchmark can report per-stage percentiles
+without any network access.
+"""
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+
+TAGS = ["Joy", "Sorrow", "Love", "Fear", "Hope", "Anger", "Longing", "Freedom", "Conflict", "Gratitude"]
+
+# Mean latency in seconds and error rate of each service, roughly matching production
+DEFAULT_PROFILES = {
+    "kindo": {"latency": 2.0, "error_rate": 0.0},
+    "whisper": {"latency": 3.0, "error_rate": 0.0},
+    "vision": {"latency": 4.0, "error_rate": 0.0},
+    "embedding": {"latency": 0.3, "error_rate": 0.0},
+    "qdrant": {"latency": 0.05, "error_rate": 0.0},
+    "mongo": {"latency": 0.03, "error_rate": 0.0},
+    "firebase": {"latency": 0.5, "error_rate": 0.0},
+}
+
+
+class FakeServiceError(Exception):
+    """
+    Injected failure, shaped like an HTTP 503 so the client retries it.
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.response = SimpleNamespace(status_code=503, headers={})
+
+
+class Recorder:
+    """
+    Thread-safe collection of call durations and errors per stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, stage, seconds, error=False):
+        with self._lock:
+            self.samples[stage].append(seconds)
+            if error:
+                self.errors[stage] += 1
+
+    def summary(self):
+        with self._lock:
+            stages = sorted(set(self.samples) | set(self.errors))
+            summary = {}
+            for stage in stages:
+                samples = np.asarray(self.samples[stage])
+                summary[stage] = {
+                    "count": len(samples),
+                    "errors": self.errors[stage],
+                    "p50": float(np.percentile(samples, 50)) if len(samples) else 0.0,
+                    "p95": float(np.percentile(samples, 95)) if len(samples) else 0.0,
+                    "p99": float(np.percentile(samples, 99)) if len(samples) else 0.0,
+                }
+            return summary
+
+
+recorder = Recorder()
+
+
+class Service:
+    """
+    Latency and error injection for one fake service.
+    """
+
+    def __init__(self, name, latency, error_rate, jitter=0.25):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.jitter = jitter
+
+    def call(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            time.sleep(max(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter), 0))
+            if random.random() < self.error_rate:
+                raise FakeServiceError(f"Injected {self.name} failure")
+            result = func(*args, **kwargs)
+        except Exception:
+            recorder.record(stage, time.perf_counter() - start, error=True)
+            raise
+        recorder.record(stage, time.perf_counter() - start)
+        return result
+
+
+def build_services(profiles, latency_scale=1.0):
+    return {
+        name: Service(name, profile["latency"] * latency_scale, profile["error_rate"])
+        for name, profile in profiles.items()
+    }
+
+
+class FakeHTTPResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+        self.content = self.text.encode("utf-8")
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise FakeServiceError(f"HTTP {self.status_code}")
+
+
+def fake_kindo_api(service):
+    """
+    The real KindoAPI, retries and circuit breaker included, with only the HTTP attempt faked.
+    """
+    from kindo_api import KindoAPI
+
+    class FakeKindoAPI(KindoAPI):
+        def __init__(self):
+            super().__init__("benchmark")
+
+        def _post(self, headers, data, timeout):
+            return service.call("kindo", self._respond, data["messages"][0]["content"], data)
+
+        def _respond(self, prompt, data):
+            tags = random.sample(TAGS, 2)
+            if data.get("response_format"):
+                content = json.dumps(
+                    {
+                        "description": f"A description of {prompt[-40:]}",
+                        "generic_description": f"A generic description of {prompt[-40:]}",
+                        "tags": tags,
+                    }
+                )
+            elif "comma separated" in prompt:
+                content = ", ".join(tags)
+            else:
+                content = f"A description of {prompt[-40:]}"
+            return FakeHTTPResponse(200, {"choices": [{"message": {"content": content}}]})
+
+    return FakeKindoAPI()
+
+
+class FakeWhisperSession:
+    """
+    Stands in for the shared requests.Session; the Whisper endpoint posts through it
+    and saved audio is fetched back from storage with it.
+    """
+
+    # No connection pools to report on /stats/clients and /metrics
+    adapters = {}
+
+    def __init__(self, service, storage=None):
+        self.service = service
+        self.storage = storage
+
+    def get(self, url, **kwargs):
+        return self.storage.call("firebase.download", lambda: FakeHTTPResponse(200, {"url": url}))
+
+    def post(self, url, headers=None, data=None, **kwargs):
+        return self.service.call(
+            "whisper", lambda: FakeHTTPResponse(200, {"text": f"lyrics of {len(data or b'')} bytes"})
+        )
+
+
+class FakeInferenceClient:
+    def __init__(self, service):
+        self.service = service
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, max_tokens, **kwargs):
+        return self.service.call("vision", self._respond, messages)
+
+    def _respond(self, messages):
+        image_url = messages[0]["content"][1]["image_url"]["url"]
+        message = SimpleNamespace(content=f"An image found at {image_url[:80]}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeEmbedModel:
+    def __init__(self, service, dim=1536):
+        self.service = service
+        self.dim = dim
+
+    def get_text_embedding_batch(self, texts):
+        return self.service.call("embedding", lambda: [self._embed(text) for text in texts])
+
+    def get_text_embedding(self, text):
+        return self.get_text_embedding_batch([text])[0]
+
+    def _embed(self, text):
+        rng = np.random.default_rng(abs(hash(text)) % 2**32)
+        return rng.standard_normal(self.dim).tolist()
+
+
+class TimedProxy:
+    """
+    Wraps an object so that the listed methods go through a fake service.
+    """
+
+    def __init__(self, target, service, methods, prefix, lock=None):
+        self._target = target
+        self._service = service
+        self._methods = methods
+        self._prefix = prefix
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name in self._methods and callable(attribute):
+            return lambda *args, **kwargs: self._service.call(
+                f"{self._prefix}.{name}", self._locked(attribute), *args, **kwargs
+            )
+        return attribute
+
+    def _locked(self, func):
+        if self._lock is None:
+            return func
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return func(*args, **kwargs)
+
+        return call
+
+
+QDRANT_METHODS = {
+    "search", "search_batch", "query_points", "query_batch_points", "upsert", "retrieve", "scroll",
+    "get_collection", "get_collections", "create_collection", "create_payload_index",
+}
+MONGO_METHODS = {"find", "find_one", "insert_one", "insert_many", "update_one"}
+
+
+def fake_qdrant_client(service):
+    from qdrant_client import QdrantClient
+
+    # The local client is not thread-safe; the lock is taken after the simulated latency
+    return TimedProxy(QdrantClient(":memory:"), service, QDRANT_METHODS, "qdrant", lock=threading.Lock())
+
+
+class FakeMongoDatabase:
+    def __init__(self, database, service):
+        self._database = database
+        self._service = service
+
+    def __getattr__(self, name):
+        return TimedProxy(self._database[name], self._service, MONGO_METHODS, f"mongo.{name}")
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def fake_pymongo_class(service):
+    import mongomock
+
+    class FakePyMongo:
+        def __init__(self, app=None, *args, **kwargs):
+            self.cx = mongomock.MongoClient()
+            self.db = FakeMongoDatabase(self.cx["artist-recommendation"], service)
+
+    return FakePyMongo
+
+
+def fake_firebase_handler_class(service):
+    import os
+
+    class FakeFirebaseHandler:
+        def __init__(self, firebase_cred_path=None, firebase_bucket_name=None):
+            pass
+
+        def upload_to_firebase(self, file_name, file_path):
+            return service.call("firebase.upload", lambda: f"https://storage.example/{file_name}")
+
+        def upload_bytes(self, file_name, data, content_type=None, chunk_size=None):
+            return service.call("firebase.upload", lambda: f"https://storage.example/{file_name}")
+
+        def delete_local_file(self, file_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    return FakeFirebaseHandler
@@ -0,0 +1,186 @@
+"""
+Offline load test of /upload and /save.
+
+Replaces Kindo, Whisper, the vision model, OpenAI embeddings, Qdrant, MongoDB and
+Firebase with the in-process fakes of benchmark/fakes.py, drives the Flask app with
+concurrent requests and reports p50/p95/p99 per stage plus throughput.
+
+Usage (from the repository root):
+    python -m benchmark.run --requests 200 --concurrency 16 --latency-scale 0.05
+    python -m benchmark.run --endpoint save --error-rate kindo=0.05 --json results.json
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import fakes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def install_fakes(services):
+    """
+    Patches the service clients before the app is imported. Must run first.
+    """
+    import flask_pymongo
+    import firebase_handler
+    import clients
+
+    flask_pymongo.PyMongo = fakes.fake_pymongo_class(services["mongo"])
+    firebase_handler.FirebaseHandler = fakes.fake_firebase_handler_class(services["firebase"])
+
+    # The registry hands out whatever was registered first, so the app never builds a real client
+    clients.registry.get("http_session", lambda: fakes.FakeWhisperSession(services["whisper"], services["firebase"]))
+    clients.registry.get("kindo", lambda: fakes.fake_kindo_api(services["kindo"]))
+    clients.registry.get("huggingface", lambda: fakes.FakeInferenceClient(services["vision"]))
+    clients.registry.get("openai_embedding", lambda: fakes.FakeEmbedModel(services["embedding"]))
+    clients.registry.get("qdrant", lambda: fakes.fake_qdrant_client(services["qdrant"]))
+
+
+def seed_collection(points):
+    from artist_matching.qdrant_handler import add_many_to_vectorstore
+
+    items = [
+        {
+            "text": f"seed artwork {i}",
+            "tags": random.sample(fakes.TAGS, 2),
+            "type": random.choice(["audio", "image"]),
+            "url": f"https://storage.example/seed-{i}",
+            "artist": {"name": f"Artist {i}", "email": f"artist{i}@example.com"},
+        }
+        for i in range(points)
+    ]
+    for start in range(0, len(items), 256):
+        add_many_to_vectorstore(items[start : start + 256])
+
+
+def upload_request(client, i):
+    form = {"return_type": random.choice(["audio", "image"]), "user_id": "benchmark"}
+    kind = random.choice(["text", "audio", "image"])
+    if kind == "text":
+        form["text"] = f"A quiet evening by the sea, request {i}"
+    else:
+        extension = "mp3" if kind == "audio" else "png"
+        form["file"] = (io.BytesIO(f"{kind} payload {i}".encode("utf-8")), f"bench-{i}.{extension}")
+
+    response = client.post("/upload", data=form, content_type="multipart/form-data")
+    return response.status_code == 200
+
+
+def save_request(client, i, poll_interval):
+    extension = random.choice(["mp3", "png"])
+    form = {
+        "user_id": "benchmark",
+        "artist_name": f"Artist {i}",
+        "file": (io.BytesIO(f"payload {i}".encode("utf-8")), f"bench-save-{i}.{extension}"),
+    }
+    response = client.post("/save", data=form, content_type="multipart/form-data")
+    if response.status_code != 202:
+        return False
+
+    # A save is only done once its background job finished
+    job_id = response.get_json()["job_id"]
+    while True:
+        status = client.get(f"/jobs/{job_id}").get_json()["status"]
+        if status in ["done", "failed"]:
+            return status == "done"
+        time.sleep(poll_interval)
+
+
+def run_load(app, endpoint, requests, concurrency, poll_interval):
+    def one(i):
+        client = app.test_client()
+        start = time.perf_counter()
+        try:
+            if endpoint == "upload":
+                ok = upload_request(client, i)
+            else:
+                ok = save_request(client, i, poll_interval)
+        except Exception:
+            ok = False
+        fakes.recorder.record(f"{endpoint}.total", time.perf_counter() - start, error=not ok)
+        return ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    return sum(results), time.perf_counter() - start
+
+
+def print_report(summary, succeeded, requests, elapsed):
+    print(f"{'stage':<28}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in summary.items():
+        print(
+            f"{stage:<28}{stats['count']:>8}{stats['errors']:>8}"
+            f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}"
+        )
+    print(f"\n{succeeded}/{requests} succeeded in {elapsed:.2f}s, {succeeded / elapsed:.2f} requests/s")
+
+
+def parse_overrides(values):
+    overrides = {}
+    for value in values or []:
+        name, _, number = value.partition("=")
+        overrides[name] = float(number)
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of /upload and /save")
+    parser.add_argument("--endpoint", choices=["upload", "save"], default="upload")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed-points", type=int, default=1000, help="Points stored in the fake Qdrant before the run")
+    parser.add_argument("--latency-scale", type=float, default=0.05, help="Multiplier applied to every fake latency")
+    parser.add_argument("--latency", action="append", help="Override a mean latency in seconds, e.g. kindo=1.5")
+    parser.add_argument("--error-rate", action="append", help="Override an error rate, e.g. whisper=0.1")
+    parser.add_argument("--cache", action="store_true", help="Keep the stage cache enabled")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--json", help="Write the per-stage summary to this file")
+    args = parser.parse_args()
+
+    profiles = {name: dict(profile) for name, profile in fakes.DEFAULT_PROFILES.items()}
+    for name, latency in parse_overrides(args.latency).items():
+        profiles[name]["latency"] = latency
+    for name, error_rate in parse_overrides(args.error_rate).items():
+        profiles[name]["error_rate"] = error_rate
+
+    # The app keeps its scratch files relative to the working directory; keep them out of the repo
+    workdir = tempfile.mkdtemp(prefix="artist-benchmark-")
+    os.chdir(workdir)
+    os.environ["QDRANT_INDEX_NAME"] = "benchmark"
+    os.environ["STAGE_CACHE_ENABLED"] = "True" if args.cache else "False"
+    os.environ["STAGE_CACHE_PATH"] = os.path.join(workdir, "stage_cache.sqlite3")
+    os.environ.setdefault("JOB_BACKOFF_BASE", "0.1")
+    sys.path.insert(0, REPO_ROOT)
+
+    services = fakes.build_services(profiles, args.latency_scale)
+    install_fakes(services)
+
+    import app
+
+    seed_collection(args.seed_points)
+    fakes.recorder.samples.clear()
+    fakes.recorder.errors.clear()
+
+    succeeded, elapsed = run_load(app.app, args.endpoint, args.requests, args.concurrency, args.poll_interval)
+    summary = fakes.recorder.summary()
+    print_report(summary, succeeded, args.requests, elapsed)
+
+    if args.json:
+        with open(os.path.join(REPO_ROOT, args.json) if not os.path.isabs(args.json) else args.json, "w") as file:
+            json.dump(
+                {"succeeded": succeeded, "requests": args.requests, "elapsed": elapsed, "stages": summary},
+                file,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# bootstrap.py
+import threading
+import time
+import logging
+
+from metrics import timed
+
+
+class Bootstrap:
+    """
+    Setup and readiness checks of a worker, run when it starts and reported by /healthz.
+
+    A check registered with `once=True` (schema setup) is kept once it has succeeded,
+    for the life of the process; a failed one is retried by the next `run`. Other
+    checks are evaluated on every `run`.
+    """
+
+    def __init__(self):
+        self._checks = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, func, once=True):
+        """
+        Parameters:
+            name (str): Name of the check, as reported by `status`.
+            func (callable): Zero-argument callable raising when the check fails.
+            once (bool): Skip the check after its first success.
+        """
+        self._checks[name] = (func, once)
+
+    def run(self):
+        """
+        Runs the checks still to be run and returns the status.
+        """
+        with self._lock:
+            for name, (func, once) in self._checks.items():
+                if once and self._results.get(name, {}).get("ok"):
+                    continue
+                start = time.perf_counter()
+                try:
+                    with timed(f"bootstrap.{name}"):
+                        func()
+                    result = {"ok": True}
+                except Exception as e:
+                    logging.error(f"Bootstrap check {name} failed: {e}")
+                    result = {"ok": False, "error": str(e)}
+                result["seconds"] = round(time.perf_counter() - start, 3)
+                self._results[name] = result
+        return self.status()
+
+    def status(self):
+        with self._lock:
+            results = {name: dict(result) for name, result in self._results.items()}
+        return {
+            "ready": len(results) == len(self._checks) and all(result["ok"] for result in results.values()),
+            "checks": results,
+        }
@@ -0,0 +1,245 @@
+"""
+Bulk ingest of artwork into MongoDB and the Qdrant vectorstore.
+
+Walks a directory of media files, or reads a JSONL manifest with one work per line:
+
+    {"path": "data/audio/song.mp3", "artist_name": "...", "email": "...", "portfolio_url": "...", "title": "..."}
+
+Every file goes through the same stages as /save (Firebase upload, transcription,
+analysis). Each stage has its own concurrency limit,
+and finished works are written to Qdrant and MongoDB in batches. Processed paths are
+appended to a checkpoint file after each batch, so an interrupted run can be resumed.
+
+Usage:
+    python bulk_ingest.py --dir data/audio --artist-name "..." --email "..."
+    python bulk_ingest.py --manifest works.jsonl --checkpoint ingest.checkpoint
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pymongo import MongoClient, UpdateOne
+from werkzeug.utils import secure_filename
+
+from config import Config
+from firebase_handler import FirebaseHandler
+from media_io import blob_name
+from utility import determine_media_type
+from artist_matching.converters import transcribe_audio, transcribe_image, analyze
+from artist_matching.dedup import dedup_fields, perceptual_hash
+from artist_matching.qdrant_handler import add_many_to_vectorstore
+from artist_matching.stage_cache import hash_file
+
+STAGES = ["upload", "transcribe", "analysis"]
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def walk_directory(directory, defaults):
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            yield {**defaults, "path": os.path.join(root, name)}
+
+
+def read_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, "r") as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+class BulkIngest:
+    def __init__(self, firebase_handler, media_collection, stage_limits, batch_size, checkpoint_path):
+        """
+        Parameters:
+            firebase_handler (FirebaseHandler): Handler used to upload the originals.
+            media_collection (Collection): MongoDB collection receiving the artist metadata.
+            stage_limits (dict): Maximum number of concurrent calls per stage.
+            batch_size (int): Number of works per Qdrant / MongoDB write.
+            checkpoint_path (str): File listing the paths already ingested.
+        """
+        self.firebase_handler = firebase_handler
+        self.media_collection = media_collection
+        self.stage_limits = {stage: threading.BoundedSemaphore(stage_limits[stage]) for stage in STAGES}
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self.ingested = 0
+        self.failed = 0
+
+    def stage(self, name, func, *args, **kwargs):
+        with self.stage_limits[name]:
+            return func(*args, **kwargs)
+
+    def process(self, work):
+        path = work["path"]
+        media_type = determine_media_type(path)
+        if media_type not in ["audio", "image"]:
+            raise ValueError(f"Unsupported media type: {path}")
+
+        content_hash = hash_file(path)
+        # Same name as /save gives it, so files sharing a basename do not overwrite each other
+        url = self.stage(
+            "upload",
+            self.firebase_handler.upload_to_firebase,
+            blob_name(content_hash, secure_filename(os.path.basename(path))),
+            path,
+        )
+        if media_type == "audio":
+            transcription = self.stage("transcribe", transcribe_audio, path)
+        elif Config.PREPROCESS_MEDIA:
+            # The image is sent inline; read it from disk rather than downloading it back
+            with open(path, "rb") as file:
+                image = file.read()
+            transcription = self.stage("transcribe", transcribe_image, image, content_hash=content_hash)
+        else:
+            transcription = self.stage("transcribe", transcribe_image, url, content_hash=content_hash)
+
+        analysis = self.stage("analysis", analyze, transcription, media_type)
+
+        artist = {
+            "name": work.get("artist_name"),
+            "email": work.get("email"),
+            "portfolio_url": work.get("portfolio_url"),
+            "title": work.get("title"),
+        }
+        phash = None
+        if Config.DEDUP_ENABLED:
+            with open(path, "rb") as file:
+                phash = perceptual_hash(media_type, file.read())
+        return {
+            "path": path,
+            "point": {
+                "text": analysis["generic_description"],
+                "tags": analysis["tags"],
+                "type": media_type,
+                "url": url,
+                "artist": artist,
+                "content_hash": content_hash,
+            },
+            # Indexed so that /save recognizes these works when they are uploaded again
+            "metadata": {"url": url, **artist, **dedup_fields(media_type, content_hash, phash)},
+        }
+
+    def add(self, result):
+        with self._lock:
+            self._pending.append(result)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+
+        add_many_to_vectorstore([result["point"] for result in batch])
+        # Upserted, so resuming after a partly written batch does not store a work twice
+        self.media_collection.bulk_write(
+            [
+                UpdateOne({"content_hash": result["metadata"]["content_hash"]}, {"$set": result["metadata"]}, upsert=True)
+                for result in batch
+            ],
+            ordered=False,
+        )
+
+        # Only checkpoint once both stores have the batch
+        with open(self.checkpoint_path, "a") as file:
+            for result in batch:
+                file.write(result["path"] + "\n")
+        self.ingested += len(batch)
+        logging.info(f"{self.ingested} ingested, {self.ingested / (time.time() - self._start):.2f} items/s")
+
+    def run(self, works, workers):
+        done = read_checkpoint(self.checkpoint_path)
+        works = [work for work in works if work["path"] not in done]
+        logging.info(f"Ingesting {len(works)} works, {len(done)} already done")
+
+        start = self._start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.process, work): work for work in works}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.failed += 1
+                        logging.error(f"Failed to ingest {futures[future]['path']}: {e}")
+                        continue
+
+                    # A failed batch write aborts the run; the checkpoint only lists stored works
+                    self.add(result)
+            except BaseException:
+                # Otherwise the queued works still make their paid model calls, only to be discarded
+                executor.shutdown(cancel_futures=True)
+                raise
+        self.flush()
+
+        elapsed = time.time() - start
+        print(
+            f"Ingested {self.ingested} works ({self.failed} failed) in {elapsed:.1f}s, "
+            f"{self.ingested / elapsed if elapsed else 0:.2f} items/s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk ingest artwork into Qdrant and MongoDB")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="Directory of media files to ingest")
+    source.add_argument("--manifest", help="JSONL manifest with one work per line")
+    parser.add_argument("--artist-name", help="Artist name for works read from --dir")
+    parser.add_argument("--email", help="Artist email for works read from --dir")
+    parser.add_argument("--portfolio-url", help="Artist portfolio URL for works read from --dir")
+    parser.add_argument("--checkpoint", default="bulk_ingest.checkpoint", help="Checkpoint file for resuming")
+    parser.add_argument("--batch-size", type=int, default=64, help="Works per Qdrant/MongoDB write")
+    parser.add_argument("--workers", type=int, default=16, help="Works processed concurrently")
+    for stage in STAGES:
+        parser.add_argument(
+            f"--{stage.replace('_', '-')}-concurrency",
+            type=int,
+            default=8,
+            help=f"Maximum concurrent calls of the {stage} stage",
+        )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    if args.manifest:
+        works = list(read_manifest(args.manifest))
+    else:
+        defaults = {
+            "artist_name": args.artist_name,
+            "email": args.email,
+            "portfolio_url": args.portfolio_url,
+        }
+        works = list(walk_directory(args.dir, defaults))
+
+    ingest = BulkIngest(
+        firebase_handler=FirebaseHandler(Config.FIREBASE_CRED_PATH, Config.FIREBASE_BUCKET_NAME),
+        media_collection=MongoClient(Config.MONGO_URI).get_default_database().media,
+        stage_limits={stage: getattr(args, f"{stage}_concurrency") for stage in STAGES},
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+    )
+    ingest.run(works, args.workers)
+
+
+if __name__ == "__main__":
+    main()
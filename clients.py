@@ -0,0 +1,223 @@
+# clients.py
+import os
+import threading
+import logging
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from huggingface_hub import AsyncInferenceClient, InferenceClient, configure_http_backend
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from config import Config
+from kindo_api import AsyncKindoAPI, KindoAPI
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of outbound clients.
+
+    Each client is built lazily on first use and reused for the life of the
+    worker. The registry is keyed on the process id, so a worker forked by
+    gunicorn after the parent touched a client builds its own copy instead of
+    sharing sockets with the parent.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._clients = {}
+        self._building = {}
+        self._hits = {}
+        self._misses = {}
+
+    def get(self, name, factory):
+        """
+        Returns the client registered under `name`, building it with `factory` on first use.
+        Concurrent first calls build it once, and other clients stay available meanwhile.
+
+        Parameters:
+            name (str): Registry key of the client.
+            factory (callable): Zero-argument callable that builds the client.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+            if name in self._clients:
+                self._hits[name] = self._hits.get(name, 0) + 1
+                return self._clients[name]
+            building = self._building.setdefault(name, threading.Lock())
+
+        # Built outside the registry lock, so a slow factory (the local index loads its snapshot)
+        # only holds up callers of the same client
+        with building:
+            with self._lock:
+                if name in self._clients:
+                    self._hits[name] = self._hits.get(name, 0) + 1
+                    return self._clients[name]
+                self._misses[name] = self._misses.get(name, 0) + 1
+
+            client = factory()
+            with self._lock:
+                self._clients[name] = client
+        logging.info(f"Initialized pooled client: {name}")
+        return client
+
+    def stats(self):
+        """
+        Returns hit/miss counters per client, plus connection reuse of the shared HTTP session.
+        """
+        with self._lock:
+            stats = {
+                name: {
+                    "hits": self._hits.get(name, 0),
+                    "misses": self._misses.get(name, 0),
+                }
+                for name in set(self._hits) | set(self._misses)
+            }
+            session = self._clients.get("http_session")
+
+        if session is not None:
+            stats["http_session"].update(_session_connection_stats(session))
+        return stats
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        # A build lock inherited from the parent may be held by a thread that does not exist here
+        self._building = {}
+        self._hits = {}
+        self._misses = {}
+
+
+def _session_connection_stats(session):
+    # urllib3 keeps per-host pools; a request served on an existing socket is a reuse
+    connections = 0
+    requests_sent = 0
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+    return {
+        "connections_opened": connections,
+        "requests_sent": requests_sent,
+        "connections_reused": max(requests_sent - connections, 0),
+    }
+
+
+registry = ClientRegistry()
+
+
+def _build_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=Config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _httpx_limits():
+    return httpx.Limits(
+        max_connections=Config.HTTP_POOL_MAXSIZE,
+        max_keepalive_connections=Config.HTTP_POOL_MAXSIZE,
+    )
+
+
+def get_http_session():
+    return registry.get("http_session", _build_http_session)
+
+
+def get_kindo_api():
+    return registry.get(
+        "kindo",
+        lambda: KindoAPI(os.getenv("KINDO_API_KEY"), session=get_http_session()),
+    )
+
+
+def get_inference_client():
+    return registry.get(
+        "huggingface",
+        lambda: InferenceClient(
+            api_key=os.getenv("HUGGINGFACE_API_KEY"), timeout=Config.OUTBOUND_TIMEOUTS["vision"][0]
+        ),
+    )
+
+
+def get_qdrant_client():
+    return registry.get(
+        "qdrant",
+        lambda: QdrantClient(
+            url=os.getenv("QDRANT_URL"),
+            api_key=os.getenv("QDRANT_KEY"),
+            limits=_httpx_limits(),
+        ),
+    )
+
+
+def get_embed_model():
+    return registry.get(
+        "openai_embedding",
+        lambda: OpenAIEmbedding(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=httpx.Client(limits=_httpx_limits()),
+        ),
+    )
+
+
+# Clients of the async serving mode (asgi.py). They bind to the event loop of the
+# worker on first use, so they must only be used from that loop.
+def get_async_http_client():
+    return registry.get(
+        "async_http",
+        lambda: httpx.AsyncClient(limits=_httpx_limits(), timeout=Config.ASYNC_HTTP_TIMEOUT),
+    )
+
+
+def get_async_kindo_api():
+    return registry.get(
+        "async_kindo",
+        lambda: AsyncKindoAPI(os.getenv("KINDO_API_KEY"), client=get_async_http_client()),
+    )
+
+
+def get_async_inference_client():
+    return registry.get(
+        "async_huggingface",
+        lambda: AsyncInferenceClient(
+            api_key=os.getenv("HUGGINGFACE_API_KEY"), timeout=Config.OUTBOUND_TIMEOUTS["vision"][0]
+        ),
+    )
+
+
+def get_async_qdrant_client():
+    return registry.get(
+        "async_qdrant",
+        lambda: AsyncQdrantClient(
+            url=os.getenv("QDRANT_URL"),
+            api_key=os.getenv("QDRANT_KEY"),
+            limits=_httpx_limits(),
+        ),
+    )
+
+
+def init_clients():
+    """
+    Builds every pooled client up front, so the first request of a worker does not pay for it.
+    """
+    # huggingface_hub keeps one session per thread; give those sessions our pool sizes too
+    configure_http_backend(backend_factory=_build_http_session)
+
+    get_http_session()
+    get_kindo_api()
+    get_inference_client()
+    get_qdrant_client()
+    get_embed_model()
@@ -17,3 +17,159 @@ class Config:
     HUGGING_FACE_API_KEY = os.getenv('HUGGING_FACE_API_KEY')
 
     TTS_KEY = os.getenv('TTS_TOKEN')
+
+    FIREBASE_CRED_PATH = os.getenv('FIREBASE_CRED_PATH', 'artist-recommendation-key.json')
+    FIREBASE_BUCKET_NAME = os.getenv('FIREBASE_BUCKET_NAME', 'artist-recommendation.firebasestorage.app')
+
+    # Uploads are kept in memory, so bound their size; larger files go to Firebase as a resumable upload in chunks
+    MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 50 * 1024 * 1024))
+    FIREBASE_CHUNK_SIZE = int(os.getenv('FIREBASE_CHUNK_SIZE', 8 * 1024 * 1024))
+
+    # Connection pool sizes for the shared outbound HTTP clients
+    HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 10))
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 20))
+
+    # Generate description, generic description and tags in a single LLM call
+    FUSED_ANALYSIS = os.getenv('FUSED_ANALYSIS', 'True') == 'True'
+
+    # Maximum number of recommendations returned by one /upload page
+    MAX_RESULTS = int(os.getenv('MAX_RESULTS', 50))
+
+    # How query tags constrain the search: "must" (every tag), "should" (soft match + re-rank) or "none"
+    TAG_FILTER_MODE = os.getenv('TAG_FILTER_MODE', 'should')
+    TAG_MIN_MATCH = int(os.getenv('TAG_MIN_MATCH', 1))
+    TAG_WEIGHT = float(os.getenv('TAG_WEIGHT', 0.1))
+    # "should" re-ranks the same TAG_RERANK_POOL closest candidates for every page, so pages neither
+    # overlap nor skip hits; pages past the pool are empty
+    TAG_RERANK_POOL = int(os.getenv('TAG_RERANK_POOL', 200))
+
+    # Send Server-Timing and X-Request-ID headers with every response
+    SERVER_TIMING = os.getenv('SERVER_TIMING', 'True') == 'True'
+
+    # Content-addressed cache of the description/tag pipeline stages
+    STAGE_CACHE_ENABLED = os.getenv('STAGE_CACHE_ENABLED', 'True') == 'True'
+    STAGE_CACHE_PATH = os.getenv('STAGE_CACHE_PATH', './tmp/stage_cache.sqlite3')
+    STAGE_CACHE_TTL = int(os.getenv('STAGE_CACHE_TTL', 7 * 24 * 3600))
+    STAGE_CACHE_MEMORY_BYTES = int(os.getenv('STAGE_CACHE_MEMORY_BYTES', 32 * 1024 * 1024))
+    STAGE_CACHE_DISK_BYTES = int(os.getenv('STAGE_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+
+    # Query embedding cache (rows of 1536 float32) and micro-batching of embedding calls
+    EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 4096))
+    EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+    EMBEDDING_BATCH_WAIT_MS = int(os.getenv('EMBEDDING_BATCH_WAIT_MS', 10))
+
+    # Persistent job queue running /save processing, in the MongoDB collection "jobs" shared by all instances
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+    JOB_QUEUE_MAX_PENDING = int(os.getenv('JOB_QUEUE_MAX_PENDING', 100))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+    JOB_BACKOFF_BASE = float(os.getenv('JOB_BACKOFF_BASE', 2))
+    JOB_BACKOFF_MAX = float(os.getenv('JOB_BACKOFF_MAX', 300))
+    JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 900))
+    JOB_RETRY_AFTER = int(os.getenv('JOB_RETRY_AFTER', 30))
+    # Seconds finished jobs stay available on /jobs/<id>
+    JOB_RETENTION = int(os.getenv('JOB_RETENTION', 7 * 24 * 3600))
+    # Seconds a query_token of /upload can be used to request more pages
+    QUERY_TOKEN_TTL = int(os.getenv('QUERY_TOKEN_TTL', 24 * 3600))
+
+    # Timeout in seconds of the httpx client used by the async serving mode
+    ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', 120))
+
+    # Outbound calls to Kindo, Whisper and the vision model: seconds per attempt, and over all attempts of a call
+    OUTBOUND_TIMEOUTS = {
+        'kindo': (float(os.getenv('KINDO_TIMEOUT', 60)), float(os.getenv('KINDO_DEADLINE', 120))),
+        'whisper': (float(os.getenv('WHISPER_TIMEOUT', 60)), float(os.getenv('WHISPER_DEADLINE', 180))),
+        'vision': (float(os.getenv('VISION_TIMEOUT', 60)), float(os.getenv('VISION_DEADLINE', 120))),
+    }
+    OUTBOUND_MAX_ATTEMPTS = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', 3))
+    OUTBOUND_BACKOFF_BASE = float(os.getenv('OUTBOUND_BACKOFF_BASE', 0.5))
+    OUTBOUND_BACKOFF_MAX = float(os.getenv('OUTBOUND_BACKOFF_MAX', 8))
+    # Consecutive failures that open the circuit of an endpoint, and seconds before it is tried again
+    OUTBOUND_BREAKER_THRESHOLD = int(os.getenv('OUTBOUND_BREAKER_THRESHOLD', 5))
+    OUTBOUND_BREAKER_RESET = float(os.getenv('OUTBOUND_BREAKER_RESET', 30))
+    # Endpoints sending a duplicate request once an attempt is slower than their p95, e.g. "kindo,vision"
+    OUTBOUND_HEDGE = [name for name in os.getenv('OUTBOUND_HEDGE', '').split(',') if name]
+    OUTBOUND_HEDGE_MIN_SAMPLES = int(os.getenv('OUTBOUND_HEDGE_MIN_SAMPLES', 20))
+    OUTBOUND_HEDGE_WORKERS = int(os.getenv('OUTBOUND_HEDGE_WORKERS', 16))
+    OUTBOUND_LATENCY_WINDOW = int(os.getenv('OUTBOUND_LATENCY_WINDOW', 200))
+
+    # "local" embeds and/or tags on CPU with the ONNX model in LOCAL_MODEL_DIR instead of OpenAI / GPT-4o.
+    # TAGGING_ENGINE can also be "centroid", see below
+    EMBEDDING_ENGINE = os.getenv('EMBEDDING_ENGINE', 'openai')
+    TAGGING_ENGINE = os.getenv('TAGGING_ENGINE', 'llm')
+    LOCAL_MODEL_DIR = os.getenv('LOCAL_MODEL_DIR', './models/all-MiniLM-L6-v2')
+    LOCAL_EMBEDDING_DIM = int(os.getenv('LOCAL_EMBEDDING_DIM', 384))
+    LOCAL_ENGINE_THREADS = int(os.getenv('LOCAL_ENGINE_THREADS', 2))
+    # Tags scoring at least the threshold are kept, at most LOCAL_TAG_TOP_K of them
+    LOCAL_TAG_THRESHOLD = float(os.getenv('LOCAL_TAG_THRESHOLD', 0.3))
+    LOCAL_TAG_TOP_K = int(os.getenv('LOCAL_TAG_TOP_K', 3))
+    # TAGGING_ENGINE "centroid" tags by similarity to the mean embedding of each tag in the collection.
+    # Tags with fewer points than TAG_CENTROIDS_MIN_SAMPLES are never assigned
+    TAG_CENTROIDS_MIN_SAMPLES = int(os.getenv('TAG_CENTROIDS_MIN_SAMPLES', 20))
+    TAG_CENTROIDS_TOP_K = int(os.getenv('TAG_CENTROIDS_TOP_K', 3))
+    # Seconds before a worker reloads the centroids stored by the nightly refresh
+    TAG_CENTROIDS_RELOAD = int(os.getenv('TAG_CENTROIDS_RELOAD', 3600))
+
+    # Send the models a bounded-resolution image and a short mono audio excerpt instead of the
+    # originals, which are still stored in Firebase. Images are then sent inline, without waiting
+    # for the upload
+    PREPROCESS_MEDIA = os.getenv('PREPROCESS_MEDIA', 'True') == 'True'
+    IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 1024))
+    # JPEG or WEBP
+    IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+    IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+    AUDIO_EXCERPT_SECONDS = float(os.getenv('AUDIO_EXCERPT_SECONDS', 30))
+    AUDIO_SAMPLE_RATE = int(os.getenv('AUDIO_SAMPLE_RATE', 16000))
+
+    # /save skips media whose content was already saved; media whose perceptual hash is at most
+    # DEDUP_MAX_DISTANCE bits away (out of 64, at most 3) from a saved one are saved and reported
+    DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'True') == 'True'
+    DEDUP_MAX_DISTANCE = int(os.getenv('DEDUP_MAX_DISTANCE', 3))
+
+    # Layout of new collections; apply it to an existing one with python -m artist_matching.migrate_collection.
+    # QDRANT_QUANTIZATION is "none", "scalar" (int8, 4x smaller) or "binary" (32x smaller, for 1536-dim OpenAI vectors)
+    QDRANT_QUANTIZATION = os.getenv('QDRANT_QUANTIZATION', 'none')
+    QDRANT_QUANTIZATION_QUANTILE = float(os.getenv('QDRANT_QUANTIZATION_QUANTILE', 0.99))
+    QDRANT_QUANTIZATION_ALWAYS_RAM = os.getenv('QDRANT_QUANTIZATION_ALWAYS_RAM', 'True') == 'True'
+    # Keep the original vectors and the payload on disk; with quantization only the quantized vectors stay in RAM
+    QDRANT_ON_DISK_VECTORS = os.getenv('QDRANT_ON_DISK_VECTORS', 'False') == 'True'
+    QDRANT_ON_DISK_PAYLOAD = os.getenv('QDRANT_ON_DISK_PAYLOAD', 'False') == 'True'
+    QDRANT_HNSW_M = int(os.getenv('QDRANT_HNSW_M', 16))
+    QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv('QDRANT_HNSW_EF_CONSTRUCT', 100))
+    # Search-time beam width; unset keeps the Qdrant default
+    QDRANT_HNSW_EF = int(os.getenv('QDRANT_HNSW_EF')) if os.getenv('QDRANT_HNSW_EF') else None
+    # Quantized searches fetch QDRANT_OVERSAMPLING times the limit and rescore them with the original vectors
+    QDRANT_RESCORE = os.getenv('QDRANT_RESCORE', 'True') == 'True'
+    QDRANT_OVERSAMPLING = float(os.getenv('QDRANT_OVERSAMPLING', 2.0))
+
+    # "local" searches an in-process copy of the collection, synced from Qdrant (artist_matching/local_index.py)
+    VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'qdrant')
+    LOCAL_INDEX_DIR = os.getenv('LOCAL_INDEX_DIR', './local_index')
+    LOCAL_INDEX_SYNC_INTERVAL = int(os.getenv('LOCAL_INDEX_SYNC_INTERVAL', 60))
+    LOCAL_INDEX_SNAPSHOT_INTERVAL = int(os.getenv('LOCAL_INDEX_SNAPSHOT_INTERVAL', 900))
+    # Seconds a search waits for the first load of the index
+    LOCAL_INDEX_READY_TIMEOUT = int(os.getenv('LOCAL_INDEX_READY_TIMEOUT', 120))
+    # Partitions of at least this many points are searched through HNSW (needs hnswlib); 0 disables it
+    LOCAL_INDEX_HNSW_MIN_POINTS = int(os.getenv('LOCAL_INDEX_HNSW_MIN_POINTS', 20000))
+    LOCAL_INDEX_HNSW_M = int(os.getenv('LOCAL_INDEX_HNSW_M', 16))
+    LOCAL_INDEX_HNSW_EF_CONSTRUCTION = int(os.getenv('LOCAL_INDEX_HNSW_EF_CONSTRUCTION', 200))
+    LOCAL_INDEX_HNSW_EF = int(os.getenv('LOCAL_INDEX_HNSW_EF', 128))
+
+    # Recommendations of the other media type precomputed for every catalogue item, served by /recommendations
+    NEIGHBOURS_ENABLED = os.getenv('NEIGHBOURS_ENABLED', 'True') == 'True'
+    NEIGHBOURS_K = int(os.getenv('NEIGHBOURS_K', 10))
+    # Items of the other type whose recommendations are recomputed when a media is saved: its closest ones
+    NEIGHBOURS_FANOUT = int(os.getenv('NEIGHBOURS_FANOUT', 20))
+    # Seconds the update after a save waits, so that queued saves run first
+    NEIGHBOURS_UPDATE_DELAY = float(os.getenv('NEIGHBOURS_UPDATE_DELAY', 30))
+
+    # /upload/batch: inputs per request, and threads analyzing the inputs of batches side by side
+    BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 20))
+    BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 16))
+
+    # Threads running the independent stages of a pipeline (upload, transcription, storage) side by side
+    PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', 32))
+
+    # Background execution of /upload requests made with async=true
+    UPLOAD_ASYNC_WORKERS = int(os.getenv('UPLOAD_ASYNC_WORKERS', 8))
+    UPLOAD_ASYNC_MAX_PENDING = int(os.getenv('UPLOAD_ASYNC_MAX_PENDING', 64))
+    UPLOAD_ASYNC_TTL = int(os.getenv('UPLOAD_ASYNC_TTL', 600))
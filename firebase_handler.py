@@ -1,8 +1,11 @@
 # firebase_handler.py
 import firebase_admin
 from firebase_admin import credentials, storage
+import io
 import os
 
+from metrics import timed
+
 class FirebaseHandler:
     def __init__(self, firebase_cred_path, firebase_bucket_name):
         """
@@ -30,9 +33,34 @@ class FirebaseHandler:
         Returns:
             str: The public URL of the uploaded file.
         """
-        blob = self.bucket.blob(file_name)
-        blob.upload_from_filename(file_path)
-        blob.make_public()  # Make the file publicly accessible
+        with timed("firebase.upload", bytes_sent=os.path.getsize(file_path)):
+            blob = self.bucket.blob(file_name)
+            blob.upload_from_filename(file_path)
+            blob.make_public()  # Make the file publicly accessible
+
+        return blob.public_url
+
+    def upload_bytes(self, file_name, data, content_type=None, chunk_size=None):
+        """
+        Uploads content held in memory to Firebase Storage and returns the public URL.
+
+        Content larger than `chunk_size` is sent as a resumable upload, one chunk
+        per request, so a dropped connection does not restart the whole file.
+
+        Parameters:
+            file_name (str): The name to give the file in Firebase.
+            data (bytes): The content of the file.
+            content_type (str): MIME type stored with the file.
+            chunk_size (int): Chunk size of resumable uploads, a multiple of 256KB.
+
+        Returns:
+            str: The public URL of the uploaded file.
+        """
+        resumable = chunk_size is not None and len(data) > chunk_size
+        with timed("firebase.upload", bytes_sent=len(data)):
+            blob = self.bucket.blob(file_name, chunk_size=chunk_size if resumable else None)
+            blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+            blob.make_public()  # Make the file publicly accessible
 
         return blob.public_url
 
@@ -0,0 +1,237 @@
+# job_queue.py
+import datetime
+import random
+import threading
+import time
+import uuid
+import logging
+
+from pymongo import ASCENDING, ReturnDocument
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Bounded worker pool backed by a persistent job collection in MongoDB.
+
+    Jobs survive a worker restart and are shared by every instance: anything
+    still queued, or running under an expired lease, is picked up by the next
+    worker of any instance. Failed jobs are retried with exponential backoff and
+    jitter until `max_attempts` is reached. Finished jobs are deleted by a TTL
+    index `retention` seconds later.
+    """
+
+    def __init__(
+        self,
+        collection,
+        workers,
+        max_pending,
+        max_attempts,
+        backoff_base,
+        backoff_max,
+        lease_seconds,
+        retention,
+        poll_interval=2,
+    ):
+        """
+        Parameters:
+            collection: MongoDB collection holding the jobs.
+            workers (int): Number of jobs run concurrently.
+            max_pending (int): Jobs ready to run accepted before `submit` raises QueueFullError.
+            max_attempts (int): Attempts before a job is marked as failed.
+            backoff_base (float): Delay in seconds before the first retry, doubled on every attempt.
+            backoff_max (float): Upper bound of the retry delay in seconds.
+            lease_seconds (float): Time after which a running job whose worker stopped renewing
+                its lease is assumed lost and requeued.
+            retention (float): Seconds a finished job stays available on /jobs/<id>.
+            poll_interval (float): Longest wait before looking for jobs submitted by other instances.
+        """
+        self.jobs = collection
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self.retention = retention
+        self.poll_interval = poll_interval
+
+        self._handlers = {}
+        self._threads = []
+        # Wakes the local workers on submit; jobs of other instances are found by polling
+        self._wakeup = threading.Condition()
+
+    def register(self, kind, handler):
+        """
+        Registers the function run for jobs of the given kind. It is called with the job payload as keyword arguments,
+        and what it returns is kept as the result of the job.
+        """
+        self._handlers[kind] = handler
+
+    def ensure_indexes(self):
+        self.jobs.create_index([("status", ASCENDING), ("run_at", ASCENDING)])
+        self.jobs.create_index("finished_at", expireAfterSeconds=int(self.retention))
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def check_capacity(self):
+        """
+        Raises QueueFullError when `max_pending` jobs are waiting to run.
+        """
+        # Delayed jobs and retries waiting for their backoff do not count as pending
+        pending = self.jobs.count_documents({"status": "queued", "run_at": {"$lte": time.time()}})
+        if pending >= self.max_pending:
+            raise QueueFullError(f"Job queue is full ({pending} pending)")
+
+    def submit(self, kind, payload, delay=0):
+        """
+        Queues a job, to be run no earlier than `delay` seconds from now.
+        """
+        self.check_capacity()
+
+        now = time.time()
+        job_id = str(uuid.uuid4())
+        self.jobs.insert_one(
+            {
+                "_id": job_id,
+                "kind": kind,
+                "payload": payload,
+                "status": "queued",
+                "attempts": 0,
+                "error": None,
+                "run_at": now + delay,
+                "created_at": now,
+                "updated_at": now,
+            }
+        )
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        job = self.jobs.find_one(
+            {"_id": job_id}, {"kind": 1, "status": 1, "attempts": 1, "error": 1, "result": 1, "created_at": 1, "updated_at": 1}
+        )
+        if job is None:
+            return None
+        job["id"] = job.pop("_id")
+        return job
+
+    def _claim(self):
+        now = time.time()
+        self._reclaim(now)
+        # Atomic, so a job is claimed by a single worker across instances
+        job = self.jobs.find_one_and_update(
+            {"status": "queued", "run_at": {"$lte": now}},
+            {
+                "$set": {
+                    "status": "running",
+                    "lease": uuid.uuid4().hex,
+                    "lease_expires": now + self.lease_seconds,
+                    "updated_at": now,
+                }
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is None:
+            next_job = self.jobs.find_one({"status": "queued"}, {"run_at": 1}, sort=[("run_at", ASCENDING)])
+            timeout = self.poll_interval
+            if next_job is not None:
+                timeout = min(next_job["run_at"] - now, timeout)
+            with self._wakeup:
+                self._wakeup.wait(timeout=max(timeout, 0.05))
+        return job
+
+    def _reclaim(self, now):
+        """
+        Requeues the jobs whose lease ran out: their worker died mid-run, which uses up an attempt.
+        """
+        expired = {"status": "running", "lease_expires": {"$lt": now}}
+        # Otherwise a job that kills its worker (e.g. out of memory) would be retried forever
+        self.jobs.update_many(
+            {**expired, "attempts": {"$gte": self.max_attempts - 1}},
+            {
+                "$set": {
+                    "status": "failed",
+                    "error": "Worker lost while running the job",
+                    "updated_at": now,
+                    "finished_at": datetime.datetime.now(datetime.timezone.utc),
+                },
+                "$inc": {"attempts": 1},
+            },
+        )
+        self.jobs.update_many(expired, {"$set": {"status": "queued", "updated_at": now}, "$inc": {"attempts": 1}})
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(job)
+            except Exception as e:
+                # MongoDB unreachable: an unrecorded job is retried once its lease expires
+                logging.error(f"Job queue error: {e}")
+                time.sleep(self.poll_interval)
+
+    def _run(self, job):
+        attempts = job["attempts"] + 1
+        # Jobs may outlast the lease (e.g. a full neighbour refresh); renew it while they run
+        finished = threading.Event()
+        threading.Thread(target=self._renew_lease, args=(job, finished), daemon=True).start()
+        try:
+            result = self._handlers[job["kind"]](**job["payload"])
+        except Exception as e:
+            logging.exception(f"Job {job['_id']} ({job['kind']}) failed on attempt {attempts}")
+            self._retry_or_fail(job, attempts, e)
+        else:
+            self._finish(job, attempts, "done", None, result)
+        finally:
+            finished.set()
+
+    def _renew_lease(self, job, finished):
+        while not finished.wait(self.lease_seconds / 3):
+            try:
+                self.jobs.update_one(
+                    {"_id": job["_id"], "lease": job["lease"], "status": "running"},
+                    {"$set": {"lease_expires": time.time() + self.lease_seconds}},
+                )
+            except Exception as e:
+                logging.warning(f"Failed to renew the lease of job {job['_id']}: {e}")
+
+    def _retry_or_fail(self, job, attempts, error):
+        if attempts >= self.max_attempts:
+            self._finish(job, attempts, "failed", str(error))
+            return
+
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        delay *= random.uniform(0.5, 1.0)
+        now = time.time()
+        self.jobs.update_one(
+            # A job whose lease was taken over belongs to the worker running it now
+            {"_id": job["_id"], "lease": job["lease"]},
+            {"$set": {"status": "queued", "attempts": attempts, "error": str(error), "run_at": now + delay, "updated_at": now}},
+        )
+
+    def _finish(self, job, attempts, status, error, result=None):
+        self.jobs.update_one(
+            {"_id": job["_id"], "lease": job["lease"]},
+            {
+                "$set": {
+                    "status": status,
+                    "attempts": attempts,
+                    "error": error,
+                    "result": result,
+                    "updated_at": time.time(),
+                    # Read by the TTL index, which needs a date
+                    "finished_at": datetime.datetime.now(datetime.timezone.utc),
+                }
+            },
+        )
@@ -1,43 +1,74 @@
+import json
 import requests
 
+from metrics import timed
+from resilience import get_endpoint
+
+
+def _prepare_request(api_key, model, messages, max_tokens, kwargs):
+    headers = {
+        "api-key": api_key,
+        "content-type": "application/json",
+    }
+
+    # Prepare the request payload
+    data = {
+        "model": model,
+        "messages": messages,
+        "max_tokens":max_tokens
+    }
+
+    # Add optional parameters if any
+    data.update(kwargs)
+    return headers, data
+
+
 class KindoAPI:
-    def __init__(self, api_key):
+    def __init__(self, api_key, session=None):
         self.api_key = api_key
+        self.session = session or requests.Session()
         self.base_url = "https://llm.kindo.ai/v1/chat/completions"
 
     def call_kindo_api(self, model, messages, max_tokens, **kwargs):
-        headers = {
-            "api-key": self.api_key,
-            "content-type": "application/json",
-        }
-
-        # Prepare the request payload
-        data = {
-            "model": model,
-            "messages": messages,
-            "max_tokens":max_tokens
-        }
-
-        # Add optional parameters if any
-        data.update(kwargs)
-
-        try:
+        """
+        Sends a chat completion request and returns the response.
+
+        Failed attempts are retried within the deadline of the "kindo" endpoint; the
+        last error is raised, e.g. requests.HTTPError or resilience.CircuitOpenError.
+        """
+        headers, data = _prepare_request(self.api_key, model, messages, max_tokens, kwargs)
+        return get_endpoint("kindo").call(lambda timeout: self._post(headers, data, timeout))
+
+    def _post(self, headers, data, timeout):
+        with timed("kindo", bytes_sent=len(json.dumps(data))) as span:
             # Send the POST request
-            response = requests.post(self.base_url, headers=headers, json=data)
+            response = self.session.post(self.base_url, headers=headers, json=data, timeout=timeout)
+            span.bytes_received = len(response.content)
 
             # Check for HTTP errors
             response.raise_for_status()
 
-            # Return the JSON response if successful
-            return response
+        return response
 
-        except requests.exceptions.HTTPError as http_err:
-            # Handle HTTP error responses
-            error_details = response.json() if response.content else {}
-            print(f"HTTP error occurred: {http_err}, details: {error_details}")
-            return {"error": str(http_err), "details": error_details}
 
-        except Exception as err:
-            # Handle other errors (network issues, etc.)
-            print(f"An error occurred: {err}")
-            return {"error": str(err)}
+class AsyncKindoAPI:
+    """
+    KindoAPI for the async serving mode, posting through a shared httpx.AsyncClient.
+    """
+
+    def __init__(self, api_key, client):
+        self.api_key = api_key
+        self.client = client
+        self.base_url = "https://llm.kindo.ai/v1/chat/completions"
+
+    async def call_kindo_api(self, model, messages, max_tokens, **kwargs):
+        headers, data = _prepare_request(self.api_key, model, messages, max_tokens, kwargs)
+        return await get_endpoint("kindo").call_async(lambda timeout: self._post(headers, data, timeout))
+
+    async def _post(self, headers, data, timeout):
+        with timed("kindo", bytes_sent=len(json.dumps(data))) as span:
+            response = await self.client.post(self.base_url, headers=headers, json=data, timeout=timeout)
+            span.bytes_received = len(response.content)
+            response.raise_for_status()
+
+        return response
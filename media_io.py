@@ -0,0 +1,78 @@
+# media_io.py
+import hashlib
+import io
+import mimetypes
+
+from flask import Request
+from werkzeug.utils import secure_filename
+
+from utility import determine_media_type
+
+
+class InMemoryRequest(Request):
+    """
+    Request whose uploaded files stay in memory.
+
+    werkzeug spools uploads larger than 500KB to temporary files on disk; the
+    upload size is already bounded by MAX_CONTENT_LENGTH, so keep them in a buffer.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+def blob_name(content_hash, filename):
+    # Content-addressed, so two uploads named "song.mp3" no longer overwrite each other
+    return f"{content_hash[:16]}-{filename}"
+
+
+class MediaPayload:
+    """
+    An uploaded file, read once from the request and shared by every stage that needs its bytes.
+    """
+
+    def __init__(self, filename, data, content_hash, content_type=None):
+        """
+        Parameters:
+            filename (str): Sanitized name of the uploaded file.
+            data (bytes): Content of the file.
+            content_hash (str): SHA-256 of the content.
+            content_type (str): MIME type sent by the client, if any.
+        """
+        self.filename = filename
+        self.data = data
+        self.content_hash = content_hash
+        self.content_type = content_type or mimetypes.guess_type(filename)[0]
+        self.media_type = determine_media_type(filename)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def blob_name(self):
+        return blob_name(self.content_hash, self.filename)
+
+
+def read_upload(file_storage):
+    """
+    Reads an uploaded file into memory and hashes it.
+
+    Parameters:
+        file_storage (FileStorage): The file from request.files.
+
+    Returns:
+        MediaPayload: The content, hash and type of the file.
+    """
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        # Already buffered by InMemoryRequest; getvalue hands over that buffer instead of copying it
+        data = stream.getvalue()
+    else:
+        data = stream.read()
+
+    return MediaPayload(
+        filename=secure_filename(file_storage.filename),
+        data=data,
+        content_hash=hashlib.sha256(data).hexdigest(),
+        content_type=file_storage.mimetype or None,
+    )
@@ -0,0 +1,155 @@
+# metrics.py
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds; remote model calls take seconds, cache hits and Qdrant milliseconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+# Stage timings of the request being served, for the Server-Timing header
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    """
+    Per-stage duration histograms, error counts and bytes transferred, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._errors = {}
+        self._bytes = {}
+
+    def observe(self, stage, seconds, error=False, bytes_sent=0, bytes_received=0):
+        with self._lock:
+            self._durations.setdefault(stage, Histogram()).observe(seconds)
+            if error:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+            if bytes_sent:
+                key = (stage, "sent")
+                self._bytes[key] = self._bytes.get(key, 0) + bytes_sent
+            if bytes_received:
+                key = (stage, "received")
+                self._bytes[key] = self._bytes.get(key, 0) + bytes_received
+
+    def render(self):
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of each pipeline stage.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self._durations.items()):
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+            name = f"{self.prefix}_stage_errors_total"
+            lines += [f"# HELP {name} Failed calls of each pipeline stage.", f"# TYPE {name} counter"]
+            for stage, count in sorted(self._errors.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {count}')
+
+            name = f"{self.prefix}_stage_bytes_total"
+            lines += [f"# HELP {name} Bytes sent to and received from remote services.", f"# TYPE {name} counter"]
+            for (stage, direction), count in sorted(self._bytes.items()):
+                lines.append(f'{name}{{stage="{stage}",direction="{direction}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def render_gauges(self, group, values, help_text):
+        """
+        Renders a flat dict of numbers as gauges, e.g. cache or connection pool counters.
+        """
+        name = f"{self.prefix}_{group}"
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'{name}{{name="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics("artist_recommendation")
+
+
+class Span:
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+@contextmanager
+def timed(stage, bytes_sent=0):
+    """
+    Times the enclosed block as `stage`. The yielded span can be given the bytes
+    sent and received once they are known.
+    """
+    span = Span()
+    span.bytes_sent = bytes_sent
+    error = False
+    start = time.perf_counter()
+    try:
+        yield span
+    except Exception:
+        error = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe(stage, elapsed, error, span.bytes_sent, span.bytes_received)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.append((stage, elapsed))
+
+
+def timed_stage(stage):
+    """
+    Decorator timing every call of the function, or of the coroutine function, as `stage`.
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing(trace):
+    # Repeated stages (e.g. several Mongo calls) are summed into one entry
+    totals = {}
+    for stage, elapsed in trace:
+        totals[stage] = totals.get(stage, 0) + elapsed
+    return ", ".join(
+        f"{stage.replace('.', '_')};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items()
+    )
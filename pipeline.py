@@ -0,0 +1,70 @@
+# pipeline.py
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class StageGraph:
+    """
+    A small dependency graph of pipeline stages.
+
+    Each stage is started on the executor as soon as the stages it depends on
+    have finished, so independent branches (e.g. the Firebase upload and the
+    transcription) overlap and the run takes as long as its critical path.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._stages = {}
+
+    def add(self, name, func, after=()):
+        """
+        Adds a stage. `func` is called with the results of the `after` stages, in that order,
+        and its return value becomes the result of `name`.
+        """
+        self._stages[name] = (func, tuple(after))
+        return self
+
+    def run(self, **inputs):
+        """
+        Runs every stage and returns the results of all stages and inputs by name.
+
+        Inputs count as finished stages. If a stage fails, no further stage is started,
+        and its exception is raised once the stages already running have finished.
+        """
+        results = dict(inputs)
+        pending = dict(self._stages)
+        running = {}
+
+        for name, (_, after) in pending.items():
+            unknown = [dep for dep in after if dep not in pending and dep not in results]
+            if unknown:
+                raise ValueError(f"Stage {name} depends on unknown stages {unknown}")
+
+        error = None
+        while pending or running:
+            if error is None:
+                for name, (func, after) in list(pending.items()):
+                    if all(dep in results for dep in after):
+                        # Copy the context so stage timings still reach the request's trace
+                        context = contextvars.copy_context()
+                        args = [results[dep] for dep in after]
+                        running[self.executor.submit(context.run, func, *args)] = name
+                        del pending[name]
+
+            if not running:
+                if error is None:
+                    raise ValueError(f"Stages {list(pending)} depend on each other")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+
+        if error is not None:
+            raise error
+        return results
@@ -0,0 +1,203 @@
+# progress.py
+import asyncio
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TooManyTasksError(Exception):
+    pass
+
+
+class ProgressTracker:
+    """
+    Runs request pipelines in the background and records the events they report.
+
+    Each task gets a `report(stage, data)` callback; clients can poll the
+    snapshot of a task or follow its events as they arrive. State is kept in
+    memory, so polling must reach the worker process that accepted the request.
+    """
+
+    def __init__(self, workers, max_pending, ttl):
+        """
+        Parameters:
+            workers (int): Number of pipelines run concurrently.
+            max_pending (int): Unfinished tasks accepted before `start` raises TooManyTasksError.
+            ttl (float): Seconds a finished task is kept for polling.
+        """
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._tasks = {}
+        self._running = set()
+        self._changed = threading.Condition()
+        # (event loop, asyncio.Event) of the async followers of each task
+        self._watchers = {}
+
+    def start(self, func, *args, **kwargs):
+        """
+        Schedules `func(report, *args, **kwargs)` and returns the ID of the task.
+        """
+        task_id = self._create()
+        self._executor.submit(self._run, task_id, func, args, kwargs)
+        return task_id
+
+    def start_async(self, func, *args, **kwargs):
+        """
+        Schedules the coroutine `func(report, *args, **kwargs)` on the running event loop and returns the ID of the task.
+        """
+        task_id = self._create()
+        task = asyncio.ensure_future(self._run_async(task_id, func, args, kwargs))
+        # The loop only keeps weak references to tasks
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        return task_id
+
+    def _create(self):
+        with self._changed:
+            self._purge()
+            pending = sum(1 for task in self._tasks.values() if task["finished_at"] is None)
+            if pending >= self.max_pending:
+                raise TooManyTasksError(f"{pending} tasks pending")
+
+            task_id = str(uuid.uuid4())
+            self._tasks[task_id] = {
+                "status": "queued",
+                "events": [],
+                "result": None,
+                "error": None,
+                "finished_at": None,
+            }
+        return task_id
+
+    def get(self, task_id):
+        with self._changed:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            return {
+                "id": task_id,
+                "status": task["status"],
+                "stages": {event["stage"]: event["data"] for event in task["events"]},
+                "result": task["result"],
+                "error": task["error"],
+            }
+
+    def follow(self, task_id, timeout=30):
+        """
+        Yields the events of a task as they are reported, until the task finishes.
+
+        A None is yielded whenever no event arrived for `timeout` seconds, so the caller can send a keep-alive.
+        """
+        sent = 0
+        while True:
+            with self._changed:
+                task = self._tasks.get(task_id)
+                if task is None:
+                    return
+                if sent == len(task["events"]) and task["finished_at"] is None:
+                    self._changed.wait(timeout=timeout)
+                events = task["events"][sent:]
+                finished = task["finished_at"] is not None
+
+            for event in events:
+                yield event
+            sent += len(events)
+
+            if finished and not events:
+                return
+            if not events:
+                yield None
+
+    async def follow_async(self, task_id, timeout=30):
+        """
+        Same as follow, waiting on an asyncio.Event so that a follower does not hold a thread.
+        """
+        changed = asyncio.Event()
+        watcher = (asyncio.get_running_loop(), changed)
+        with self._changed:
+            self._watchers.setdefault(task_id, set()).add(watcher)
+        try:
+            sent = 0
+            while True:
+                with self._changed:
+                    task = self._tasks.get(task_id)
+                    if task is None:
+                        return
+                    events = task["events"][sent:]
+                    finished = task["finished_at"] is not None
+                    if not events and not finished:
+                        # Cleared under the lock, so a change reported after this check sets it again
+                        changed.clear()
+
+                if not events and not finished:
+                    try:
+                        await asyncio.wait_for(changed.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        yield None
+                    continue
+
+                for event in events:
+                    yield event
+                sent += len(events)
+                if finished and not events:
+                    return
+        finally:
+            with self._changed:
+                watchers = self._watchers.get(task_id, set())
+                watchers.discard(watcher)
+                if not watchers:
+                    self._watchers.pop(task_id, None)
+
+    def _run(self, task_id, func, args, kwargs):
+        self._update(task_id, status="running")
+        try:
+            result = func(lambda stage, data: self._report(task_id, stage, data), *args, **kwargs)
+        except Exception as e:
+            logging.exception(f"Task {task_id} failed")
+            self._report(task_id, "error", {"error": str(e)})
+            self._update(task_id, status="failed", error=str(e), finished_at=time.time())
+        else:
+            self._update(task_id, status="done", result=result, finished_at=time.time())
+
+    async def _run_async(self, task_id, func, args, kwargs):
+        self._update(task_id, status="running")
+        try:
+            result = await func(lambda stage, data: self._report(task_id, stage, data), *args, **kwargs)
+        except Exception as e:
+            logging.exception(f"Task {task_id} failed")
+            self._report(task_id, "error", {"error": str(e)})
+            self._update(task_id, status="failed", error=str(e), finished_at=time.time())
+        else:
+            self._update(task_id, status="done", result=result, finished_at=time.time())
+
+    def _report(self, task_id, stage, data):
+        with self._changed:
+            self._tasks[task_id]["events"].append({"stage": stage, "data": data})
+            self._notify(task_id)
+
+    def _update(self, task_id, **fields):
+        with self._changed:
+            self._tasks[task_id].update(fields)
+            self._notify(task_id)
+
+    def _notify(self, task_id):
+        self._changed.notify_all()
+        for loop, changed in self._watchers.get(task_id, ()):
+            try:
+                loop.call_soon_threadsafe(changed.set)
+            except RuntimeError:
+                # The loop of the follower is closed
+                pass
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        expired = [
+            task_id
+            for task_id, task in self._tasks.items()
+            if task["finished_at"] is not None and task["finished_at"] < cutoff
+        ]
+        for task_id in expired:
+            del self._tasks[task_id]
@@ -0,0 +1,335 @@
+# resilience.py
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import requests
+
+from config import Config
+
+# Statuses worth retrying: the service is overloaded, restarting or (Hugging Face) loading the model
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class OutboundError(Exception):
+    pass
+
+
+class CircuitOpenError(OutboundError):
+    pass
+
+
+class DeadlineExceededError(OutboundError):
+    pass
+
+
+class RetryableError(OutboundError):
+    """
+    Raised by a call for a failure worth retrying that is not an HTTP error, e.g. a model
+    that is still loading. `retry_after` is the delay in seconds the service asked for, if any.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(error):
+    """
+    Returns (retryable, delay asked for by the service) of an exception raised by a call.
+    """
+    if isinstance(error, RetryableError):
+        return True, error.retry_after
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError, TimeoutError)):
+        return True, None
+
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status not in RETRYABLE_STATUSES:
+        return False, None
+    try:
+        return True, float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return True, None
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after `threshold` consecutive failures.
+
+    While open, calls fail at once with CircuitOpenError. After `reset_timeout`
+    seconds one trial call is let through; its success closes the circuit again.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                if self._opened_at is None or self._trial:
+                    self.opened += 1
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+class Endpoint:
+    """
+    Outbound-call policy of one remote service: a timeout per attempt, a deadline over
+    all attempts, jittered exponential retries, a circuit breaker and optional hedging.
+
+    A call is given as `func(timeout)`, which must make a single attempt and give up
+    after `timeout` seconds. When hedging is on and an attempt is still running after
+    the p95 latency of the endpoint, a duplicate is sent and the first answer wins; only
+    use it for idempotent calls.
+    """
+
+    def __init__(self, name, timeout, deadline, max_attempts, backoff_base, backoff_max, breaker, hedge=False):
+        """
+        Parameters:
+            name (str): Name of the endpoint, used in logs and stats.
+            timeout (float): Seconds one attempt may take.
+            deadline (float): Seconds all attempts of a call, and the waits between them, may take.
+            max_attempts (int): Attempts before the last error is raised.
+            backoff_base (float): Upper bound in seconds of the first retry delay, doubled on every attempt.
+            backoff_max (float): Upper bound of the retry delay in seconds.
+            breaker (CircuitBreaker): Circuit breaker of the endpoint.
+            hedge (bool): Send a duplicate attempt when one is slower than the p95 latency.
+        """
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.hedge = hedge
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=Config.OUTBOUND_LATENCY_WINDOW)
+        self._executor = ThreadPoolExecutor(max_workers=Config.OUTBOUND_HEDGE_WORKERS) if hedge else None
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "hedged": 0, "hedge_wins": 0}
+
+    def call(self, func):
+        """
+        Runs `func(timeout)` under the policy of the endpoint and returns its result.
+        """
+        deadline = time.monotonic() + self.deadline
+        self._count("calls")
+        for attempt in range(1, self.max_attempts + 1):
+            timeout = self._attempt_timeout(deadline)
+            start = time.monotonic()
+            try:
+                result = self._attempt(func, timeout)
+            except Exception as e:
+                delay = self._after_failure(e, attempt, deadline)
+                time.sleep(delay)
+            else:
+                self._after_success(time.monotonic() - start)
+                return result
+
+    async def call_async(self, func):
+        """
+        Same as call, for a `func(timeout)` returning an awaitable.
+        """
+        deadline = time.monotonic() + self.deadline
+        self._count("calls")
+        for attempt in range(1, self.max_attempts + 1):
+            timeout = self._attempt_timeout(deadline)
+            start = time.monotonic()
+            try:
+                result = await self._attempt_async(func, timeout)
+            except Exception as e:
+                delay = self._after_failure(e, attempt, deadline)
+                await asyncio.sleep(delay)
+            else:
+                self._after_success(time.monotonic() - start)
+                return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            latencies = sorted(self._latencies)
+        stats["circuit_open"] = int(self.breaker.state == "open")
+        stats["circuit_opened"] = self.breaker.opened
+        if latencies:
+            stats["p95_seconds"] = latencies[int(0.95 * (len(latencies) - 1))]
+        return stats
+
+    def _attempt_timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededError(f"{self.name}: deadline of {self.deadline}s exceeded")
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise CircuitOpenError(f"{self.name}: circuit open after repeated failures")
+        return min(self.timeout, remaining)
+
+    def _after_success(self, elapsed):
+        self.breaker.record_success()
+        with self._lock:
+            self._latencies.append(elapsed)
+
+    def _after_failure(self, error, attempt, deadline):
+        """
+        Records a failed attempt and returns the delay before the next one, or re-raises
+        the error when it is final.
+        """
+        self._count("failures")
+        retryable, retry_after = _retry_after(error)
+        if not retryable:
+            # The service answered; a bad request says nothing about its health
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+        if attempt == self.max_attempts:
+            raise error
+
+        # Full jitter, unless the service said how long to wait
+        delay = retry_after if retry_after is not None else random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        )
+        if time.monotonic() + delay >= deadline:
+            # Waiting would outlive the deadline; fail now rather than later
+            raise error
+        logging.warning(f"{self.name} attempt {attempt} failed ({error}), retrying in {delay:.1f}s")
+        self._count("retries")
+        return delay
+
+    def _hedge_delay(self):
+        if not self.hedge:
+            return None
+        with self._lock:
+            if len(self._latencies) < Config.OUTBOUND_HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def _attempt(self, func, timeout):
+        delay = self._hedge_delay()
+        if delay is None or delay >= timeout:
+            return func(timeout)
+
+        # Copy the context so the timings of both attempts reach the caller's trace
+        primary = self._executor.submit(contextvars.copy_context().run, func, timeout)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self._count("hedged")
+        backup = self._executor.submit(contextvars.copy_context().run, func, timeout - delay)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is backup:
+                    self._count("hedge_wins")
+                return result
+        raise error
+
+    async def _attempt_async(self, func, timeout):
+        delay = self._hedge_delay()
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(func(timeout), timeout)
+
+        primary = asyncio.ensure_future(asyncio.wait_for(func(timeout), timeout))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self._count("hedged")
+        backup = asyncio.ensure_future(asyncio.wait_for(func(timeout - delay), timeout - delay))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is backup:
+                        self._count("hedge_wins")
+                    return task.result()
+            raise error
+        finally:
+            # The losing attempt is not needed any more
+            for task in pending:
+                task.cancel()
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoint(name):
+    """
+    Returns the shared Endpoint of a remote service ("kindo", "whisper" or "vision"), configured from Config.
+    """
+    with _endpoints_lock:
+        if name not in _endpoints:
+            timeout, deadline = Config.OUTBOUND_TIMEOUTS[name]
+            _endpoints[name] = Endpoint(
+                name,
+                timeout=timeout,
+                deadline=deadline,
+                max_attempts=Config.OUTBOUND_MAX_ATTEMPTS,
+                backoff_base=Config.OUTBOUND_BACKOFF_BASE,
+                backoff_max=Config.OUTBOUND_BACKOFF_MAX,
+                breaker=CircuitBreaker(Config.OUTBOUND_BREAKER_THRESHOLD, Config.OUTBOUND_BREAKER_RESET),
+                hedge=name in Config.OUTBOUND_HEDGE,
+            )
+        return _endpoints[name]
+
+
+def outbound_stats():
+    with _endpoints_lock:
+        endpoints = dict(_endpoints)
+    return {name: endpoint.stats() for name, endpoint in endpoints.items()}
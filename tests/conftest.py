@@ -0,0 +1,29 @@
+"""
+Fixtures shared by the tests, built on the in-process fakes of the benchmark with no latency.
+"""
+import mongomock
+import pytest
+
+from benchmark.fakes import DEFAULT_PROFILES, FakeMongoDatabase, build_services, fake_qdrant_client
+
+
+@pytest.fixture
+def services():
+    return build_services(DEFAULT_PROFILES, latency_scale=0)
+
+
+@pytest.fixture
+def mongo_db(services):
+    return FakeMongoDatabase(mongomock.MongoClient()["artist"], services["mongo"])
+
+
+@pytest.fixture
+def qdrant(services, monkeypatch):
+    """
+    In-memory Qdrant client used by the vector backends for the duration of a test.
+    """
+    import artist_matching.qdrant_handler as qdrant_handler
+
+    client = fake_qdrant_client(services["qdrant"])
+    monkeypatch.setattr(qdrant_handler, "get_qdrant_client", lambda: client)
+    return client
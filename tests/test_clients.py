@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from clients import ClientRegistry
+
+
+def test_slow_build_does_not_block_other_clients():
+    registry = ClientRegistry()
+    building = threading.Event()
+    release = threading.Event()
+
+    def slow_factory():
+        building.set()
+        assert release.wait(5)
+        return "index"
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(registry.get, "local_index", slow_factory)
+        assert building.wait(5)
+        # Served while the index is still being built
+        assert registry.get("http_session", lambda: "session") == "session"
+        release.set()
+        assert future.result(5) == "index"
+
+
+def test_concurrent_first_calls_build_once():
+    registry = ClientRegistry()
+    builds = []
+    release = threading.Event()
+
+    def factory():
+        builds.append(1)
+        assert release.wait(5)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(registry.get, "qdrant", factory) for _ in range(8)]
+        release.set()
+        clients = {id(future.result(5)) for future in futures}
+
+    assert len(builds) == 1
+    assert len(clients) == 1
+    assert registry.stats()["qdrant"] == {"hits": 7, "misses": 1}
+
+
+def test_failed_build_is_retried():
+    registry = ClientRegistry()
+
+    def broken():
+        raise ConnectionError("unreachable")
+
+    with pytest.raises(ConnectionError):
+        registry.get("whisper", broken)
+    assert registry.get("whisper", lambda: "client") == "client"
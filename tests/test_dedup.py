@@ -0,0 +1,101 @@
+import pytest
+
+from artist_matching.dedup import (
+    HASH_BANDS,
+    HASH_BITS,
+    closest_match,
+    dedup_fields,
+    duplicate_query,
+    hamming,
+    hash_bands,
+    max_distance,
+    near_duplicate_query,
+)
+from config import Config
+
+PHASH = "f0e1d2c3b4a59687"
+BAND_BITS = HASH_BITS // HASH_BANDS
+
+
+def flip(phash, positions):
+    """
+    Flips the given bits of a hash, counted from the most significant one.
+    """
+    value = int(phash, 16)
+    for position in positions:
+        value ^= 1 << (HASH_BITS - 1 - position)
+    return f"{value:016x}"
+
+
+@pytest.fixture
+def media(mongo_db):
+    collection = mongo_db.media
+    collection.insert_one({"url": "original", **dedup_fields("image", "original-sha", PHASH)})
+    return collection
+
+
+def find_near_duplicate(media, media_type, phash):
+    candidates = list(media.find(near_duplicate_query(media_type, phash)))
+    return candidates, closest_match(candidates, phash)
+
+
+def test_bands_cover_the_hash():
+    bands = hash_bands(PHASH)
+    assert len(bands) == HASH_BANDS
+    assert "".join(band.split(":")[1] for band in bands) == f"{int(PHASH, 16):064b}"
+
+
+def test_bands_do_not_depend_on_the_threshold(monkeypatch):
+    bands = hash_bands(PHASH)
+    monkeypatch.setattr(Config, "DEDUP_MAX_DISTANCE", 1)
+    assert hash_bands(PHASH) == bands
+
+
+@pytest.mark.parametrize("band", range(HASH_BANDS))
+def test_hash_within_threshold_is_found_by_its_bands(media, band):
+    # One bit flipped in every band but one: the untouched band still matches
+    positions = [other * BAND_BITS + 5 for other in range(HASH_BANDS) if other != band]
+    near = flip(PHASH, positions)
+    assert hamming(PHASH, near) == max_distance()
+
+    candidates, match = find_near_duplicate(media, "image", near)
+    assert [candidate["url"] for candidate in candidates] == ["original"]
+    assert match["url"] == "original"
+
+
+def test_hash_differing_in_every_band_is_not_a_candidate(media):
+    far = flip(PHASH, [band * BAND_BITS for band in range(HASH_BANDS)])
+    candidates, match = find_near_duplicate(media, "image", far)
+    assert candidates == []
+    assert match is None
+
+
+def test_candidate_beyond_threshold_is_rejected(media):
+    # Shares its first band, but too many bits differ in the others
+    far = flip(PHASH, [BAND_BITS + i for i in range(max_distance() + 1)])
+    candidates, match = find_near_duplicate(media, "image", far)
+    assert len(candidates) == 1
+    assert match is None
+
+
+def test_other_media_type_never_matches(media):
+    candidates, match = find_near_duplicate(media, "audio", PHASH)
+    assert candidates == []
+    assert match is None
+
+
+def test_hashes_of_another_fingerprint_version_are_ignored(media):
+    media.update_one({"url": "original"}, {"$set": {"phash_version": 0}})
+    candidates, _ = find_near_duplicate(media, "image", PHASH)
+    assert candidates == []
+
+
+def test_closest_candidate_wins(media):
+    media.insert_one({"url": "closer", **dedup_fields("image", "closer-sha", flip(PHASH, [0]))})
+    _, match = find_near_duplicate(media, "image", flip(PHASH, [0, 20]))
+    assert match["url"] == "closer"
+
+
+def test_only_identical_content_is_a_duplicate(media):
+    assert media.find_one(duplicate_query("original-sha"))["url"] == "original"
+    assert media.find_one(duplicate_query("other-sha")) is None
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+from job_queue import JobQueue, QueueFullError
+
+
+@pytest.fixture
+def queue(mongo_db):
+    queue = JobQueue(
+        collection=mongo_db.jobs,
+        workers=1,
+        max_pending=2,
+        max_attempts=3,
+        backoff_base=10,
+        backoff_max=15,
+        lease_seconds=30,
+        retention=3600,
+        poll_interval=0.01,
+    )
+    queue.ensure_indexes()
+    return queue
+
+
+def make_due(queue, job_id):
+    queue.jobs.update_one({"_id": job_id}, {"$set": {"run_at": time.time()}})
+
+
+def test_failed_job_is_retried_with_backoff_then_failed(queue):
+    attempts = []
+
+    def handler(**payload):
+        attempts.append(payload)
+        raise RuntimeError("kindo down")
+
+    queue.register("work", handler)
+    job_id = queue.submit("work", {"url": "a"})
+
+    queue._run(queue._claim())
+    job = queue.jobs.find_one({"_id": job_id})
+    assert job["status"] == "queued"
+    assert job["attempts"] == 1
+    assert job["error"] == "kindo down"
+    # backoff_base, jittered down to at most half
+    assert 5 <= job["run_at"] - job["updated_at"] <= 10
+    # Not claimed before its backoff
+    assert queue._claim() is None
+
+    make_due(queue, job_id)
+    queue._run(queue._claim())
+    job = queue.jobs.find_one({"_id": job_id})
+    # Doubled, then capped by backoff_max
+    assert 7.5 <= job["run_at"] - job["updated_at"] <= 15
+
+    make_due(queue, job_id)
+    queue._run(queue._claim())
+    job = queue.jobs.find_one({"_id": job_id})
+    assert job["status"] == "failed"
+    assert job["attempts"] == 3
+    assert "finished_at" in job
+    assert attempts == [{"url": "a"}] * 3
+
+
+def test_expired_lease_is_reclaimed(queue):
+    queue.register("work", lambda: None)
+    job_id = queue.submit("work", {})
+
+    lost = queue._claim()
+    assert queue.get(job_id)["status"] == "running"
+    # The worker holding it died: nobody renews the lease
+    queue.jobs.update_one({"_id": job_id}, {"$set": {"lease_expires": time.time() - 1}})
+
+    reclaimed = queue._claim()
+    assert reclaimed["_id"] == job_id
+    assert reclaimed["lease"] != lost["lease"]
+    # The lost run counts as an attempt
+    assert reclaimed["attempts"] == 1
+
+    # A late outcome of the lost worker does not overwrite the new run
+    queue._finish(lost, 1, "failed", "lost")
+    assert queue.get(job_id)["status"] == "running"
+
+    queue._run(reclaimed)
+    assert queue.get(job_id)["status"] == "done"
+
+
+def test_job_killing_its_workers_fails_after_max_attempts(queue):
+    queue.register("work", lambda: None)
+    job_id = queue.submit("work", {})
+
+    for attempt in range(queue.max_attempts):
+        assert queue._claim()["_id"] == job_id
+        queue.jobs.update_one({"_id": job_id}, {"$set": {"lease_expires": time.time() - 1}})
+
+    assert queue._claim() is None
+    job = queue.jobs.find_one({"_id": job_id})
+    assert job["status"] == "failed"
+    assert job["attempts"] == queue.max_attempts
+    assert "finished_at" in job
+
+
+def test_running_job_renews_its_lease(mongo_db):
+    queue = JobQueue(mongo_db.jobs, 1, 10, 1, 1, 1, lease_seconds=0.3, retention=3600, poll_interval=0.01)
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler():
+        started.set()
+        release.wait(5)
+
+    queue.register("slow", handler)
+    job_id = queue.submit("slow", {})
+    runner = threading.Thread(target=queue._run, args=(queue._claim(),))
+    runner.start()
+    started.wait(5)
+
+    # Well past the initial lease, another worker still finds nothing to reclaim
+    time.sleep(0.6)
+    assert queue._claim() is None
+    release.set()
+    runner.join(5)
+    assert queue.get(job_id)["status"] == "done"
+    assert queue.get(job_id)["attempts"] == 1
+
+
+def test_delayed_jobs_do_not_count_as_pending(queue):
+    queue.submit("work", {}, delay=60)
+    queue.submit("work", {}, delay=60)
+    queue.submit("work", {})
+    queue.submit("work", {})
+    with pytest.raises(QueueFullError):
+        queue.check_capacity()
+    with pytest.raises(QueueFullError):
+        queue.submit("work", {})
@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pipeline import StageGraph
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+def test_stages_receive_the_results_they_depend_on(executor):
+    graph = StageGraph(executor)
+    graph.add("upload", lambda: "url")
+    graph.add("source", lambda media: media.upper(), after=["media"])
+    graph.add("save", lambda url, source: (url, source), after=["upload", "source"])
+
+    results = graph.run(media="song")
+    assert results["save"] == ("url", "SONG")
+
+
+def test_failing_stage_stops_its_dependants(executor):
+    ran = []
+
+    def transcribe():
+        raise RuntimeError("transcription failed")
+
+    graph = StageGraph(executor)
+    graph.add("upload", lambda: ran.append("upload") or "url")
+    graph.add("source", transcribe)
+    graph.add("analysis", lambda source: ran.append("analysis"), after=["source"])
+    graph.add("save", lambda url, analysis: ran.append("save"), after=["upload", "analysis"])
+
+    with pytest.raises(RuntimeError, match="transcription failed"):
+        graph.run()
+    assert "analysis" not in ran
+    assert "save" not in ran
+
+
+def test_unknown_and_circular_dependencies_are_rejected(executor):
+    with pytest.raises(ValueError, match="unknown"):
+        StageGraph(executor).add("save", lambda url: url, after=["upload"]).run()
+
+    graph = StageGraph(executor)
+    graph.add("a", lambda b: b, after=["b"])
+    graph.add("b", lambda a: a, after=["a"])
+    with pytest.raises(ValueError, match="each other"):
+        graph.run()
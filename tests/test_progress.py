@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import time
+
+from progress import ProgressTracker
+
+
+def reporting(report):
+    for step in range(3):
+        time.sleep(0.05)
+        report("step", step)
+    return "done"
+
+
+def test_async_followers_do_not_hold_threads():
+    tracker = ProgressTracker(workers=1, max_pending=10, ttl=60)
+
+    async def follow_all():
+        task_id = tracker.start(reporting)
+        threads = threading.active_count()
+
+        async def follow():
+            return [event async for event in tracker.follow_async(task_id, timeout=0.02)]
+
+        followed = await asyncio.gather(*(follow() for _ in range(100)))
+        assert threading.active_count() <= threads
+        return followed
+
+    for events in asyncio.run(follow_all()):
+        # Keep-alives (None) are sent while no event arrives
+        assert [event for event in events if event] == [{"stage": "step", "data": step} for step in range(3)]
+    assert tracker._watchers == {}
+
+
+def test_async_follower_sees_the_events_of_an_async_task():
+    tracker = ProgressTracker(workers=1, max_pending=10, ttl=60)
+
+    async def run(report):
+        await asyncio.sleep(0.01)
+        report("tags", {"tags": ["Joy"]})
+        return "done"
+
+    async def follow():
+        task_id = tracker.start_async(run)
+        events = [event async for event in tracker.follow_async(task_id)]
+        return task_id, events
+
+    task_id, events = asyncio.run(follow())
+    assert events == [{"stage": "tags", "data": {"tags": ["Joy"]}}]
+    assert tracker.get(task_id)["status"] == "done"
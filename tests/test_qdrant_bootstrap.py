@@ -0,0 +1,58 @@
+import pytest
+
+from artist_matching.qdrant_handler import create_collection_if_not_exists, resolve_alias
+
+NAME = "artworks"
+
+
+class RacingClient:
+    """
+    Qdrant client on which a rival worker bootstraps the collection between the existence
+    check and the create, and which rejects an existing alias as the server does.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.raced = False
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def create_collection(self, **kwargs):
+        if not self.raced:
+            self.raced = True
+            create_collection_if_not_exists(self._client, NAME, size=4)
+        return self._client.create_collection(**kwargs)
+
+    def update_collection_aliases(self, change_aliases_operations):
+        for operation in change_aliases_operations:
+            if resolve_alias(self._client, operation.create_alias.alias_name) is not None:
+                raise ValueError(f"Alias {operation.create_alias.alias_name} already exists")
+        return self._client.update_collection_aliases(change_aliases_operations=change_aliases_operations)
+
+
+def collections(client):
+    return sorted(collection.name for collection in client.get_collections().collections)
+
+
+def test_creates_the_collection_behind_an_alias(qdrant):
+    create_collection_if_not_exists(qdrant, NAME, size=4)
+    assert collections(qdrant) == [resolve_alias(qdrant, NAME)]
+
+
+def test_worker_losing_the_race_drops_its_collection(qdrant):
+    client = RacingClient(qdrant)
+    create_collection_if_not_exists(client, NAME, size=4)
+
+    assert client.raced
+    # Only the rival's collection is left, and the alias still points at it
+    assert collections(qdrant) == [resolve_alias(qdrant, NAME)]
+
+
+def test_other_failures_are_raised(qdrant):
+    class BrokenClient(RacingClient):
+        def create_collection(self, **kwargs):
+            raise ConnectionError("Qdrant is unreachable")
+
+    with pytest.raises(ConnectionError):
+        create_collection_if_not_exists(BrokenClient(qdrant), NAME, size=4)
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from qdrant_client.http import models
+
+from artist_matching.local_index import LocalIndex
+from artist_matching.qdrant_handler import VECTOR_BACKENDS
+from config import Config
+
+DIM = 8
+COLLECTION = "test"
+TAGS = ["Joy", "Hope", "Fear", "Love"]
+QUERY_TAGS = ["Joy", "Hope"]
+
+
+def make_points(count=60, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        models.PointStruct(
+            id=i,
+            vector=rng.standard_normal(DIM).tolist(),
+            payload={
+                "type": "audio",
+                "url": f"https://media/{i}",
+                "tags": list(rng.choice(TAGS, size=rng.integers(1, 3), replace=False)),
+            },
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.fixture(autouse=True)
+def should_mode(monkeypatch):
+    monkeypatch.setattr(Config, "TAG_FILTER_MODE", "should")
+    monkeypatch.setattr(Config, "TAG_MIN_MATCH", 1)
+    monkeypatch.setattr(Config, "TAG_WEIGHT", 0.1)
+
+
+@pytest.fixture
+def points(qdrant):
+    points = make_points()
+    qdrant.create_collection(
+        COLLECTION, vectors_config=models.VectorParams(size=DIM, distance=models.Distance.COSINE)
+    )
+    qdrant.upsert(COLLECTION, points)
+    return points
+
+
+@pytest.fixture
+def query():
+    return np.random.default_rng(1).standard_normal(DIM).tolist()
+
+
+def search(limit, offset, query):
+    return VECTOR_BACKENDS["qdrant"].search(COLLECTION, query, "audio", QUERY_TAGS, limit, offset, None)
+
+
+def test_pages_tile_the_full_ranking(points, query):
+    full = search(12, 0, query)
+    pages = [search(4, offset, query) for offset in (0, 4, 8)]
+    assert [point.id for page in pages for point in page] == [point.id for point in full]
+
+
+def test_score_stays_the_cosine_similarity(points, query):
+    vectors = {point.id: np.asarray(point.vector) for point in points}
+    query_vector = np.asarray(query)
+    hits = search(12, 0, query)
+
+    assert [hit.order_value for hit in hits] == sorted((hit.order_value for hit in hits), reverse=True)
+    for hit in hits:
+        vector = vectors[hit.id]
+        cosine = vector @ query_vector / np.linalg.norm(vector) / np.linalg.norm(query_vector)
+        assert hit.score == pytest.approx(cosine, abs=1e-5)
+        assert hit.score <= 1
+        assert hit.order_value >= hit.score
+
+
+def test_batch_search_matches_single_searches(points, query):
+    batch = VECTOR_BACKENDS["qdrant"].search_batch(
+        COLLECTION, [(query, "audio", QUERY_TAGS, 4, offset, None) for offset in (0, 4)]
+    )
+    assert [[hit.id for hit in hits] for hits in batch] == [
+        [hit.id for hit in search(4, offset, query)] for offset in (0, 4)
+    ]
+
+
+def test_local_index_pages_like_qdrant(points, query, tmp_path):
+    index = LocalIndex(COLLECTION, DIM, str(tmp_path))
+    index.upsert(points)
+    # Set by the first sync in production
+    index.ready.set()
+    for offset in (0, 4, 8):
+        local = index.search(query, "audio", QUERY_TAGS, 4, offset)
+        assert [int(hit.id) for hit in local] == [hit.id for hit in search(4, offset, query)]
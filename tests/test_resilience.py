@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from benchmark.fakes import FakeServiceError, Service
+from resilience import CircuitBreaker, CircuitOpenError, Endpoint
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.opened == 1
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_breaker_lets_a_single_trial_through():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    # Other calls are rejected while the trial runs
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.opened == 2
+
+
+def endpoint(max_attempts=3, threshold=3):
+    return Endpoint(
+        "test",
+        timeout=1,
+        deadline=5,
+        max_attempts=max_attempts,
+        backoff_base=0.01,
+        backoff_max=0.01,
+        breaker=CircuitBreaker(threshold, reset_timeout=60),
+    )
+
+
+def test_endpoint_retries_until_the_breaker_opens():
+    flaky = Service("flaky", latency=0, error_rate=1)
+    outbound = endpoint()
+
+    with pytest.raises(FakeServiceError):
+        outbound.call(lambda timeout: flaky.call("flaky", lambda: "ok"))
+    assert outbound.counters["failures"] == 3
+    assert outbound.counters["retries"] == 2
+
+    # The breaker is open: the next call is rejected without being attempted
+    with pytest.raises(CircuitOpenError):
+        outbound.call(lambda timeout: "ok")
+    assert outbound.counters["rejected"] == 1
+
+
+def test_endpoint_does_not_retry_client_errors():
+    outbound = endpoint(threshold=1)
+    attempts = []
+
+    def call(timeout):
+        attempts.append(timeout)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        outbound.call(call)
+    assert len(attempts) == 1
+    assert outbound.breaker.state == "closed"
@@ -0,0 +1,119 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from artist_matching import stage_cache
+from artist_matching.stage_cache import (
+    MemoryTier,
+    SQLiteTier,
+    StageCache,
+    cached_stage,
+    cached_stage_async,
+    make_key,
+)
+from config import Config
+
+
+def test_memory_tier_evicts_least_recently_used():
+    tier = MemoryTier(max_bytes=10, ttl=60)
+    tier.set("a", b"aaaa")
+    tier.set("b", b"bbbb")
+    assert tier.get("a") == b"aaaa"
+
+    tier.set("c", b"cccc")
+    assert tier.get("b") is None
+    assert tier.get("a") == b"aaaa"
+    assert tier.bytes_used == 8
+
+
+def test_memory_tier_drops_expired_and_oversized_values():
+    tier = MemoryTier(max_bytes=10, ttl=60)
+    tier.set("old", b"old", expires_at=time.time() - 1)
+    tier.set("big", b"x" * 11)
+    assert tier.get("old") is None
+    assert tier.get("big") is None
+    assert tier.bytes_used == 0
+
+
+@pytest.fixture
+def disk(tmp_path):
+    return SQLiteTier(str(tmp_path / "stage_cache.sqlite3"), max_bytes=10, ttl=60)
+
+
+def test_sqlite_tier_uses_wal(disk):
+    assert disk._conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_sqlite_tier_evicts_least_recently_used(disk):
+    disk.ACCESS_RESOLUTION = 0
+    disk.set("a", b"aaaa")
+    disk.set("b", b"bbbb")
+    assert disk.get("a")[0] == b"aaaa"
+
+    disk.set("c", b"cccc")
+    assert disk.get("b") == (None, None)
+    assert disk.get("a")[0] == b"aaaa"
+    assert disk.bytes_used == 8
+
+
+def test_sqlite_tier_expires_entries(tmp_path):
+    disk = SQLiteTier(str(tmp_path / "stage_cache.sqlite3"), max_bytes=10, ttl=0)
+    disk.set("a", b"aaaa")
+    time.sleep(0.01)
+    assert disk.get("a") == (None, None)
+
+    # Expired rows are removed on the next write
+    disk.set("b", b"bbbb")
+    assert disk.bytes_used == 4
+
+
+def test_disk_hits_are_promoted_to_memory(tmp_path):
+    cache = StageCache(str(tmp_path / "stage_cache.sqlite3"), memory_bytes=1024, disk_bytes=1024, ttl=60)
+    cache.disk.set("key", b'{"tags": ["Joy"]}')
+    assert cache.get("key") == {"tags": ["Joy"]}
+    assert cache.get("key") == {"tags": ["Joy"]}
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.stats()["memory_hits"] == 1
+
+
+class BrokenCache:
+    def get(self, key):
+        raise sqlite3.OperationalError("database is locked")
+
+    def set(self, key, value):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_cache_errors_do_not_fail_the_stage(monkeypatch):
+    monkeypatch.setattr(Config, "STAGE_CACHE_ENABLED", True)
+    monkeypatch.setattr(stage_cache, "get_stage_cache", lambda: BrokenCache())
+    assert cached_stage("describe", "model", 1, "hash", lambda: {"description": "d"}) == {"description": "d"}
+
+
+def test_async_stage_reads_sqlite_off_the_event_loop(tmp_path, monkeypatch):
+    cache = StageCache(str(tmp_path / "stage_cache.sqlite3"), memory_bytes=1024, disk_bytes=1024, ttl=60)
+    cache.disk.set(make_key("describe", "model", 1, "hash"), b'{"description": "d"}')
+    loop_thread = threading.get_ident()
+    disk_threads = []
+    disk_get = cache.disk.get
+
+    def get(key):
+        disk_threads.append(threading.get_ident())
+        return disk_get(key)
+
+    monkeypatch.setattr(cache.disk, "get", get)
+    monkeypatch.setattr(Config, "STAGE_CACHE_ENABLED", True)
+    monkeypatch.setattr(stage_cache, "_cache", cache)
+
+    async def compute():
+        raise AssertionError("cached")
+
+    for _ in range(2):
+        value = asyncio.run(cached_stage_async("describe", "model", 1, "hash", compute))
+        assert value == {"description": "d"}
+    # Read once from SQLite in a thread, then served from memory
+    assert len(disk_threads) == 1
+    assert disk_threads[0] != loop_thread